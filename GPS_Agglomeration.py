@@ -6,24 +6,83 @@ File: GPS_Agglomeration.py
 # Dendogram
 from scipy.cluster.hierarchy import dendrogram, linkage
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import math
+import os
 
 # DBScan
 from sklearn.cluster import DBSCAN
 from geopy.distance import great_circle
-from shapely.geometry import MultiPoint
 
 # Cosine Similarity
 from numpy import dot
 from numpy.linalg import norm
 
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from scipy.cluster import hierarchy
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, kmeans_plusplus
+from scipy.spatial import cKDTree
 
+# Own code
+from GPS_Helper import EARTH_RADIUS, bearing_array, bearing_consecutive, write_atomic
+from GPS_Profile import PROFILER
+
+
+def group_by_label(labels, num_labels=0):
+    '''
+    Group the points by their cluster label with one sort,
+    instead of going over every point once per cluster
+    :param labels: The cluster label of every point, negative for noise
+    :param num_labels: Least number of clusters, trailing ones may be empty
+    :return: order, the index of every point sorted by label without the
+             noise, and offsets, so cluster n is order[offsets[n]:offsets[n + 1]]
+    '''
+    labels = np.asarray(labels, dtype=np.intp)
+    counts = np.bincount(labels[labels >= 0], minlength=num_labels)
+
+    # The sort is stable, so every cluster keeps the order of its
+    # points. Noise is negative and sorts to the front, cut it off
+    order = np.argsort(labels, kind='stable')
+    order = order[len(labels) - counts.sum():]
+    offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    return order, offsets
+
+class Clusters:
+    '''
+    The points of every cluster. The points are sorted by cluster
+    once, so every cluster is a view of that one array rather than
+    a copy of its own
+    '''
+
+    def __init__(self, coords, labels, num_clusters=0):
+        '''
+        :param coords: The coordinates [time, lon, lat, speed]
+        :param labels: The cluster label of every coordinate, negative for noise
+        :param num_clusters: Least number of clusters, trailing ones may be empty
+        '''
+        self.index, self.offsets = group_by_label(labels, num_clusters)
+        self.points = np.asarray(coords)[self.index]
+
+    def labels(self):
+        '''
+        :return: The cluster of every point in self.points
+        '''
+        return np.repeat(np.arange(len(self)), np.diff(self.offsets))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, n):
+        if not -len(self) <= n < len(self):
+            raise IndexError('cluster {} out of range'.format(n))
+        n %= len(self)
+        return self.points[self.offsets[n]:self.offsets[n + 1]]
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self.points[self.offsets[n]:self.offsets[n + 1]]
 
 def DBScan_Cluster(coords):
     '''
@@ -35,13 +94,16 @@ def DBScan_Cluster(coords):
     # A list extracting only the Lon and Lat Coordinates
     lon_lat_coords = [(coord[1], coord[2]) for coord in coords]
 
-    db = DBSCAN(eps=0.0001, min_samples=15, algorithm='auto', metric='manhattan').fit(lon_lat_coords)
+    with PROFILER.stage('DBScan_Cluster', rows=len(lon_lat_coords)):
+        db = DBSCAN(eps=0.0001, min_samples=15, algorithm='auto', metric='manhattan').fit(lon_lat_coords)
     cluster_labels = db.labels_
-    num_clusters = len(set(cluster_labels))
+
+    # Label -1 is noise, the clusters are labelled 0 to num_clusters - 1
+    num_clusters = int(cluster_labels.max()) + 1 if len(cluster_labels) > 0 else 0
 
     # Put the points into respective bins, given which cluster
     # the point was classified in
-    clusters = pd.Series([coords[cluster_labels == n] for n in range(num_clusters)])
+    clusters = Clusters(coords, cluster_labels, num_clusters)
     print('Number of clusters: {}'.format(num_clusters))
 
     total_pts = len(cluster_labels)
@@ -49,11 +111,49 @@ def DBScan_Cluster(coords):
     print(total_pts)
 
     print("Medoid from DBScan")
-    medoids = get_medoid(clusters)
+    with PROFILER.stage('get_medoid', rows=total_pts):
+        medoids = get_medoid(clusters)
     print(medoids.head(10))
 
     return medoids, clusters
 
+def DBScan_Stops(coords, eps=10, min_samples=15, max_speed=10):
+    '''
+    Find the stops of a trace with DBSCAN. Only the slow points are
+    clustered, through a ball tree on the haversine distance, so eps is
+    a real distance and the cost grows close to linearly with the trace
+    :param coords: A list of Coordinates [time, lon, lat, speed]
+    :param eps: Neighbourhood radius in meters
+    :param min_samples: Number of points within eps that make a point the core of a stop
+    :param max_speed: Points faster than this are never part of a stop
+    :return: A list of medoids, and a list of points in every stop
+    '''
+    coords = np.asarray(coords, dtype=np.float64)
+
+    # A vehicle that is driving by is not stopping
+    slow = coords[coords[:, 3] <= max_speed]
+
+    with PROFILER.stage('DBScan_Stops', rows=len(slow)):
+        if len(slow) >= min_samples:
+            # The haversine metric wants [lat, lon] in radians, and eps as an angle
+            lat_lon = np.radians(slow[:, [2, 1]])
+            db = DBSCAN(eps=eps / EARTH_RADIUS, min_samples=min_samples, algorithm='ball_tree',
+                        metric='haversine').fit(lat_lon)
+            cluster_labels = db.labels_
+        else:
+            cluster_labels = np.full(len(slow), -1)
+
+    # Label -1 is noise, the stops are labelled 0 to num_clusters - 1
+    num_clusters = int(cluster_labels.max()) + 1 if len(cluster_labels) > 0 else 0
+
+    clusters = Clusters(slow, cluster_labels, num_clusters)
+    print('Number of stops: {} out of {} slow points'.format(num_clusters, len(slow)))
+
+    with PROFILER.stage('get_medoid', rows=len(slow)):
+        medoids = medoids_from_labels(slow, cluster_labels)
+
+    return medoids, clusters
+
 # Another garbage function...
 def sort_points(coords):
     '''
@@ -77,34 +177,65 @@ def get_medoid(clusters):
     :return: a list of medoids for each DBScan cluster
     '''
 
-    # For every cluster, find a real point
-    # that is closest to the cluster
-    # and save that
-    medoids = {'time': [], 'lon': [], 'lat': [], 'speed': []}
+    # Already grouped, every cluster is part of one array
+    if isinstance(clusters, Clusters):
+        return medoids_from_labels(clusters.points, clusters.labels())
 
-    for cluster in clusters:
+    # Stack the clusters back into one array, and label every
+    # point with the position of the cluster it came from
+    clusters = [np.asarray(cluster, dtype=np.float64).reshape(-1, 4) for cluster in clusters]
+    if len(clusters) == 0:
+        return medoids_from_labels(np.empty((0, 4)), np.empty(0, dtype=np.intp))
 
-        # Only calculate the the centroid, if there are points
-        # in the cluster
-        if len(cluster) > 0:
+    labels = np.repeat(np.arange(len(clusters)), [len(cluster) for cluster in clusters])
 
-            # For each cluster, get the centroid, and find the closest
-            # point to the centroid, but still a point within the original
-            # data
-            lon_lat_clust = np.array([[coord[1], coord[2]] for coord in cluster])
-            centroid = (MultiPoint(lon_lat_clust).centroid.x, MultiPoint(lon_lat_clust).centroid.y)
+    return medoids_from_labels(np.concatenate(clusters), labels)
 
-            # Find a real point that is closest to the centroid
-            medoid = find_minDist(centroid, lon_lat_clust)
-            medoids['time'].append(np.mean(cluster[:,0]))
-            medoids['lon'].append(medoid[0])
-            medoids['lat'].append(medoid[1])
-            medoids['speed'].append(np.mean(cluster[:,3]))
+def medoids_from_labels(coords, labels):
+    '''
+    For every cluster, find the real point that is closest
+    to the centroid of the cluster. All the clusters are done
+    together, grouped by their label
+    :param coords: The coordinates [time, lon, lat, speed]
+    :param labels: The cluster label of every coordinate, negative for noise
+    :return: a list of medoids, one for each non empty cluster in label order
+    '''
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+    labels = np.asarray(labels, dtype=np.intp)
+
+    # Group the points by cluster, noise does not belong to any
+    order, offsets = group_by_label(labels)
+    coords, labels = coords[order], labels[order]
+
+    # Size of every cluster, and the mean of every column,
+    # the lon/lat mean is the centroid of the cluster
+    counts = np.diff(offsets)
+    nonempty = counts > 0
+    means = np.zeros((len(counts), 4))
+    for col in range(4):
+        means[:, col] = np.bincount(labels, weights=coords[:, col], minlength=len(counts))
+    means[nonempty] /= counts[nonempty, None]
+
+    # Distance from every point to the centroid of its own cluster
+    dist = np.hypot(coords[:, 1] - means[labels, 1], coords[:, 2] - means[labels, 2])
+
+    # The closest point of every cluster. Within a cluster the points
+    # are still in their original order, so a tie goes to the earliest
+    # point like find_minDist does
+    starts = offsets[:-1][nonempty]
+    closest = starts
+    if len(starts) > 0:
+        at_min = np.flatnonzero(dist <= np.repeat(np.minimum.reduceat(dist, starts), counts[nonempty]))
+        closest = at_min[np.searchsorted(at_min, starts)]
+
+    medoids_df = pd.DataFrame({'time': means[nonempty, 0],
+                               'lon': coords[closest, 1],
+                               'lat': coords[closest, 2],
+                               'speed': means[nonempty, 3]})
 
     # Google Earth doesn't like it when
     # there are duplicated coordinates
     # this prevents that
-    medoids_df = pd.DataFrame.from_dict(medoids)
     medoids_df = medoids_df.drop_duplicates(subset=['lon', 'lat'])
 
     # Reset index, so that you don't see 0, 9, 10 etc...
@@ -164,30 +295,182 @@ def cosine_distances(a, b):
     return dot(a, b)/(norm(a)*norm(b))
 
 
-def k_means(coords, n):
+class IncrementalKMeans:
+    '''
+    K-Means that is fit one chunk of points at a time. Every centroid
+    is the running mean of all the points that were ever assigned to
+    it, so a chunk only moves the centroids as much as its share of the
+    points does. The centroids and their counts can be saved, and the
+    next run carries on from them instead of clustering everything again
+    '''
+
+    def __init__(self, n_clusters, centroids_file=None):
+        '''
+        :param n_clusters: The number of clusters to make
+        :param centroids_file: .npz file of a previous run to warm start from, if it exists
+        '''
+        self.n_clusters = n_clusters
+        self.centroids = None
+        self.counts = None
+
+        # Points seen before there are enough to seed the centroids
+        self._pending = []
+
+        if centroids_file is not None and os.path.exists(centroids_file):
+            self.load(centroids_file)
+
+    def load(self, centroids_file):
+        '''
+        Warm start from the centroids of a previous run
+        :param centroids_file: .npz file written by save
+        '''
+        with np.load(centroids_file) as saved:
+            centroids, counts = saved['centroids'], saved['counts']
+
+        if len(centroids) != self.n_clusters:
+            raise ValueError('{} has {} centroids, expected {}'.format(centroids_file, len(centroids),
+                                                                       self.n_clusters))
+        self.centroids = centroids.astype(np.float64)
+        self.counts = counts.astype(np.int64)
+
+    def save(self, centroids_file):
+        '''
+        Save the centroids and their counts, so the next run can warm start
+        :param centroids_file: .npz file to write
+        '''
+        # A crash never leaves half a file behind
+        write_atomic(centroids_file, lambda f: np.savez(f, centroids=self.centroids, counts=self.counts))
+
+    def partial_fit(self, coords):
+        '''
+        Move the centroids with one more chunk of points
+        :param coords: The coordinates [time, lon, lat, speed]
+        :return: self
+        '''
+        lon_lat = np.asarray(coords, dtype=np.float64)[:, 1:3]
+
+        if self.centroids is None:
+            # Seed the centroids with k-means++ as soon as
+            # there are enough points to pick them from
+            self._pending.append(lon_lat)
+            lon_lat = np.concatenate(self._pending)
+            if len(lon_lat) < self.n_clusters:
+                return self
+            self._pending = []
+            self.centroids, _ = kmeans_plusplus(lon_lat, self.n_clusters, random_state=0)
+            self.counts = np.zeros(self.n_clusters, dtype=np.int64)
+        else:
+            self._cover(lon_lat)
+
+        cluster_labels = self._nearest(lon_lat)
+
+        # Sum and count of the chunk's points in every cluster
+        batch_counts = np.bincount(cluster_labels, minlength=self.n_clusters)
+        batch_sums = np.column_stack([np.bincount(cluster_labels, weights=lon_lat[:, col],
+                                                  minlength=self.n_clusters) for col in range(2)])
+
+        # Fold them into the running means
+        self.counts += batch_counts
+        hit = batch_counts > 0
+        self.centroids[hit] += (batch_sums[hit] - batch_counts[hit, None] * self.centroids[hit]) / \
+                               self.counts[hit, None]
+
+        return self
+
+    def predict(self, coords):
+        '''
+        :param coords: The coordinates [time, lon, lat, speed]
+        :return: The cluster of every coordinate
+        '''
+        if self.centroids is None:
+            raise ValueError('Fewer points than the {} clusters to make'.format(self.n_clusters))
+        return self._nearest(np.asarray(coords, dtype=np.float64)[:, 1:3])
+
+    def _nearest(self, lon_lat):
+        return cKDTree(self.centroids).query(lon_lat)[1]
+
+    def _cover(self, lon_lat):
+        '''
+        A chunk from a road that no earlier chunk went down is far from
+        every centroid. Give it its share of the centroids, by merging
+        the centroids that are closest together and seeding the freed
+        ones among the far away points
+        '''
+        tree = cKDTree(self.centroids)
+        dist = tree.query(lon_lat)[0]
+
+        # Points further from their centroid than centroids
+        # usually are from each other are not covered
+        spacing, neighbour = tree.query(self.centroids, k=2)
+        spacing, neighbour = spacing[:, 1], neighbour[:, 1]
+        far = lon_lat[dist > np.median(spacing)]
+
+        share = len(far) / (self.counts.sum() + len(lon_lat))
+        num_new = min(int(self.n_clusters * share), len(far), self.n_clusters // 2)
+        if num_new == 0:
+            return
+
+        # Merge the closest pairs into the first of the two,
+        # each centroid is only merged once
+        merged = np.zeros(self.n_clusters, dtype=bool)
+        freed = []
+        for a in np.argsort(spacing, kind='stable'):
+            b = neighbour[a]
+            if len(freed) == num_new:
+                break
+            if merged[a] or merged[b]:
+                continue
+            weights = self.counts[[a, b]] + 1
+            self.centroids[a] = np.average(self.centroids[[a, b]], axis=0, weights=weights)
+            self.counts[a] += self.counts[b]
+            merged[a] = merged[b] = True
+            freed.append(b)
+
+        freed = np.array(freed, dtype=np.intp)
+        self.centroids[freed], _ = kmeans_plusplus(far, len(freed), random_state=0)
+        self.counts[freed] = 0
+
+def k_means(coords, n, incremental=False, centroids_file=None, chunk_size=10000, fit=None):
     '''
     Using K-Means the cluster the coordinates
     :param coords: The coordinates [time, lon, lat, speed]
     :param n: The number of clusters to make
+    :param incremental: Fit chunk_size points at a time with IncrementalKMeans, instead of all at once
+    :param centroids_file: Incremental only, .npz file the centroids are warm started from and saved to
+    :param chunk_size: Incremental only, number of points in every chunk
+    :param fit: Incremental only, the coordinates the saved centroids have not seen yet. None fits
+                all of coords, and so do runs that have no centroids to warm start from
     :return: A list of medoid for each cluster
     '''
-
-    # Extract the Lon, Lat values only for K Means clustering
-    lon_lat_coords = np.array([[coord[1], coord[2]] for coord in coords])
-
-    # Cluster using K-Mean down to n clusters
-    kmeans = KMeans(n_clusters=n)
-    kmeans.fit(lon_lat_coords)
-
-    # Creates a unique set for the cluster points
-    cluster_labels = kmeans.labels_
-    num_clusters = len(set(cluster_labels))
-
-    # Put the points in the respective cluster
-    clusters = pd.Series([coords[cluster_labels == n] for n in range(num_clusters)])
+    coords = np.asarray(coords, dtype=np.float64)
+
+    if incremental:
+        # Carry on from the centroids of the last run, so
+        # only the new points have to be clustered
+        kmeans = IncrementalKMeans(n, centroids_file)
+        if fit is None or kmeans.centroids is None:
+            fit = coords
+        fit = np.asarray(fit, dtype=np.float64).reshape(-1, 4)
+        for start in range(0, len(fit), chunk_size):
+            kmeans.partial_fit(fit[start:start + chunk_size])
+        cluster_labels = kmeans.predict(coords)
+
+        if centroids_file is not None:
+            kmeans.save(centroids_file)
+    else:
+        # Cluster using K-Mean down to n clusters,
+        # on the Lon, Lat values only
+        kmeans = KMeans(n_clusters=n)
+        kmeans.fit(coords[:, 1:3])
+        cluster_labels = kmeans.labels_
+
+    # Clusters that got any point at all
+    num_clusters = np.count_nonzero(np.bincount(cluster_labels, minlength=n))
     print('Number of clusters: {}'.format(num_clusters))
 
-    medoids = get_medoid(clusters)
+    # The points are grouped by cluster with one
+    # sort while the medoids are found
+    medoids = medoids_from_labels(coords, cluster_labels)
 
     #print(medoids.head(10))
 
@@ -203,10 +486,7 @@ def get_bearing(x_lon, x_lat, y_lon, y_lat):
     :param y_lat: latitude of point 2
     :return: The angle in Degree rounded to 2 decimal place
     '''
-    dy = y_lat - x_lat
-    dx = math.cos(math.pi/180*x_lat)*(y_lon - x_lon)
-
-    return round(math.degrees(math.atan2(dy, dx)),2)
+    return float(bearing_array(x_lon, x_lat, y_lon, y_lat))
 
 def find_angle_between_pts(coords, n_space):
     '''
@@ -216,6 +496,10 @@ def find_angle_between_pts(coords, n_space):
     :return:
     '''
 
+    # Bearings for every pair of points n_space apart, all in one go
+    spaced = np.array([coord[:2] for coord in coords[::n_space]], dtype=np.float64).reshape(-1, 2)
+    angles = bearing_consecutive(spaced[:, 0], spaced[:, 1])
+
     for idx in range(n_space, len(coords), n_space):
 
         # Compute the cosine between
@@ -232,7 +516,7 @@ def find_angle_between_pts(coords, n_space):
         y_lat = coords[idx][1]
         y_speed = coords[idx][2]
 
-        angle = get_bearing(x_lon, x_lat, y_lon, y_lat)
+        angle = float(angles[idx // n_space - 1])
         delta_speed = abs(y_speed - x_speed)
 
         # The speed direction tells me whether
@@ -303,59 +587,100 @@ def turn_classifier(coord):
             else:
                 return False
 
-def classify_turn(coords):
-    #unit_vector = lambda vector : vector / np.linalg.norm(vector)
-    #angle_between = lambda v1, v2: np.arccos(np.clip(np.dot(unit_vector(v1), unit_vector(v2)), -1.0, 1.0))
-    coords = coords.values.tolist()
-
-    #Have to fix lat and lon mixup here...
-    for idx in range(len(coords)):
-        lat = coords[idx][1]
-        lon = coords[idx][0]
-        coords[idx][0] = lat
-        coords[idx][1] = lon
+TURN_COLUMNS = ['lon', 'lat', 'speed', 'accel', 'heading', 'delta', 'right']
 
-    angle_between = lambda v1_lat, v1_lon, v2_lat, v2_lon: round(math.degrees(math.atan2(v2_lat - v1_lat, math.cos(math.pi / 180 * v1_lat) * (v2_lon - v1_lon))), 2)
+def classify_turn(coords, plot=False):
+    '''
+    Find the left and right turns along a trace. Everything is
+    computed as whole columns, so this is one linear pass over the trace
+    :param coords: DataFrame with lon, lat and speed columns, in driving order
+    :param plot: Show a scatter plot of the trace and its turns
+    :return: DataFrame of the turns [lon, lat, speed, accel, heading, delta, right]
+    '''
+    lon = coords['lon'].to_numpy(dtype=np.float64)
+    lat = coords['lat'].to_numpy(dtype=np.float64)
+    speed = coords['speed'].to_numpy(dtype=np.float64)
 
     # Get acceleration between this point and last
-    for idx in range(1, len(coords)):
-        if idx == 1: coords[idx][3] = 0; continue
-        coords[idx][3] = coords[idx][2] - coords[idx - 1][2]
-
-    #Get angle between this point and last
-    for idx in range(1, len(coords)):
-        if idx == 1: coords[idx].append(0); continue
-        coords[idx].append(angle_between(coords[idx - 1][0], coords[idx - 1][1], coords[idx][0], coords[idx][1]))
-
-    #Get change (delta) of angle between this point and next
-    #Average with change between the last angle to try to weed out anomalies
-    for idx in range(1, len(coords) -1):
-        if idx == 1 or idx == 2:
-            coords[idx].append(coords[idx][4]); continue
-
-        delta1 = (coords[idx + 1][4] - coords[idx][4])
-        delta2 = (coords[idx + 1][4] - coords[idx - 1][4])
-        #Sometimes these are really weird and anomalous - even when taking the average of two of them
-        #We're just going to completely cut out massive weird numbers
-        if abs(delta1) > 150: delta1 = 0
-        if abs(delta2) > 150: delta2 = 0
-
-        coords[idx].append((delta1 + delta2) / 2)
-
-    #[coord[3] for coord in coords[3:] if abs(coord[5]) > 2 and coord[3] < -1]
-    turns = []
-    for idx in range(1, len(coords) - 1):
-        if abs(coords[idx][5]) > 20 and abs(coords[idx][5]) < 170:
-            turns.append(coords[idx] + [abs(coords[idx][5]) == coords[idx][5]])
-
-    #plt.scatter([coord[0] for coord in coords[1:-1]], [coord[1] for coord in coords[1:-1]],
-    #            c=KMeans(n_clusters=2, random_state=1).fit(np.array(coords[1:-1])).labels_)
-    plt.scatter([coord[0] for coord in coords[1:-1]], [coord[1] for coord in coords[1:-1]], s= 3, c = [coord[3] for coord in coords[1:-1]], alpha=.8 )
-    plt.scatter([coord[0] for coord in turns], [coord[1] for coord in turns], color="r")
-    plt.show()
+    accel = np.zeros(len(speed))
+    accel[1:] = np.diff(speed)
+
+    # Get heading from the last point to this one. Bearings count
+    # counter clockwise, so turning left makes the heading go up
+    heading = np.full(len(lon), np.nan)
+    heading[1:] = bearing_consecutive(lon, lat)
+
+    # Get change (delta) of heading between this point and next
+    # Average with change from the heading before to try to weed out anomalies
+    delta = np.zeros(len(lon))
+    if len(lon) > 3:
+        delta1 = _wrap_angle(heading[3:] - heading[2:-1])
+        delta2 = _wrap_angle(heading[3:] - heading[1:-2])
+
+        # Sometimes these are really weird and anomalous - even when taking the average of two of them
+        # We're just going to completely cut out massive weird numbers
+        delta1[np.abs(delta1) > 150] = 0
+        delta2[np.abs(delta2) > 150] = 0
+
+        delta[2:-1] = (delta1 + delta2) / 2
+
+    is_turn = (np.abs(delta) > 20) & (np.abs(delta) < 170)
+
+    turns = pd.DataFrame({
+        'lon': lon[is_turn],
+        'lat': lat[is_turn],
+        'speed': speed[is_turn],
+        'accel': accel[is_turn],
+        'heading': heading[is_turn],
+        'delta': delta[is_turn],
+        'right': delta[is_turn] < 0
+    }, columns=TURN_COLUMNS)
+
+    if plot:
+        # Only pull in matplotlib when something is drawn, importing it
+        # in every worker of classify_turns_by_trip costs more than the turns
+        import matplotlib.pyplot as plt
+        plt.scatter(lon, lat, s=3, c=accel, alpha=.8)
+        plt.scatter(turns['lon'], turns['lat'], color="r")
+        plt.show()
 
     return turns
 
+def classify_turns_by_trip(dfs, jobs=1):
+    '''
+    Classify the turns of every trip on its own, so no bearing is ever
+    taken across the seam between two unrelated trips. The trips
+    are spread over a pool of processes when jobs is not 1
+    :param dfs: List of DataFrames, one per trip
+    :param jobs: Number of processes to use. None uses every core
+    :return: DataFrame of all the turns, like classify_turn, plus the trip index they belong to
+    '''
+    if jobs == 1 or len(dfs) <= 1:
+        all_turns = []
+        for df in dfs:
+            with PROFILER.stage('classify_turn', rows=len(df)):
+                all_turns.append(classify_turn(df))
+    else:
+        # The time of the workers is only seen as a whole, in this process
+        with PROFILER.stage('classify_turn', rows=sum(len(df) for df in dfs)):
+            with ProcessPoolExecutor(max_workers=jobs) as pool:
+                all_turns = list(pool.map(classify_turn, dfs))
+
+    for trip, turns in enumerate(all_turns):
+        turns.insert(0, 'trip', trip)
+
+    if len(all_turns) == 0:
+        return pd.DataFrame(columns=['trip'] + TURN_COLUMNS)
+
+    return pd.concat(all_turns, ignore_index=True)
+
+def _wrap_angle(angle):
+    '''
+    Bring a change of angle into [-180, 180), so that
+    going from 179 to -179 degrees is a 2 degree turn
+    '''
+    return (angle + 180) % 360 - 180
+
 def main():
     '''
     Test individual functions.
@@ -379,4 +704,5 @@ def main():
 
     print(find_angle_between_pts(coords, 10)[:40])
 
-main()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
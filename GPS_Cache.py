@@ -0,0 +1,300 @@
+"""
+File: On disk cache of parsed GPS traces
+Author: JosephGolden, JenniferLiu
+
+Parsing a raw NMEA log is by far the slowest part of loading it,
+and the logs never change once they are written. The cache keeps the
+DataFrame that load_file returns as one .npz file per trace, with
+one array per column, named after the SHA-1 of the raw file.
+
+The result cache does the same for what is found in every trace, its
+stops and turns, so that a run over a directory only has to work on
+the files that were added or changed since the last run.
+"""
+
+import hashlib
+import json
+import os
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from GPS_Helper import load_file, write_atomic
+
+# Bump this whenever load_file starts returning something different,
+# so that traces parsed by an older version are not reused
+CACHE_VERSION = 1
+
+# Same for the stops and turns found in a trace, bump it whenever
+# DBScan_Stops or classify_turn start finding something different
+RESULTS_VERSION = 2
+
+COLUMNS = ['time', 'lon', 'lat', 'speed']
+
+def file_hash(file):
+    """
+    SHA-1 of the contents of a file
+    :param file: The file to hash
+    :return: hex digest
+    """
+    sha = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha.update(block)
+    return sha.hexdigest()
+
+class TraceCache:
+    """
+    Cache of parsed traces, capped at max_bytes.
+    Once the cap is hit, the least recently used traces are dropped
+    """
+    def __init__(self, cache_dir='.gps_cache', max_bytes=512 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _trace_path(self, digest):
+        return join(self.cache_dir, 'v{}_{}.npz'.format(CACHE_VERSION, digest))
+
+    def _digest(self, file):
+        return file_digest(self.cache_dir, file)
+
+    def load(self, file, engine='numpy', rebuild=False):
+        """
+        Drop in replacement for load_file that goes through the cache
+        :param file: The GPS trace file
+        :param engine: Parser used on a cache miss, see load_file
+        :param rebuild: Parse the file again even if it is cached
+        :return: DataFrame containing the parsed GPS Trace
+        """
+        os.makedirs(join(self.cache_dir, 'keys'), exist_ok=True)
+
+        trace_path = self._trace_path(self._digest(file))
+
+        if not rebuild:
+            try:
+                with np.load(trace_path) as columns:
+                    df = pd.DataFrame({column: columns[column] for column in COLUMNS})
+
+                # Touch the entry, the modification time is what the LRU goes by
+                os.utime(trace_path)
+
+                print('Loading ' + file + " from cache")
+                print('Considering ' + str(len(df)) + " total GPS data points.")
+                return df
+            except (OSError, ValueError, KeyError):
+                # Not cached yet, or a half written entry
+                pass
+
+        df = load_file(file, engine=engine)
+
+        columns = {column: df[column].to_numpy(dtype=np.float64) for column in COLUMNS}
+        write_atomic(trace_path, lambda f: np.savez(f, **columns))
+
+        self.evict()
+        return df
+
+    def evict(self):
+        """
+        Remove the least recently used traces until
+        the cache fits into max_bytes again
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.npz'):
+                continue
+            try:
+                stat = os.stat(join(self.cache_dir, name))
+            except OSError:
+                continue
+            entries.append((stat.st_mtime_ns, stat.st_size, name))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(join(self.cache_dir, name))
+            except OSError:
+                pass
+            total -= size
+
+    def prune_keys(self):
+        """
+        Remove the key files that no entry is left for, see prune_keys.
+        Call it once a whole batch is loaded, a worker that is still
+        loading may just have written a key for a trace that is not in yet
+        """
+        prune_keys(self.cache_dir)
+
+def file_digest(cache_dir, file):
+    """
+    Content hash of a raw file. Rehashing is skipped when the
+    path, size and modification time match what was seen last time
+    :param cache_dir: Cache the key files are kept in
+    :param file: The GPS trace file
+    :return: hex digest
+    """
+    os.makedirs(join(cache_dir, 'keys'), exist_ok=True)
+
+    stat = os.stat(file)
+    key = {'path': os.path.abspath(file), 'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+
+    # Every raw file gets its own small key file, so that
+    # several processes can fill the cache at the same time
+    name = hashlib.sha1(key['path'].encode()).hexdigest()
+    key_path = join(cache_dir, 'keys', name + '.json')
+
+    try:
+        with open(key_path) as f:
+            known = json.load(f)
+        if all(known.get(field) == value for field, value in key.items()):
+            return known['hash']
+    except (OSError, ValueError, KeyError):
+        pass
+
+    key['hash'] = file_hash(file)
+    write_atomic(key_path, json.dumps(key).encode())
+    return key['hash']
+
+class ResultCache:
+    """
+    Stops and turns of every trace, kept next to the trace cache.
+    The manifest lists the files of the last run and the results of
+    each, so a run can tell which files are new, changed or gone
+    """
+    def __init__(self, cache_dir='.gps_cache', params=None):
+        """
+        :param cache_dir: Where the results live
+        :param params: Settings the results depend on, results found with other settings are not reused
+        """
+        self.cache_dir = cache_dir
+        self.results_dir = join(cache_dir, 'results')
+        self.manifest_path = join(self.results_dir, 'manifest.json')
+        self.params = json.dumps(params or {}, sort_keys=True)
+
+        try:
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)
+        except (OSError, ValueError):
+            self.manifest = {}
+        self.seen = {}
+
+        # What the last commit found, files added, changed and removed
+        self.changes = None
+
+    def _result_path(self, digest):
+        # The settings are part of the name, so changing them
+        # never picks up results found with the old ones
+        params = hashlib.sha1(self.params.encode()).hexdigest()[:12]
+        return join(self.results_dir, 'v{}_{}_{}.npz'.format(RESULTS_VERSION, digest, params))
+
+    def get(self, file):
+        """
+        Results of a file, if it has not changed since they were stored
+        :param file: The GPS trace file
+        :return: (stops, turns) or None. stops is an array of [lon, lat, speed, dwell],
+                 turns a DataFrame like classify_turn returns
+        """
+        os.makedirs(self.results_dir, exist_ok=True)
+
+        digest = file_digest(self.cache_dir, file)
+        path = self._result_path(digest)
+        self.seen[os.path.abspath(file)] = {'hash': digest, 'results': os.path.basename(path)}
+
+        try:
+            with np.load(path) as arrays:
+                stops = arrays['stops']
+                turns = pd.DataFrame({column[5:]: arrays[column] for column in arrays.files
+                                      if column.startswith('turn_')})
+                order = json.loads(str(arrays['turn_columns']))
+            return stops, turns[order]
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def put(self, file, stops, turns):
+        """
+        Store the results of a file
+        :param file: The GPS trace file
+        :param stops: Array of [lon, lat, speed, dwell] of every stop
+        :param turns: DataFrame of the turns, like classify_turn returns
+        """
+        os.makedirs(self.results_dir, exist_ok=True)
+
+        digest = file_digest(self.cache_dir, file)
+        path = self._result_path(digest)
+        self.seen[os.path.abspath(file)] = {'hash': digest, 'results': os.path.basename(path)}
+
+        arrays = {'turn_' + column: turns[column].to_numpy() for column in turns.columns}
+        arrays['turn_columns'] = np.array(json.dumps(list(turns.columns)))
+        arrays['stops'] = np.asarray(stops, dtype=np.float64).reshape(-1, 4)
+
+        write_atomic(path, lambda f: np.savez(f, **arrays))
+
+    def commit(self):
+        """
+        Write the manifest of this run, and drop the results
+        no file of the manifest points to any more
+        :return: number of files added, changed and removed since the last run
+        """
+        added = sum(1 for file in self.seen if file not in self.manifest)
+        changed = sum(1 for file, entry in self.seen.items()
+                      if file in self.manifest and self.manifest[file] != entry)
+
+        # Files that were not part of this run are kept in the manifest
+        # while they still exist, another directory may share the cache
+        manifest = {file: entry for file, entry in self.manifest.items()
+                    if file not in self.seen and os.path.exists(file)}
+        removed = sum(1 for file in self.manifest if file not in self.seen and file not in manifest)
+        manifest.update(self.seen)
+
+        os.makedirs(self.results_dir, exist_ok=True)
+        write_atomic(self.manifest_path, json.dumps(manifest, indent=1, sort_keys=True).encode())
+
+        used = {entry['results'] for entry in manifest.values()}
+        for name in os.listdir(self.results_dir):
+            if name.endswith('.npz') and name not in used:
+                try:
+                    os.remove(join(self.results_dir, name))
+                except OSError:
+                    pass
+
+        self.manifest, self.seen = manifest, {}
+        self.changes = (added, changed, removed)
+        prune_keys(self.cache_dir)
+        return added, changed, removed
+
+def prune_keys(cache_dir):
+    """
+    Remove the key files of raw files that are gone, or whose hash
+    has neither a trace nor results cached any more. There is one
+    for every raw file ever loaded, evicting the traces alone
+    would leave them piling up
+    :param cache_dir: Cache the key files are kept in
+    """
+    keys_dir = join(cache_dir, 'keys')
+    results_dir = join(cache_dir, 'results')
+    try:
+        names = os.listdir(keys_dir)
+    except OSError:
+        return
+    entries = os.listdir(cache_dir) + (os.listdir(results_dir) if os.path.isdir(results_dir) else [])
+
+    # Traces are v<version>_<hash>.npz, results v<version>_<hash>_<params>.npz
+    cached = {name[:-4].split('_')[1] for name in entries if name.endswith('.npz') and name.count('_') in (1, 2)}
+
+    for name in names:
+        if not name.endswith('.json'):
+            continue
+        key_path = join(keys_dir, name)
+        try:
+            with open(key_path) as f:
+                key = json.load(f)
+            if key['hash'] in cached and os.path.exists(key['path']):
+                continue
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        try:
+            os.remove(key_path)
+        except OSError:
+            pass
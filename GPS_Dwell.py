@@ -0,0 +1,231 @@
+"""
+File: Stops found in one pass
+Author: JosephGolden, JenniferLiu
+
+DBScan_Stops needs the whole trace in memory before it can find a
+single stop. Here the fixes are looked at one at a time, in the order
+they were driven, and only a few running sums are kept per vehicle.
+
+A dwell window opens at the first slow fix and takes every slow fix
+within radius meters of its centroid. A fix further away closes the
+window and opens the next one. A window of at least min_samples fixes
+is a stop. Windows that follow each other without a break are chained
+into one stop, like DBSCAN chains a queue of cars creeping up to a
+light. The chain ends with a short window or with settle fast fixes in
+a row, and then its stop comes out with its start, end, dwell time and
+medoid. The medoid of a window is the fix closest to its centroid at
+the time the fix came in, and that of a chain is the window medoid
+closest to the centroid of the chain, so it can be a little off the
+medoid of DBScan_Stops.
+
+The old GPS_to_CostMap looked ahead on delta_speed to find where the
+car stopped, this does the same job without looking ahead.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+
+from GPS_Helper import EARTH_RADIUS, clock_seconds
+from GPS_Profile import PROFILER
+
+STOP_COLUMNS = ['time', 'lon', 'lat', 'speed', 'start', 'end', 'dwell', 'points']
+
+# Medoids of the windows of a chain that are kept to pick the medoid
+# of the whole chain from, the ones furthest from its centroid go first
+MAX_CANDIDATES = 16
+
+def dwell_seconds(start, end):
+    """
+    Seconds from start to end
+    :param start: hhmmss.sss time of day, a number or an array of them
+    :param end: hhmmss.sss time of day, same shape as start
+    :return: Seconds, same shape as start
+    """
+    dwell = clock_seconds(end) - clock_seconds(start)
+    # The clock went past midnight during the stop
+    return np.where(dwell < 0, dwell + 86400, dwell)
+
+class _Dwell:
+    """
+    Running sums of the fixes of a dwell window, or of a chain of them
+    """
+    __slots__ = ('n', 'time', 'lon', 'lat', 'speed', 'start', 'end', 'best', 'candidates')
+
+    def __init__(self, fix):
+        self.n = 1
+        self.time, self.lon, self.lat, self.speed = fix
+        self.start = self.end = fix[0]
+        self.best = fix
+        self.candidates = None
+
+    def centroid(self):
+        return self.lon / self.n, self.lat / self.n
+
+    def add(self, fix):
+        self.n += 1
+        self.time += fix[0]
+        self.lon += fix[1]
+        self.lat += fix[2]
+        self.speed += fix[3]
+        self.end = fix[0]
+        self._keep_closest(fix)
+
+    def merge(self, other):
+        """
+        Take in the window that came right after this one. The
+        centroid moves along a queue of cars creeping up to a light,
+        so the medoid of every window is kept to choose from at the end
+        """
+        if self.candidates is None:
+            self.candidates = [self.best]
+        self.n += other.n
+        self.time += other.time
+        self.lon += other.lon
+        self.lat += other.lat
+        self.speed += other.speed
+        self.end = other.end
+
+        self.candidates.append(other.best)
+        if len(self.candidates) > MAX_CANDIDATES:
+            self.candidates.remove(max(self.candidates, key=self._offset))
+
+    def _offset(self, fix):
+        # Distance in degrees from the centroid, like medoids_from_labels
+        lon, lat = self.centroid()
+        return math.hypot(fix[1] - lon, fix[2] - lat)
+
+    def _keep_closest(self, fix):
+        if self._offset(fix) < self._offset(self.best):
+            self.best = fix
+
+    def medoid(self):
+        if self.candidates is None:
+            return self.best
+        return min(self.candidates, key=self._offset)
+
+    def event(self):
+        medoid = self.medoid()
+        return {'type': 'stop', 'time': float(self.start), 'end': float(self.end),
+                'dwell': float(dwell_seconds(self.start, self.end)),
+                'lon': float(medoid[1]), 'lat': float(medoid[2]), 'speed': self.speed / self.n,
+                'points': self.n, 'mean_time': self.time / self.n}
+
+class DwellStops:
+    """
+    Stops of one vehicle, found one fix at a time. Holds two windows
+    of running sums and at most MAX_CANDIDATES medoids, whatever the
+    length of the trip
+    """
+    def __init__(self, radius=10, min_samples=15, max_speed=10, settle=5):
+        """
+        :param radius: Meters a fix may be from the centroid of its window
+        :param min_samples: Number of fixes in a window that make a stop, like DBScan_Stops
+        :param max_speed: Fixes faster than this are never part of a stop
+        :param settle: Fast fixes in a row that end a stop
+        """
+        self.radius = radius
+        self.min_samples = min_samples
+        self.max_speed = max_speed
+        self.settle = settle
+        self.window = None
+        self.chain = None
+        self.fast = 0
+
+    def feed(self, fix):
+        """
+        :param fix: (time, lon, lat, speed)
+        :return: The stop that just ended, if any
+        """
+        if fix[3] > self.max_speed:
+            self.fast += 1
+            if self.fast >= self.settle:
+                return self.flush()
+            return []
+        self.fast = 0
+
+        events = []
+        if self.window is not None and self._distance(fix) > self.radius:
+            events = self._close_window()
+
+        if self.window is None:
+            self.window = _Dwell(fix)
+        else:
+            self.window.add(fix)
+        return events
+
+    def flush(self):
+        """
+        The car drove off or the trace ended, whatever is open is final
+        :return: The stop that ended, if any
+        """
+        events = self._close_window()
+        if self.chain is not None:
+            events.append(self.chain.event())
+            self.chain = None
+        return events
+
+    def _distance(self, fix):
+        # Flat earth is plenty within a few tens of meters, and much
+        # cheaper than the haversine for every fix
+        lon, lat = self.window.centroid()
+        dx = math.radians(fix[1] - lon) * math.cos(math.radians(lat))
+        dy = math.radians(fix[2] - lat)
+        return EARTH_RADIUS * math.hypot(dx, dy)
+
+    def _close_window(self):
+        window, self.window = self.window, None
+        if window is None:
+            return []
+
+        # A stop, it goes on the chain
+        if window.n >= self.min_samples:
+            if self.chain is None:
+                self.chain = window
+            else:
+                self.chain.merge(window)
+            return []
+
+        # Too short to be a stop, it ends the chain
+        events = []
+        if self.chain is not None:
+            events.append(self.chain.event())
+            self.chain = None
+        return events
+
+def dwell_stops(coords, radius=10, min_samples=15, max_speed=10, settle=5):
+    """
+    Find the stops of a trace in one pass, a drop in for DBScan_Stops
+    :param coords: A list of Coordinates [time, lon, lat, speed], in the order they were driven
+    :return: DataFrame of the stops with STOP_COLUMNS, time and speed are the
+             means over the stop like the medoids of DBScan_Stops
+    """
+    detector = DwellStops(radius, min_samples, max_speed, settle)
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 4)
+
+    events = []
+    with PROFILER.stage('dwell_stops', rows=len(coords)):
+        # Most of a trip is driving, and a fast fix only counts towards
+        # settle. So only the slow fixes are fed, and the fix that makes
+        # settle fast ones in a row ends the stop, the same as feeding all
+        fast = coords[:, 3] > max_speed
+        index = np.arange(len(coords))
+        run_start = np.maximum.accumulate(np.where(fast, 0, index + 1))
+        settled = fast & (index - run_start == settle - 1)
+
+        for i in np.flatnonzero(~fast | settled).tolist():
+            if settled[i]:
+                events += detector.flush()
+            else:
+                events += detector.feed(coords[i].tolist())
+        events += detector.flush()
+
+    stops = pd.DataFrame([[event['mean_time'], event['lon'], event['lat'], event['speed'], event['time'],
+                           event['end'], event['dwell'], event['points']] for event in events],
+                         columns=STOP_COLUMNS)
+    print('Number of stops: {} in one pass over {} points'.format(len(stops), len(coords)))
+
+    # Google Earth doesn't like it when
+    # there are duplicated coordinates
+    return stops.drop_duplicates(subset=['lon', 'lat']).reset_index(drop=True)
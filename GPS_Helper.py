@@ -4,13 +4,34 @@ Author: JosephGolden, JenniferLiu
 """
 
 import pandas as pd
-import math
+import numpy as np
+import io
+import mmap
+import os
+from time import perf_counter
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+from itertools import compress
+
+from GPS_Profile import PROFILER
+
+# Radius of Earth in meters
+EARTH_RADIUS = 6371000
+
+# Points remembered when dropping duplicates out of a stream. A car
+# parked for a while repeats its position within seconds, a duplicate
+# further back than this is an earlier visit and is kept
+DEDUP_WINDOW = 100000
 
 class Point:
     """
-    Class to store one single GPS Data point
+    Class to store one single GPS Data point. The fields are
+    slots, so a point holds no __dict__ of its own. The position
+    and speed are rounded to 5 decimals, for output
     """
-    def __init__(self, time, lat, lon, speed, angle):
+    __slots__ = ('time', 'lat', 'lon', 'speed', 'angle')
+
+    def __init__(self, time, lat, lon, speed, angle=None):
         self.time = time
         self.lat = round(lat, 5)
         self.lon = round(lon, 5)
@@ -58,116 +79,638 @@ def haversine(coord1, coord2):
     lon1, lat1 = coord1[0], coord1[1]
     lon2, lat2 = coord2[0], coord2[1]
 
-    R = 6371000  # radius of Earth in meters
-    phi_1 = math.radians(lat1)
-    phi_2 = math.radians(lat2)
+    return float(haversine_array(lon1, lat1, lon2, lat2))
 
-    delta_phi = math.radians(lat2 - lat1)
-    delta_lambda = math.radians(lon2 - lon1)
+def haversine_array(lon1, lat1, lon2, lat2):
+    """
+    Vectorized haversine distance. The arguments can be scalars
+    or arrays of any shape that broadcast together, e.g. a whole
+    trace against one reference point
+    :return: Distance in meters, for every pair of points
+    """
+    R = EARTH_RADIUS
+    phi_1 = np.radians(lat1)
+    phi_2 = np.radians(lat2)
 
-    a = math.sin(delta_phi / 2.0) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(delta_lambda / 2.0) ** 2
+    delta_phi = np.radians(np.subtract(lat2, lat1))
+    delta_lambda = np.radians(np.subtract(lon2, lon1))
 
-    c = 2 * math.atan2(math.sqrt(a), math.sqrt(1 - a))
+    a = np.sin(delta_phi / 2.0) ** 2 + np.cos(phi_1) * np.cos(phi_2) * np.sin(delta_lambda / 2.0) ** 2
 
-    meters = R * c  # output distance in meters
-    km = meters / 1000.0  # output distance in kilometers
-    # km = round(km, 3)
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
 
-    return meters
+    return R * c
 
-def load_file(file):
+def haversine_consecutive(lon, lat):
     """
-    Takes a GPS File and create a Pandas DataFrame
-    :param file: The GPS trace file
-    :return: DataFrame containing the parsed GPS Trace
+    Distance between every point of a trace and the next one
+    :param lon: Array of longitudes
+    :param lat: Array of latitudes
+    :return: Array of n - 1 distances in meters
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    return haversine_array(lon[:-1], lat[:-1], lon[1:], lat[1:])
+
+def bearing_array(x_lon, x_lat, y_lon, y_lat):
+    """
+    Vectorized bearings formula, the angle of the way from
+    point x to point y. Broadcasts like haversine_array
+    :return: The angle in Degree rounded to 2 decimal place
+    """
+    dy = np.subtract(y_lat, x_lat)
+    dx = np.cos(np.pi / 180 * np.asarray(x_lat)) * np.subtract(y_lon, x_lon)
+
+    return _round(np.degrees(np.arctan2(dy, dx)), 2)
+
+def bearing_consecutive(lon, lat):
+    """
+    Bearing from every point of a trace to the next one
+    :param lon: Array of longitudes
+    :param lat: Array of latitudes
+    :return: Array of n - 1 angles in Degree
+    """
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    return bearing_array(lon[:-1], lat[:-1], lon[1:], lat[1:])
+
+def project(lon, lat, lat0=None):
+    """
+    Equirectangular projection to meters, good enough
+    within a city
+    :param lat0: Latitude the projection is true at, the middle of lat if None
+    :return: x, y in meters
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    if lat0 is None:
+        lat0 = np.mean(lat) if len(lat) > 0 else 0
+    x = np.radians(lon) * EARTH_RADIUS * np.cos(np.radians(lat0))
+    y = np.radians(lat) * EARTH_RADIUS
+    return x, y
+
+def clock_seconds(time):
+    """
+    Seconds since midnight of a time of day
+    :param time: hhmmss.sss, a number or an array of them
+    :return: Seconds, same shape as time
+    """
+    hours, rest = np.divmod(time, 10000)
+    minutes, seconds = np.divmod(rest, 100)
+    return hours * 3600 + minutes * 60 + seconds
+
+class _ParseState:
+    """
+    Everything the parsers carry from one line to the next,
+    so that a trace can be parsed one block at a time
+    """
+    def __init__(self):
+        # Entries kept so far. A failing GPGGA can still pop the last one
+        self.entry = {'time': [], 'lon': [], 'lat': [], 'speed': []}
+
+        # The last slow point that was kept, used to suppress stops
+        self.prev_entry = None
+
+        # Set by a garbage GPRMC, the next line is ignored
+        self.bad = False
+
+        self.skipCount = 0
+
+def _to_numbers(fields, cast):
+    """
+    Converts an array of fields into numbers in bulk
+    :param fields: Array of the raw fields, as bytes
+    :param cast: float or int, applied exactly like the line by line parser does
+    :return: The converted values, and a mask of which fields converted successfully
+    """
+    dtype = np.float64 if cast is float else np.int64
+
+    # Fast path, every field is a well formed number. Dropouts leave
+    # empty fields, a log with any of them goes straight to the masks
+    if not np.any(fields == b''):
+        try:
+            return fields.astype(dtype), np.ones(len(fields), dtype=bool)
+        except (ValueError, OverflowError):
+            pass
+
+    # Some field is garbage. Sort the fields by their bytes first: plain
+    # numbers convert in bulk, empty fields fail, and only what is left
+    # is converted one by one
+    fields = np.ascontiguousarray(fields)
+    lengths = np.char.str_len(fields)
+    chars = fields.view(np.uint8).reshape(len(fields), -1)
+    inside = np.arange(chars.shape[1]) < lengths[:, None]
+
+    digit = (chars >= ord('0')) & (chars <= ord('9'))
+    allowed = digit.copy()
+    allowed[:, 0] |= (chars[:, 0] == ord('-')) | (chars[:, 0] == ord('+'))
+    if cast is float:
+        dot = chars == ord('.')
+        allowed |= dot
+        plain = np.count_nonzero(dot & inside, axis=1) <= 1
+    else:
+        # Too many digits could overflow an int64
+        plain = lengths <= 18
+    plain &= np.all(allowed | ~inside, axis=1) & np.any(digit & inside, axis=1)
+
+    values = np.zeros(len(fields), dtype=dtype)
+    values[plain] = fields[plain].astype(dtype)
+    ok = plain.copy()
+
+    # Whatever the mask can not tell, e.g. 1e5 or spaces, goes the slow way
+    for idx in np.flatnonzero(~plain & (lengths > 0)):
+        try:
+            values[idx] = cast(fields[idx])
+            ok[idx] = True
+        except (ValueError, OverflowError):
+            pass
+
+    return values, ok
+
+def _round(values, ndigits):
+    """
+    Rounds an array the same way Python's round does.
+    np.round can disagree with round on values that sit
+    exactly on a tie, so those few are redone one by one
+    :param values: Array of floats
+    :param ndigits: Number of decimal places to keep
+    :return: The rounded array
+    """
+    values = np.asarray(values, dtype=np.float64)
+    rounded = np.round(values, ndigits, out=np.empty_like(values))
+    scaled = values * 10 ** ndigits
+    ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    for idx in ties:
+        rounded.flat[idx] = round(float(values.flat[idx]), ndigits)
+
+    return rounded
+
+def _gather(buf, starts, ends):
+    """
+    Cut a slice out of the buffer for every (start, end) pair
+    :param buf: The file contents as a uint8 array
+    :param starts: Array of slice starts
+    :param ends: Array of slice ends (exclusive)
+    :return: Fixed width bytes array with one entry per slice
+    """
+    lengths = np.maximum(ends - starts, 0)
+    width = max(int(lengths.max()) if len(lengths) > 0 else 0, 1)
+
+    if len(buf) < width:
+        buf = np.concatenate([buf, np.zeros(width, dtype=np.uint8)])
+
+    # Take a width wide window at every start, and blank out whatever
+    # runs past the end. numpy strips trailing zeros from fixed width
+    # bytes so the short slices come out unchanged
+    windows = np.lib.stride_tricks.sliding_window_view(buf, width)
+    last = len(windows) - 1
+    chars = windows[np.minimum(starts, last)]
+
+    # The windows stop short of the end of the buffer, so the
+    # few slices right at the end come from a zero padded copy
+    tail = np.flatnonzero(starts > last)
+    if len(tail) > 0:
+        padded = np.concatenate([buf[last:], np.zeros(width, dtype=np.uint8)])
+        chars[tail] = np.lib.stride_tricks.sliding_window_view(padded, width)[starts[tail] - last]
+
+    chars[np.arange(width) >= lengths[:, None]] = 0
+
+    return chars.view('S' + str(width)).ravel()
+
+def _dms_to_dd(buf, starts, ends):
+    """
+    Vectorized version of dms_to_dd
+    :param buf: The file contents as a uint8 array
+    :param starts: Array of field starts
+    :param ends: Array of field ends (exclusive)
+    :return: Array of decimal degrees, and a mask of which fields converted successfully
     """
-    entry = {'time': [], 'lon': [], 'lat': [], 'speed': []}
+    # A leading 0 means we are in the western hemisphere
+    negative = (ends > starts) & (buf[np.minimum(starts, len(buf) - 1)] == ord('0'))
+    starts = starts + negative
+
+    split = np.minimum(starts + 2, ends)
+    degrees, deg_ok = _to_numbers(_gather(buf, starts, split), float)
+    minutes, min_ok = _to_numbers(_gather(buf, split, ends), float)
+    dd = degrees + (minutes / 60)
+
+    return np.where(negative, -dd, dd), deg_ok & min_ok
+
+def _stop_mask(lon, lat, speed, prev_entry=None):
+    """
+    Vectorized version of the stop suppression in load_file.
+    A slow point is a stop if it is within 10 meters of the last
+    slow point that was kept, so we jump from kept point to kept point
+    and test a whole window of the following slow points at once
+    :param prev_entry: The last kept slow point before these ones, if any
+    :return: Mask of the points that are suppressed as stops
+    """
+    if prev_entry is not None:
+        # Treat the carried over point as the first slow point
+        lon = np.concatenate([[prev_entry['lon']], lon])
+        lat = np.concatenate([[prev_entry['lat']], lat])
+        speed = np.concatenate([[prev_entry['speed']], speed])
+        return _stop_mask(lon, lat, speed)[1:]
+
+    stop = np.zeros(len(speed), dtype=bool)
+    slow = np.flatnonzero(speed <= 0.5)
+
+    k = 0
+    while k < len(slow):
+        anchor = slow[k]
+        start = k + 1
+        window = 8
+        k = len(slow)
+
+        while start < len(slow):
+            candidates = slow[start:start + window]
+            near = _haversine_within(lon[candidates], lat[candidates], lon[anchor], lat[anchor], 10)
+            far = np.flatnonzero(~near)
+
+            if len(far) > 0:
+                # The first point that moved away becomes the next kept point
+                stop[candidates[:far[0]]] = True
+                k = start + far[0]
+                break
+
+            stop[candidates] = True
+            start += window
+            window *= 2
+
+    return stop
+
+def _haversine_within(lons, lats, lon, lat, meters):
+    """
+    Check which points are within a distance of (lon, lat),
+    agreeing exactly with the scalar haversine
+    """
+    dist = haversine_array(lons, lats, lon, lat)
+
+    # numpy can take a different code path for a whole array than
+    # for one number, so settle the borderline distances one by one
+    within = dist <= meters
+    for idx in np.flatnonzero(np.abs(dist - meters) < 1e-6):
+        within[idx] = haversine((lons[idx], lats[idx]), (lon, lat)) <= meters
+
+    return within
+
+class _Sentences:
+    """
+    Byte offsets of the comma separated fields of a
+    set of sentences, all held in one buffer
+    """
+    def __init__(self, buf, commas, starts, ends, first, num):
+        self.buf = buf
+        self.commas = commas
+        self.starts = starts
+        self.ends = ends
+
+        # Index of the first comma of each sentence, and how many fields it has
+        self.first = first
+        self.num = num
+        self._bounds = {}
+
+    def bounds(self, field):
+        """
+        :param field: Index of the field, like split(",")[field]
+        :return: start and end offsets of the field, empty where the sentence is too short
+        """
+        if field not in self._bounds:
+            present = self.num > field
+            last = len(self.commas) - 1
+            if field == 0:
+                start = self.starts
+            else:
+                start = self.commas[np.minimum(self.first + field - 1, last)] + 1
+            end = np.where(self.num > field + 1, self.commas[np.minimum(self.first + field, last)], self.ends)
+
+            self._bounds[field] = (np.where(present, start, self.ends), np.where(present, end, self.ends))
+
+        return self._bounds[field]
+
+    def field(self, field):
+        """
+        :param field: Index of the field, like split(",")[field]
+        :return: Fixed width bytes array of the field in every sentence
+        """
+        start, end = self.bounds(field)
+        return _gather(self.buf, start, end)
+
+    def equals(self, field, value):
+        """
+        :return: Mask of the sentences where split(",")[field] == value
+        """
+        start, end = self.bounds(field)
+        same = (end - start == len(value))
+        if len(value) > 0:
+            same &= self.field(field) == value
+        return (self.num > field) & same
+
+def _parse_numpy(data, state):
+    """
+    Vectorized parser. Takes a block of the file in bulk, converts the
+    fields and applies the stop and quality filters as whole arrays.
+    Produces exactly the same entries as _parse_python
+    :param data: Whole lines of the GPS trace, any bytes like object. It is only read, never copied
+    :param state: _ParseState carried over from the previous lines, updated in place
+    """
+    raw = np.frombuffer(data, dtype=np.uint8)
+
+    # The field slicing below counts bytes, not characters
+    if len(raw) > 0 and raw.max() > 127:
+        _parse_python(io.StringIO(raw.tobytes().decode(), newline=None), state)
+        return
+
+    # Same newline handling as reading the file in text mode
+    if (raw == ord('\r')).any():
+        raw = np.frombuffer(raw.tobytes().replace(b'\r\n', b'\n').replace(b'\r', b'\n'), dtype=np.uint8)
+
+    # Every line keeps its newline, the loop parser sees it
+    # as part of the last field
+    newlines = np.flatnonzero(raw == ord('\n'))
+    starts = np.concatenate([[0], newlines + 1])
+    ends = np.concatenate([newlines + 1, [len(raw)]])
+    if starts[-1] == len(raw):
+        starts, ends = starts[:-1], ends[:-1]
+
+    buf = raw
+
+    # Compare the first 6 bytes of each line to the sentence type
+    head = _gather(buf, starts, np.minimum(starts + 6, ends))
+    is_rmc = head == b'$GPRMC'
+    is_gga = head == b'$GPGGA'
+
+    commas = np.flatnonzero(raw == ord(','))
+    if len(commas) == 0:
+        commas = np.array([len(raw)])
+
+    first = np.searchsorted(commas, starts)
+    num = np.searchsorted(commas, ends) - first + 1
+
+    rmc_idx = np.flatnonzero(is_rmc)
+    gga_idx = np.flatnonzero(is_gga)
+
+    # $GPRMC,183410.001,A,4305.1494,N,07740.8738,W,0.02,342.94,030319,,,A*7A
+    rmc = _Sentences(buf, commas, starts[is_rmc], ends[is_rmc], first[is_rmc], num[is_rmc])
+
+    # Replay the order in which the loop checks the fields, a missing
+    # field raises an IndexError which skips the line altogether
+    rmc_bad = np.zeros(len(rmc_idx), dtype=bool)
+    pending = np.ones(len(rmc_idx), dtype=bool)
+    for field, value in ((3, b''), (5, b''), (7, b'$PGACK')):
+        pending &= rmc.num > field
+        hit = pending & rmc.equals(field, value)
+        rmc_bad |= hit
+        pending &= ~hit
+
+    time, time_ok = _to_numbers(rmc.field(1), float)
+    lat, lat_ok = _dms_to_dd(buf, *rmc.bounds(3))
+    lon, lon_ok = _dms_to_dd(buf, *rmc.bounds(5))
+    speed, speed_ok = _to_numbers(rmc.field(7), float)
+    rmc_ok = pending & time_ok & lat_ok & lon_ok & speed_ok
+
+    rmc_idx_ok = rmc_idx[rmc_ok]
+    time, lat, lon = time[rmc_ok], lat[rmc_ok], lon[rmc_ok]
+    speed = _round(speed[rmc_ok] * 1.151, 3)
+
+    keep = ~_stop_mask(lon, lat, speed, state.prev_entry)
+
+    kept_slow = np.flatnonzero(keep & (speed <= 0.5))
+    if len(kept_slow) > 0:
+        last = kept_slow[-1]
+        state.prev_entry = {'time': float(time[last]), 'lon': float(lon[last]),
+                            'lat': float(lat[last]), 'speed': float(speed[last])}
+
+    # A GPGGA line is ignored, and instead clears the flag, when an
+    # RMC line set the flag after the last non RMC line cleared it
+    flags = np.full(len(starts) + 1, np.nan)
+    flags[0] = state.bad
+    flags[1:][~is_rmc] = 0
+    flags[1:][rmc_idx[rmc_bad]] = 1
+    flags = pd.Series(flags).ffill().to_numpy() == 1
+    bad = flags[:-1]
+    state.bad = bool(flags[-1])
+
+    # $GPGGA,183410.200,4305.1494,N,07740.8738,W,1,08,1.03,154.2,M,-34.4,M,,*5F
+    gga = _Sentences(buf, commas, starts[is_gga], ends[is_gga], first[is_gga], num[is_gga])
+    gga_ok = ~bad[gga_idx]
+    for field in (8, 9):
+        gga_ok &= gga.num > field
+        gga_ok &= ~gga.equals(field, b'')
+
+    sats, sats_ok = _to_numbers(gga.field(7), int)
+    dil, dil_ok = _to_numbers(gga.field(8), float)
+    alt, alt_ok = _to_numbers(gga.field(9), float)
+    gga_ok &= sats_ok & dil_ok & alt_ok
+
+    dil = _round(dil, 4)
+    alt = _round(alt, 1)
+    drop = gga_ok & ((alt < 100) | (dil > 9) | (sats < 3))
+
+    # Every kept RMC pushes an entry, and every failing GGA pops
+    # the most recent one. Popping an empty list does nothing.
+    # The entries still held from earlier lines were pushed before line 0
+    held = len(state.entry['time'])
+    push_idx = np.concatenate([np.full(held, -1), rmc_idx_ok[keep]])
+    pop_idx = gga_idx[drop]
+    order = np.argsort(np.concatenate([push_idx, pop_idx]), kind='stable')
+    steps = np.concatenate([np.ones(len(push_idx), dtype=np.int64),
+                            -np.ones(len(pop_idx), dtype=np.int64)])[order]
+
+    # Depth of the clamped stack after every event
+    walk = np.cumsum(steps)
+    depth = walk - np.minimum(np.minimum.accumulate(walk), 0)
+    popped = (steps == -1) & (np.concatenate([[0], depth])[:-1] > 0)
+
+    # A pushed entry survives if the stack never drops below it later on
+    after = np.minimum.accumulate(np.concatenate([depth[::-1], [np.iinfo(np.int64).max]]))[::-1][1:]
+    survives = (steps == 1) & (after >= depth)
+    survives = survives[np.argsort(order, kind='stable')][:len(push_idx)]
+
+    pushed = {'time': time, 'lon': lon, 'lat': lat, 'speed': speed}
+    state.entry = {key: np.concatenate([np.asarray(value, dtype=np.float64), pushed[key][keep]])[survives]
+                   for key, value in state.entry.items()}
+
+    state.skipCount += int(rmc_bad.sum() + popped.sum())
+
+def _parse_python(lines, state):
+    """
+    Original line by line parser
+    :param lines: The lines of the GPS trace, as read from a text file
+    :param state: _ParseState carried over from the previous lines, updated in place
+    """
+    entry = {key: list(value) for key, value in state.entry.items()}
 
     stops = {'time': [], 'lon': [], 'lat': [], 'speed': []}
 
     # Keeps a record of 1 previous entry
     # Initially, it is None
-    prev_entry = None
+    prev_entry = state.prev_entry
+
+    bad = state.bad
+    skipCount = 0
+    for line in lines:
+        # $GPRMC,183410.001,A,4305.1494,N,07740.8738,W,0.02,342.94,030319,,,A*7A
+        # $GPGGA,183410.200,4305.1494,N,07740.8738,W,1,08,1.03,154.2,M,-34.4,M,,*5F
+        # lng=-77.681236, lat=43.085823, altitude=154.20, speed=0.02, satellites=8, angle=342.9400, fixquality=1
+        split = line.split(",")
+
+        try:
+            if line.startswith('$GPRMC'):
+                # Skip garbage GPS entries
+                if split[3] == '' or split[5] == '' or split[7] == '$PGACK':
+                    bad = True
+                    skipCount += 1
+                    continue
+
+                time = float(split[1])
+                lat = dms_to_dd(split[3])
+                lon = dms_to_dd(split[5])
+                speed = round(float(split[7]) * 1.151,3)
+
+                # If the speed is slower than a certain threshold,
+                # we might have to do some agglomeration
+                # We ignore this stop point
+                # The speed is still rather slow and the time
+                # hasn't changed much and the distance between
+                # previous point and current point is smaller than 10 m
+
+                if speed <= 0.5:
+                    if prev_entry is None:
+                        prev_entry = {'time': time, 'lon': lon, 'lat': lat, 'speed': speed}
+                        #print({'time': time, 'lon': lon, 'lat': lat, 'speed': speed})
+                        #print()
+                    elif haversine((lon, lat), (prev_entry['lon'], prev_entry['lat'])) <= 10:
+                        stops['time'].append(time)
+                        stops['lat'].append(lat)
+                        stops['lon'].append(lon)
+                        stops['speed'].append(speed)
+                        #print("Found a stop")
+                        #print({'time': time, 'lon': lon, 'lat': lat, 'speed': speed})
+                        #print()
+                        continue
+                    else:
+                        prev_entry = {'time': time, 'lon': lon, 'lat': lat, 'speed': speed}
+
+                
+                entry['time'].append(time)
+                entry['lat'].append(lat)
+                entry['lon'].append(lon)
+                entry['speed'].append(speed)
+
+
+            elif not bad and line.startswith("$GPGGA"):
+                # Do not add point, if the essential
+                # data are empty
+                if split[8] == '' or split[9] == '':
+                    continue
+
+                sats = int(split[7])
+                dil = round(float(split[8]), 4)
+                alt = round(float(split[9]), 1)
+
+                # Check for Dilution of Precision
+                # If not satisified, pop it off the list
+                if alt < 100 or dil > 9 or sats < 3:
+                    entry['time'].pop()
+                    entry['lat'].pop()
+                    entry['lon'].pop()
+                    entry['speed'].pop()
+                    skipCount += 1
+            elif bad:
+                bad = False
+
+        except IndexError as ie:
+            print(ie, split)
+        except ValueError as ve:
+            print(ve, split)
+
+    state.entry = entry
+    state.prev_entry = prev_entry
+    state.bad = bad
+    state.skipCount += skipCount
+
+def _map_file(file):
+    """
+    Memory map a file for reading, so the parser works straight
+    off the page cache instead of a copy of the whole file
+    :return: mmap of the file, or empty bytes for an empty file
+    """
+    with open(file, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
 
+def _parse_file(file, engine, state, block_size=1 << 23):
+    """
+    Parse a GPS file one block of whole lines at a time.
+    Kept entries are handed out as soon as no GPGGA further down can
+    pop them anymore, everything else stays in state.entry
+    :param file: The GPS trace file
+    :param engine: 'numpy' for the vectorized parser, 'python' for the original line by line parser
+    :param state: _ParseState, updated in place
+    :param block_size: Number of bytes parsed at a time
+    :return: Generator of dicts of column arrays, in file order
+    """
+    data = _map_file(file)
+    view = memoryview(data)
+
+    # The map is closed as soon as the generator is done with it, also
+    # when it is dropped halfway or the parser raises, rather than
+    # whenever it is garbage collected
+    try:
+        start = 0
+        while start < len(data):
+            # Cut the block after the last newline in it
+            end = start + block_size
+            if end >= len(data):
+                end = len(data)
+            else:
+                cut = data.rfind(b'\n', start, end)
+                if cut < 0:
+                    cut = data.find(b'\n', end)
+                end = len(data) if cut < 0 else cut + 1
+
+            with view[start:end] as block:
+                if engine == 'numpy':
+                    _parse_numpy(block, state)
+                else:
+                    _parse_python(io.StringIO(bytes(block).decode(), newline=None), state)
+            start = end
+
+            # Every GPGGA that pops is at least 16 bytes long, so the next
+            # block can not pop more entries than that
+            reserve = min(block_size, len(data) - start) // 16 + 1
+            release = len(state.entry['time']) - reserve
+            if release > 0:
+                yield {key: np.asarray(value[:release], dtype=np.float64) for key, value in state.entry.items()}
+                state.entry = {key: value[release:] for key, value in state.entry.items()}
+    finally:
+        view.release()
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+def load_file(file, engine='numpy'):
+    """
+    Takes a GPS File and create a Pandas DataFrame
+    :param file: The GPS trace file
+    :param engine: 'numpy' for the vectorized parser, 'python' for the original line by line parser
+    :return: DataFrame containing the parsed GPS Trace
+    """
     print('Loading ' + file + "")
-    with open(file) as f:
-        bad = False
-        skipCount = 0
-        for line in f:
-            # $GPRMC,183410.001,A,4305.1494,N,07740.8738,W,0.02,342.94,030319,,,A*7A
-            # $GPGGA,183410.200,4305.1494,N,07740.8738,W,1,08,1.03,154.2,M,-34.4,M,,*5F
-            # lng=-77.681236, lat=43.085823, altitude=154.20, speed=0.02, satellites=8, angle=342.9400, fixquality=1
-            split = line.split(",")
-
-            try:
-                if line.startswith('$GPRMC'):
-                    # Skip garbage GPS entries
-                    if split[3] == '' or split[5] == '' or split[7] == '$PGACK':
-                        bad = True
-                        skipCount += 1
-                        continue
 
-                    time = float(split[1])
-                    lat = dms_to_dd(split[3])
-                    lon = dms_to_dd(split[5])
-                    speed = round(float(split[7]) * 1.151,3)
-
-                    # If the speed is slower than a certain threshold,
-                    # we might have to do some agglomeration
-                    # We ignore this stop point
-                    # The speed is still rather slow and the time
-                    # hasn't changed much and the distance between
-                    # previous point and current point is smaller than 10 m
-
-                    if speed <= 0.5:
-                        if prev_entry is None:
-                            prev_entry = {'time': time, 'lon': lon, 'lat': lat, 'speed': speed}
-                            #print({'time': time, 'lon': lon, 'lat': lat, 'speed': speed})
-                            #print()
-                        elif haversine((lon, lat), (prev_entry['lon'], prev_entry['lat'])) <= 10:
-                            stops['time'].append(time)
-                            stops['lat'].append(lat)
-                            stops['lon'].append(lon)
-                            stops['speed'].append(speed)
-                            #print("Found a stop")
-                            #print({'time': time, 'lon': lon, 'lat': lat, 'speed': speed})
-                            #print()
-                            continue
-                        else:
-                            prev_entry = {'time': time, 'lon': lon, 'lat': lat, 'speed': speed}
-
-                    
-                    entry['time'].append(time)
-                    entry['lat'].append(lat)
-                    entry['lon'].append(lon)
-                    entry['speed'].append(speed)
-
-
-                elif not bad and line.startswith("$GPGGA"):
-                    # Do not add point, if the essential
-                    # data are empty
-                    if split[8] == '' or split[9] == '':
-                        continue
+    state = _ParseState()
+    if engine == 'numpy':
+        parts = list(_parse_file(file, engine, state))
+        entry = {key: np.concatenate([part[key] for part in parts] + [state.entry[key]])
+                 for key in state.entry}
+    elif engine == 'python':
+        with open(file) as f:
+            _parse_python(f, state)
+        entry = state.entry
+    else:
+        raise ValueError('Unknown engine ' + str(engine))
 
-                    sats = int(split[7])
-                    dil = round(float(split[8]), 4)
-                    alt = round(float(split[9]), 1)
-
-                    # Check for Dilution of Precision
-                    # If not satisified, pop it off the list
-                    if alt < 100 or dil > 9 or sats < 3:
-                        entry['time'].pop()
-                        entry['lat'].pop()
-                        entry['lon'].pop()
-                        entry['speed'].pop()
-                        skipCount += 1
-                elif bad:
-                    bad = False
-
-            except IndexError as ie:
-                print(ie, split)
-            except ValueError as ve:
-                print(ve, split)
+    skipCount = state.skipCount
 
     df = None
     try:
@@ -191,3 +734,163 @@ def load_file(file):
 
 
 
+def load_chunks(file, chunk_size=10000, engine='numpy', dedup_window=DEDUP_WINDOW, block_size=1 << 20):
+    """
+    Streaming version of load_file. Parses the GPS file one block at a
+    time and yields DataFrames of chunk_size cleaned points, so memory
+    depends on chunk_size, block_size and dedup_window instead of the
+    trace length. Stop suppression and the GPGGA pop back carry over
+    from block to block. Duplicates are only dropped within the last
+    dedup_window points, so a position repeated further apart than that
+    is kept where load_file drops it
+    :param file: The GPS trace file
+    :param chunk_size: Number of points in every chunk but the last
+    :param engine: 'numpy' for the vectorized parser, 'python' for the original line by line parser
+    :param dedup_window: Only remember this many points when dropping duplicates. None remembers
+                         all of them, the same as load_file, but memory then grows with every new point
+    :param block_size: Number of bytes parsed at a time
+    :return: Generator of DataFrames with the same columns as load_file
+    """
+    if engine not in ('numpy', 'python'):
+        raise ValueError('Unknown engine ' + str(engine))
+
+    print('Loading ' + file + "")
+
+    state = _ParseState()
+
+    # Coordinates already handed out, oldest first
+    seen = set()
+    seen_order = deque()
+
+    ready = []
+    num_ready = 0
+    num_kept = 0
+    num_emitted = 0
+
+    parts = _parse_file(file, engine, state, block_size)
+    done = False
+    while not done:
+        points = next(parts, None)
+        if points is None:
+            # Whatever is still held back is final now
+            done = True
+            points = state.entry
+
+        points = pd.DataFrame({key: np.asarray(value, dtype=np.float64) for key, value in points.items()})
+        num_kept += len(points)
+
+        points = points[~points.duplicated(subset=['lat', 'lon'])]
+        keys = list(zip(points['lat'], points['lon']))
+        new = np.fromiter((key not in seen for key in keys), dtype=bool, count=len(keys))
+        points = points[new]
+
+        for key in compress(keys, new):
+            seen.add(key)
+            seen_order.append(key)
+        while dedup_window is not None and len(seen_order) > dedup_window:
+            seen.discard(seen_order.popleft())
+
+        ready.append(points)
+        num_ready += len(points)
+
+        # Hand out every full chunk, and whatever is left at the end
+        while num_ready >= chunk_size or (done and num_ready > 0):
+            points = pd.concat(ready, ignore_index=True)
+            chunk, rest = points[:chunk_size], points[chunk_size:]
+            ready, num_ready = [rest], len(rest)
+
+            chunk.index = pd.RangeIndex(num_emitted, num_emitted + len(chunk))
+            num_emitted += len(chunk)
+            yield chunk
+
+    print('Loaded ' + str(num_kept + state.skipCount) + " total GPS data points.")
+    print('Dropped ' + str(state.skipCount) + " anomalous GPS data points.")
+    print('Dropped Duplicate Points.')
+    print('Considering ' + str(num_emitted) + " total GPS data points.")
+
+def _timed_load(file, engine, cache=None, rebuild_cache=False, profile=False):
+    """
+    Load one file, catching any error so that one bad
+    file does not take the rest of the batch down with it
+    :param profile: Record the load for the profiler. A spawned worker
+                    process starts with its own profiler, which is off
+    :return: (DataFrame or None, seconds taken, error message or None, profile record)
+    """
+    if profile:
+        PROFILER.enable()
+    start = perf_counter()
+    # This can run in a worker process, so the record goes back with the result
+    with PROFILER.stage('load_file', file=file, keep=False) as record:
+        try:
+            if cache is None:
+                df = load_file(file, engine=engine)
+            else:
+                df = cache.load(file, engine=engine, rebuild=rebuild_cache)
+            record['rows'] = len(df)
+            error = None
+        except Exception as e:
+            df, error = None, type(e).__name__ + ': ' + str(e)
+    return df, perf_counter() - start, error, record
+
+def load_files(files, engine='numpy', jobs=1, cache=None, rebuild_cache=False):
+    """
+    Load several GPS files, optionally spreading them over a pool of processes.
+    The files are always loaded and returned in sorted order, so
+    the output does not depend on which process finishes first
+    :param files: List of GPS trace files
+    :param engine: 'numpy' for the vectorized parser, 'python' for the original line by line parser
+    :param jobs: Number of processes to use. None uses every core
+    :param cache: GPS_Cache.TraceCache to load the files through, None parses every file
+    :param rebuild_cache: Parse every file again and overwrite what is cached
+    :return: List of DataFrames, and the list of files that loaded successfully
+    """
+    files = sorted(files)
+
+    if jobs == 1 or len(files) <= 1:
+        results = [_timed_load(file, engine, cache, rebuild_cache, PROFILER.enabled) for file in files]
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            results = list(pool.map(_timed_load, files, [engine] * len(files), [cache] * len(files),
+                                    [rebuild_cache] * len(files), [PROFILER.enabled] * len(files)))
+
+    # Every process is done, key files no trace is left for can go
+    if cache is not None:
+        cache.prune_keys()
+
+    dfs = []
+    loaded = []
+
+    print('File timings:')
+    for file, (df, seconds, error, record) in zip(files, results):
+        PROFILER.add(record)
+        if error is None:
+            print('  {}: {} points in {:.3f}s'.format(file, len(df), seconds))
+            dfs.append(df)
+            loaded.append(file)
+        else:
+            print('  {}: FAILED after {:.3f}s ({})'.format(file, seconds, error))
+
+    print('Loaded ' + str(len(loaded)) + ' of ' + str(len(files)) + ' files.')
+    return dfs, loaded
+
+def write_atomic(path, data):
+    """
+    Write a whole file at once, readers never see half of it
+    :param path: The file to write
+    :param data: bytes, or a function that writes the file to the open file it is given
+    """
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            if callable(data):
+                data(f)
+            else:
+                f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        # Nothing half written is left lying around
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
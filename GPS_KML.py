@@ -0,0 +1,390 @@
+"""
+File: Streaming KML writer
+Author: JosephGolden, JenniferLiu
+
+Writes a KML document straight to the file as the placemarks are
+made, like FileHandler in Old_GPS_to_KML.py used to, instead of
+building the whole document in memory with simplekml first. Every
+style is written once in the header and the placemarks refer to it
+with a styleUrl, so a placemark is only a few lines long.
+
+The document can also be zipped into a .kmz, and TiledKMLWriter
+splits the placemarks into tiles that are only loaded once they
+are on screen and big enough to see.
+"""
+
+import io
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+# KML colors are aabbggrr
+YELLOW = 'ff00ffff'
+RED = 'ff0000ff'
+
+def style_xml(style_id, label_color=None, label_scale=None, line_color=None, line_width=None):
+    """
+    A shared style, placemarks use it with styleUrl #style_id
+    :return: The <Style> element
+    """
+    xml = ["<Style id='{}'>\n".format(style_id)]
+    if label_color is not None or label_scale is not None:
+        xml.append("<LabelStyle>\n")
+        if label_color is not None:
+            xml.append(" <color>{}</color>\n".format(label_color))
+        if label_scale is not None:
+            xml.append(" <scale>{}</scale>\n".format(label_scale))
+        xml.append("</LabelStyle>\n")
+    if line_color is not None or line_width is not None:
+        xml.append("<LineStyle>\n")
+        if line_color is not None:
+            xml.append(" <color>{}</color>\n".format(line_color))
+        if line_width is not None:
+            xml.append(" <width>{}</width>\n".format(line_width))
+        xml.append("</LineStyle>\n")
+    xml.append("</Style>\n")
+    return ''.join(xml)
+
+HEADER = ("<?xml version='1.0' encoding='UTF-8'?>\n"
+          "<kml xmlns='http://www.opengis.net/kml/2.2'>\n"
+          "<Document>\n")
+FOOTER = "</Document>\n</kml>\n"
+
+# Size in pixels a tile has to take up on screen before its
+# placemarks are loaded. Routes show up first, the many
+# stops and turns only once zoomed in
+MIN_LOD_PIXELS = {'route': 128, 'cluster': 256, 'stop': 384, 'turn': 512}
+
+def points_xml(names, coords, style, description=None):
+    """
+    :param names: Name of every point, or one name for all of them
+    :param coords: (lon, lat, altitude) of every point
+    :param style: Id of the style to use
+    :param description: Description of every point, or one for all of them
+    :return: The point placemarks
+    """
+    if isinstance(names, str):
+        names = [names] * len(coords)
+    if description is None or isinstance(description, str):
+        description = [description] * len(coords)
+
+    return ''.join([
+        "<Placemark><name>{}</name>{}<styleUrl>#{}</styleUrl>"
+        "<Point><coordinates>{},{},{}</coordinates></Point></Placemark>\n".format(
+            escape(str(name)), _description(desc), style, *coord)
+        for name, desc, coord in zip(names, description, coords)])
+
+def line_xml(name, coords, style, description=None):
+    """
+    A LineString placemark, extruded down to the ground
+    :param coords: (lon, lat, altitude) of every point of the line
+    :param style: Id of the style to use
+    :return: The placemark
+    """
+    return ''.join(["<Placemark><name>{}</name>{}<styleUrl>#{}</styleUrl>\n"
+                    "<LineString>\n"
+                    " <extrude>1</extrude>\n"
+                    " <altitudeMode>relativeToGround</altitudeMode>\n"
+                    "<coordinates>\n".format(escape(str(name)), _description(description), style)]
+                   + ['{},{},{}\n'.format(*coord) for coord in coords]
+                   + ["</coordinates>\n"
+                      "</LineString>\n"
+                      "</Placemark>\n"])
+
+def network_link_xml(name, href, north, south, east, west, min_lod_pixels):
+    """
+    A link to another KML file that is only loaded while
+    the box is on screen and at least min_lod_pixels big
+    :return: The NetworkLink
+    """
+    return ("<NetworkLink><name>{}</name>\n"
+            "<Region><LatLonAltBox><north>{}</north><south>{}</south><east>{}</east><west>{}</west></LatLonAltBox>"
+            "<Lod><minLodPixels>{}</minLodPixels><maxLodPixels>-1</maxLodPixels></Lod></Region>\n"
+            "<Link><href>{}</href><viewRefreshMode>onRegion</viewRefreshMode></Link>\n"
+            "</NetworkLink>\n".format(escape(name), north, south, east, west, min_lod_pixels, escape(href)))
+
+def refresh_link_xml(name, href, interval):
+    """
+    A link to another KML file that is loaded again every
+    interval seconds, to follow a file that keeps changing
+    :return: The NetworkLink
+    """
+    return ("<NetworkLink><name>{}</name>\n"
+            "<Link><href>{}</href><refreshMode>onInterval</refreshMode>"
+            "<refreshInterval>{}</refreshInterval></Link>\n"
+            "</NetworkLink>\n".format(escape(name), escape(href), interval))
+
+class KMLWriter:
+    """
+    Write a KML document one placemark at a time
+
+    with KMLWriter('kml/out.kml', [style_xml('stop', label_color=YELLOW)]) as kml:
+        kml.point('Stop Light', (lon, lat, speed), 'stop')
+    """
+
+    def __init__(self, out, styles=(), name=None, kmz=False):
+        """
+        :param out: Path of the file to write, or a text file object to write to.
+                    A path is written next to it and only replaced once the document
+                    is complete, a run that fails halfway leaves the last one in place
+        :param styles: The <Style> elements of the document, see style_xml
+        :param name: Name of the document
+        :param kmz: Zip the document into the .kmz file out, as doc.kml
+        """
+        self._zip = None
+        self._path = None
+        if isinstance(out, str):
+            self._path = out
+            self._tmp = out + '.' + str(os.getpid()) + '.tmp'
+            if kmz:
+                self._zip = zipfile.ZipFile(self._tmp, 'w', zipfile.ZIP_DEFLATED)
+                self.out = _open_entry(self._zip, 'doc.kml')
+            else:
+                self.out = open(self._tmp, 'w', encoding='utf-8')
+            self._owns_out = True
+        else:
+            self.out = out
+            self._owns_out = False
+
+        # Write the inital headers, and every style once
+        self.out.write(HEADER)
+        if name is not None:
+            self.out.write("<name>{}</name>\n".format(escape(name)))
+        for style in styles:
+            self.out.write(style)
+
+    def point(self, name, coord, style, description=None):
+        """
+        Write one point placemark
+        :param coord: (lon, lat, altitude)
+        :param style: Id of the style to use
+        """
+        self.points([name], [coord], style, description)
+
+    def points(self, names, coords, style, description=None):
+        """
+        Write a batch of point placemarks with a single write
+        :param names: Name of every point, or one name for all of them
+        :param coords: (lon, lat, altitude) of every point
+        :param style: Id of the style to use
+        :param description: Description of every point, or one for all of them
+        """
+        self.out.write(points_xml(names, coords, style, description))
+
+    def line(self, name, coords, style, description=None):
+        """
+        Write one LineString placemark, extruded down to the ground
+        :param coords: (lon, lat, altitude) of every point of the line
+        :param style: Id of the style to use
+        """
+        self.out.write(line_xml(name, coords, style, description))
+
+    def close(self):
+        # Document closing, KML Closing
+        self.out.write(FOOTER)
+        self._release()
+        if self._path is not None:
+            os.replace(self._tmp, self._path)
+
+    def abort(self):
+        """
+        Give up on the document, the file written before stays as it was
+        """
+        self._release()
+        if self._path is not None:
+            try:
+                os.remove(self._tmp)
+            except OSError:
+                pass
+
+    def _release(self):
+        if self._owns_out:
+            self.out.close()
+        if self._zip is not None:
+            self._zip.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class TiledKMLWriter:
+    """
+    Write the placemarks into square tiles of the map, one KML file per
+    tile and style. The main document only holds a NetworkLink to every
+    tile with a Region around it, so a viewer only loads the tiles that
+    are on screen. Lines are cut where they cross into the next tile.
+
+    Has the same point, points and line methods as KMLWriter, the style
+    of a placemark also picks which layer of tiles it goes in
+    """
+
+    def __init__(self, path, styles=(), name=None, kmz=False, tile_size=0.05, min_lod_pixels=None):
+        """
+        :param path: The main .kml file, the tiles go in a directory next to it.
+                     Or with kmz, the .kmz file that all of it is zipped into
+        :param styles: The <Style> elements of the document, see style_xml
+        :param name: Name of the document
+        :param kmz: Zip everything into one .kmz file
+        :param tile_size: Size of a tile in degrees
+        :param min_lod_pixels: Size on screen per style a tile needs to load, see MIN_LOD_PIXELS
+        """
+        self.path = path
+        self.styles = list(styles)
+        self.name = name
+        self.kmz = kmz
+        self.tile_size = tile_size
+        self.min_lod_pixels = dict(MIN_LOD_PIXELS, **(min_lod_pixels or {}))
+
+        # Tiles are spooled to files until close, no tile is kept in memory
+        self._spool = tempfile.mkdtemp(prefix='kml_tiles_', dir=os.path.dirname(os.path.abspath(path)))
+        self._tiles = set()
+
+    def point(self, name, coord, style, description=None):
+        self.points([name], [coord], style, description)
+
+    def points(self, names, coords, style, description=None):
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+        if isinstance(names, str):
+            names = [names] * len(coords)
+        if description is None or isinstance(description, str):
+            description = [description] * len(coords)
+
+        # Write the points of every tile together
+        tiles, tile_of = np.unique(self._tile_index(coords), axis=0, return_inverse=True)
+        order = np.argsort(tile_of.ravel(), kind='stable')
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(tile_of.ravel(), minlength=len(tiles)))])
+        for n, (ix, iy) in enumerate(tiles.tolist()):
+            members = order[offsets[n]:offsets[n + 1]].tolist()
+            self._append(style, ix, iy, points_xml([names[i] for i in members], coords[members].tolist(),
+                                                   style, [description[i] for i in members]))
+
+    def line(self, name, coords, style, description=None):
+        coords = np.asarray(coords, dtype=np.float64).reshape(-1, 3)
+        if len(coords) == 0:
+            return
+        tile = self._tile_index(coords)
+
+        # Cut the line where it goes from one tile to the next. Every
+        # piece also takes the first point of the next, so the line
+        # stays connected, and goes in the tile it starts in
+        cuts = np.flatnonzero((tile[1:] != tile[:-1]).any(axis=1)) + 1
+        starts = np.concatenate([[0], cuts])
+        ends = np.concatenate([cuts + 1, [len(coords)]])
+        for start, end in zip(starts.tolist(), ends.tolist()):
+            if end - start < 2 and len(coords) > 1:
+                continue
+            ix, iy = tile[start].tolist()
+            self._append(style, ix, iy, line_xml(name, coords[start:end].tolist(), style, description))
+
+    def close(self):
+        """
+        Write the main document with a link to every tile, then the tiles.
+        All of it is written next to the old output first and swapped in
+        at the end, so old and new tiles are never mixed
+        """
+        tmp = self.path + '.' + str(os.getpid()) + '.tmp'
+        tile_dir = os.path.splitext(self.path)[0] + '_tiles'
+        tmp_dir = tile_dir + '.' + str(os.getpid()) + '.tmp'
+        try:
+            if self.kmz:
+                with zipfile.ZipFile(tmp, 'w', zipfile.ZIP_DEFLATED) as kmz:
+                    # The main document has to be the first file in the kmz
+                    with _open_entry(kmz, 'doc.kml') as doc:
+                        self._write_links(doc, 'tiles/')
+                    for tile in sorted(self._tiles):
+                        with _open_entry(kmz, 'tiles/' + self._tile_file(*tile)) as out:
+                            self._write_tile(out, *tile)
+                os.replace(tmp, self.path)
+            else:
+                os.makedirs(tmp_dir)
+                with open(tmp, 'w', encoding='utf-8') as doc:
+                    self._write_links(doc, os.path.basename(tile_dir) + '/')
+                for tile in sorted(self._tiles):
+                    with open(os.path.join(tmp_dir, self._tile_file(*tile)), 'w', encoding='utf-8') as out:
+                        self._write_tile(out, *tile)
+
+                # Move the old tiles out of the way, the new ones in, then the document
+                old_dir = tile_dir + '.' + str(os.getpid()) + '.old'
+                if os.path.isdir(tile_dir):
+                    os.rename(tile_dir, old_dir)
+                os.rename(tmp_dir, tile_dir)
+                os.replace(tmp, self.path)
+                shutil.rmtree(old_dir, ignore_errors=True)
+        except BaseException:
+            for path in (tmp, tmp_dir):
+                if os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                elif os.path.exists(path):
+                    os.remove(path)
+            raise
+        finally:
+            shutil.rmtree(self._spool, ignore_errors=True)
+
+    def abort(self):
+        """
+        Give up on the tiles, the output written before stays as it was
+        """
+        shutil.rmtree(self._spool, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def _tile_index(self, coords):
+        return np.floor(coords[:, :2] / self.tile_size).astype(np.int64)
+
+    def _tile_file(self, style, ix, iy):
+        return '{}_{}_{}.kml'.format(style, ix, iy)
+
+    def _append(self, style, ix, iy, xml):
+        self._tiles.add((style, ix, iy))
+        with open(os.path.join(self._spool, self._tile_file(style, ix, iy)), 'a', encoding='utf-8') as spool:
+            spool.write(xml)
+
+    def _write_links(self, out, tile_href):
+        out.write(HEADER)
+        if self.name is not None:
+            out.write("<name>{}</name>\n".format(escape(self.name)))
+        for style, ix, iy in sorted(self._tiles):
+            west, south = round(ix * self.tile_size, 10), round(iy * self.tile_size, 10)
+            east, north = round(west + self.tile_size, 10), round(south + self.tile_size, 10)
+            out.write(network_link_xml('{} {} {}'.format(style, ix, iy), tile_href + self._tile_file(style, ix, iy),
+                                       north, south, east, west, self.min_lod_pixels.get(style, 128)))
+        out.write(FOOTER)
+
+    def _write_tile(self, out, style, ix, iy):
+        out.write(HEADER)
+        for style_element in self.styles:
+            out.write(style_element)
+        with open(os.path.join(self._spool, self._tile_file(style, ix, iy)), encoding='utf-8') as spool:
+            shutil.copyfileobj(spool, out)
+        out.write(FOOTER)
+
+def _open_entry(kmz, name):
+    """
+    Open a file inside the kmz to write text to, compressed
+    and dated now rather than in 1980
+    """
+    info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED
+    return io.TextIOWrapper(kmz.open(info, 'w'), encoding='utf-8')
+
+def _description(description):
+    if description is None:
+        return ''
+    return '<description>{}</description>'.format(escape(str(description)))
@@ -0,0 +1,151 @@
+"""
+File: Time and memory spent in every stage of the pipeline
+Author: JosephGolden, JenniferLiu
+
+Every stage of the pipeline runs inside PROFILER.stage(...). While the
+profiler is off that costs nothing. Once it is enabled, every stage is
+recorded with its wall time, CPU time, memory and number of rows, and
+the file it worked on, so the report can show where a run goes. The
+operating system only keeps the peak memory of the whole process, so a
+stage records that peak as it was when the stage ended, and how much
+the stage raised it. A stage that stays below an earlier peak shows no
+growth.
+Stages can be nested, convert_to_kml for instance holds the time of
+every stage that runs while the KML is written.
+"""
+
+import json
+import os
+import resource
+import sys
+from contextlib import contextmanager
+from time import perf_counter, process_time
+
+import pandas as pd
+
+def peak_rss():
+    """
+    Peak resident memory of this process so far
+    :return: bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux counts in kB, macOS in bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+class Profiler:
+    """
+    Records of the stages of a run
+    """
+    def __init__(self):
+        self.enabled = False
+        self.records = []
+        self.file = None
+
+    def enable(self):
+        self.enabled = True
+
+    @contextmanager
+    def for_file(self, file):
+        """
+        Stages in this block worked on this file, unless they say otherwise
+        """
+        outer, self.file = self.file, file
+        try:
+            yield
+        finally:
+            self.file = outer
+
+    @contextmanager
+    def stage(self, name, file=None, rows=None, keep=True):
+        """
+        Measure a stage. The rows can be set on the record inside the block,
+        once they are known: record['rows'] = len(df)
+        :param name: Name of the stage
+        :param file: File the stage works on, the one of for_file by default
+        :param rows: Number of rows the stage works on
+        :param keep: Add the record to the profiler. Stages that run in
+                     another process return their record to be added with add
+        :return: The record of the stage
+        """
+        record = {'stage': name, 'file': file if file is not None else self.file, 'rows': rows}
+        if not self.enabled:
+            yield record
+            return
+
+        peak_before = peak_rss()
+        wall, cpu = perf_counter(), process_time()
+        try:
+            yield record
+        finally:
+            record['wall'] = perf_counter() - wall
+            record['cpu'] = process_time() - cpu
+            record['process_peak_rss'] = peak_rss()
+            record['rss_growth'] = record['process_peak_rss'] - peak_before
+            record['pid'] = os.getpid()
+            if keep:
+                self.records.append(record)
+
+    def add(self, record):
+        """
+        Add a record measured somewhere else, in a worker process
+        """
+        if self.enabled and 'wall' in record:
+            self.records.append(record)
+
+    def summary(self):
+        """
+        :return: DataFrame with one row per stage, in the order the stages first ran
+        """
+        df = pd.DataFrame(self.records, columns=['stage', 'file', 'rows', 'wall', 'cpu',
+                                                 'process_peak_rss', 'rss_growth', 'pid'])
+        df['rows'] = pd.to_numeric(df['rows']).fillna(0)
+        summary = df.groupby('stage', sort=False).agg(calls=('wall', 'size'), rows=('rows', 'sum'),
+                                                      wall=('wall', 'sum'), cpu=('cpu', 'sum'),
+                                                      process_peak_rss=('process_peak_rss', 'max'),
+                                                      rss_growth=('rss_growth', 'sum'))
+        return summary
+
+    def report(self, out=sys.stdout):
+        """
+        Print the time and memory of every stage, then of every stage of every file
+        """
+        if not self.records:
+            print('Profile: no stages were recorded', file=out)
+            return
+
+        mb = 1024 * 1024
+        summary = self.summary()
+        table = pd.DataFrame({
+            'calls': summary['calls'],
+            'rows': summary['rows'].astype('int64'),
+            'wall s': summary['wall'].round(3),
+            'cpu s': summary['cpu'].round(3),
+            'process peak RSS MB': (summary['process_peak_rss'] / mb).round(1),
+            'RSS growth MB': (summary['rss_growth'] / mb).round(1),
+        })
+        print('Profile by stage (stages can be nested, their times add up to more than the run)', file=out)
+        print('Process peak RSS is the peak of the whole run when the stage ended, '
+              'RSS growth how much the stage raised it', file=out)
+        print(table.to_string(), file=out)
+
+        df = pd.DataFrame([record for record in self.records if record['file'] is not None])
+        if len(df) > 0:
+            df['rows'] = pd.to_numeric(df['rows']).fillna(0)
+            by_file = df.groupby(['file', 'stage'], sort=False).agg(rows=('rows', 'sum'), wall=('wall', 'sum'),
+                                                                    cpu=('cpu', 'sum'))
+            by_file['rows'] = by_file['rows'].astype('int64')
+            by_file[['wall', 'cpu']] = by_file[['wall', 'cpu']].round(3)
+            print('Profile by file', file=out)
+            print(by_file.rename(columns={'wall': 'wall s', 'cpu': 'cpu s'}).to_string(), file=out)
+
+    def dump(self, path):
+        """
+        Write every record and the summary by stage to a JSON file
+        """
+        summary = self.summary().reset_index()
+        with open(path, 'w') as f:
+            json.dump({'stages': summary.to_dict(orient='records'), 'records': self.records},
+                      f, indent=1, default=float)
+
+# The profiler of the whole run, every module records into it
+PROFILER = Profiler()
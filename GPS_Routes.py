@@ -0,0 +1,266 @@
+"""
+File: Merge the routes of many trips into shared corridors
+Author: JosephGolden, JenniferLiu
+
+Trips that drive down the same road never record the same points,
+so drawing every trip gives a bundle of almost parallel lines. Here
+every trip is resampled every few meters along its path and snapped,
+one trip after the other, onto the nodes laid down by the trips before
+it. Only the parts of a trip that no earlier trip drove add new nodes.
+The trips then become walks over one graph of nodes. Every edge of the
+graph is kept once however many trips used it, and the graph is cut
+into corridors at its junctions and dead ends, one line per corridor.
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+from GPS_Helper import project
+
+def resample(x, y, values, piece, spacing):
+    """
+    Points every spacing meters along the path of every stretch of
+    trip, whatever the speed the car was going at
+    :param values: Columns that are interpolated along with the position
+    :param piece: Id of the stretch of trip every point is on, nothing is sampled between stretches
+    :return: x, y, values and piece of the samples
+    """
+    # Distance along the path, with a jump between stretches
+    # so that no sample falls between two of them
+    step = np.hypot(np.diff(x), np.diff(y))
+    step[piece[1:] != piece[:-1]] = spacing
+    along = np.concatenate([[0], np.cumsum(step)])
+
+    # Where every stretch begins and ends along the path
+    first = np.flatnonzero(np.concatenate([[True], piece[1:] != piece[:-1]]))
+    last = np.concatenate([first[1:], [len(x)]]) - 1
+    count = np.floor((along[last] - along[first]) / spacing).astype(np.int64) + 1
+
+    offset = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+    at = np.repeat(along[first], count) + offset * spacing
+
+    def interp(column):
+        return np.interp(at, along, column)
+
+    return interp(x), interp(y), [interp(column) for column in values], np.repeat(piece[first], count)
+
+def snap_trip(tree, x, y, snap_dist, num_nodes, min_run=4):
+    """
+    Snap the samples of one trip onto the nearest existing node within
+    snap_dist. Samples that are further away than that from every node
+    are on a new road, and every two of them in a row make a new node.
+    Fewer than min_run samples in a row that are only a little too far,
+    within twice snap_dist, are the GPS wandering and are snapped anyway
+    :param tree: KD tree of the existing nodes, None when there are none
+    :return: node of every sample, the samples that start a new node, and
+             the run of new samples that each of those belongs to
+    """
+    if tree is None:
+        snapped = np.zeros(len(x), dtype=bool)
+        nearest = np.zeros(len(x), dtype=np.int64)
+    else:
+        dist, nearest = tree.query(np.column_stack([x, y]), distance_upper_bound=2 * snap_dist)
+        snapped = dist <= snap_dist
+
+        # Length of every run of samples that are too far
+        far = ~snapped
+        run = np.cumsum(far & np.concatenate([[True], snapped[:-1]]))
+        length = np.bincount(run[far], minlength=run[-1] + 1)
+        snapped |= far & (length[run] < min_run) & np.isfinite(dist)
+
+    # Position of every new sample within its run of new samples
+    new = ~snapped
+    index = np.arange(len(x))
+    run_start = new & np.concatenate([[True], snapped[:-1]])
+    in_run = index - np.maximum.accumulate(np.where(run_start, index, 0))
+
+    starts_node = new & (in_run % 2 == 0)
+    node = np.where(snapped, nearest, num_nodes + np.cumsum(starts_node) - 1)
+
+    return node, starts_node, np.cumsum(run_start)[starts_node]
+
+def drop_excursions(node_run, piece, max_len):
+    """
+    Where two runs of nodes lie side by side, like the two sides of a
+    divided road, a trip can hop over to the other run for a sample or
+    two and back. Those hops are the GPS wandering, not the car
+    :param node_run: Run that created the node of every sample
+    :param piece: Stretch of trip of every sample
+    :param max_len: Most samples in a hop
+    :return: mask of the samples to keep
+    """
+    # Split the samples in segments on the same run
+    change = np.concatenate([[True], (node_run[1:] != node_run[:-1]) | (piece[1:] != piece[:-1])])
+    segment = np.cumsum(change) - 1
+    length = np.bincount(segment)
+    seg_run = node_run[change]
+    seg_piece = piece[change]
+
+    # A hop is a short segment with the same run on either side of it
+    before = np.concatenate([[-1], seg_run[:-1]])
+    after = np.concatenate([seg_run[1:], [-1]])
+    same_piece = np.concatenate([[False], seg_piece[1:] == seg_piece[:-1]])
+    same_piece = same_piece & np.concatenate([same_piece[1:], [False]])
+    hop = (length <= max_len) & same_piece & (before == after) & (before != seg_run)
+
+    return ~hop[segment]
+
+def fill_skips(a, b, run, max_skip):
+    """
+    The nodes of one run of new samples are numbered in the order the
+    trip went past them. A later trip that jumps from one of them to
+    another a few nodes on is driving down the same road, so the jump
+    is replaced by the steps over every node in between
+    :param a: Node every step starts from
+    :param b: Node every step goes to
+    :param run: Run of new samples that created every node
+    :param max_skip: Longest jump that is filled in
+    :return: the steps, with the jumps filled in
+    """
+    skip = np.abs(b - a)
+    fill = (run[a] == run[b]) & (skip > 1) & (skip <= max_skip)
+    parts = np.where(fill, skip, 1)
+
+    # A jump over parts nodes becomes parts steps of one node
+    index = np.repeat(np.arange(len(a)), parts)
+    offset = np.arange(len(index)) - np.repeat(np.cumsum(parts) - parts, parts)
+    direction = np.where(fill, np.sign(b - a), 0)[index]
+    start = np.where(fill[index], a[index] + offset * direction, a[index])
+    end = np.where(fill[index], start + direction, b[index])
+
+    return start, end, index
+
+def trace_corridors(u, v, num_nodes):
+    """
+    Cut the graph into chains that only meet at junctions and dead ends.
+    Every edge ends up in exactly one chain
+    :param u: First node of every edge
+    :param v: Second node of every edge
+    :return: list of chains, each a list of nodes, and the edges of every chain
+    """
+    degree = np.bincount(np.concatenate([u, v]), minlength=num_nodes)
+
+    # Edges next to every node, grouped by node
+    ends = np.concatenate([u, v])
+    edge_ids = np.concatenate([np.arange(len(u)), np.arange(len(u))])
+    order = np.argsort(ends, kind='stable')
+    incident = edge_ids[order].tolist()
+    start = np.concatenate([[0], np.cumsum(degree)]).tolist()
+
+    u, v, degree = u.tolist(), v.tolist(), degree.tolist()
+    used = [False] * len(u)
+    chains, chain_edges = [], []
+
+    def walk(node, edge):
+        nodes, edges = [node], []
+        while not used[edge]:
+            used[edge] = True
+            edges.append(edge)
+            node = v[edge] if u[edge] == node else u[edge]
+            nodes.append(node)
+
+            # Stop at junctions and dead ends
+            if degree[node] != 2:
+                break
+            first, second = incident[start[node]], incident[start[node] + 1]
+            edge = second if first == edge else first
+        chains.append(nodes)
+        chain_edges.append(edges)
+
+    # Chains start and end at nodes that are not in the middle of a road
+    for node in range(num_nodes):
+        if degree[node] != 2:
+            for edge in incident[start[node]:start[node + 1]]:
+                if not used[edge]:
+                    walk(node, edge)
+
+    # What is left are loops with no junction on them
+    for edge in range(len(u)):
+        if not used[edge]:
+            walk(u[edge], edge)
+
+    return chains, chain_edges
+
+def merge_routes(dfs, spacing=10, snap_dist=25, max_gap=200, min_trips=1):
+    """
+    Merge the trips into corridors, so that a road that was
+    driven many times is drawn once
+    :param dfs: A DataFrame [time, lon, lat, speed] for every trip
+    :param spacing: Distance between the nodes of a corridor in meters
+    :param snap_dist: Trips closer than this in meters share a corridor
+    :param max_gap: Jumps longer than this in meters, where the GPS lost its fix, are not drawn
+    :param min_trips: Only keep roads that at least this many trips drove down
+    :return: list of corridors, each an array of [lon, lat, speed], and the number of trips on each corridor
+    """
+    lon = np.concatenate([df['lon'].to_numpy(dtype=np.float64) for df in dfs] + [np.empty(0)])
+    lat = np.concatenate([df['lat'].to_numpy(dtype=np.float64) for df in dfs] + [np.empty(0)])
+    speed = np.concatenate([df['speed'].to_numpy(dtype=np.float64) for df in dfs] + [np.empty(0)])
+    trip = np.repeat(np.arange(len(dfs)), [len(df) for df in dfs])
+
+    if len(lon) == 0:
+        return [], np.empty(0, dtype=np.int64)
+
+    x, y = project(lon, lat, np.mean(lat))
+
+    # Steps longer than max_gap, where the GPS lost its fix,
+    # split a trip in two stretches. No line is drawn across them
+    gap = np.hypot(np.diff(x), np.diff(y)) > max_gap
+    piece = np.cumsum(np.concatenate([[0], gap | (trip[1:] != trip[:-1])]))
+
+    # Two samples per node, so that a trip running next to an earlier
+    # one goes through each of its nodes in turn without skipping any
+    x, y, (lon, lat, speed, trip), piece = resample(x, y, [lon, lat, speed, trip], piece, spacing / 2)
+    trip = np.rint(trip).astype(np.int64)
+
+    # Snap the trips one at a time onto the nodes of the trips before
+    node = np.empty(len(x), dtype=np.int64)
+    node_x, node_y, node_run = np.empty(0), np.empty(0), np.empty(0, dtype=np.int64)
+    tree = None
+    bounds = np.searchsorted(trip, np.arange(len(dfs) + 1))
+    for lo, hi in zip(bounds[:-1], bounds[1:]):
+        if lo == hi:
+            continue
+        node[lo:hi], starts_node, run = snap_trip(tree, x[lo:hi], y[lo:hi], snap_dist, len(node_x))
+        if starts_node.any():
+            node_x = np.concatenate([node_x, x[lo:hi][starts_node]])
+            node_y = np.concatenate([node_y, y[lo:hi][starts_node]])
+            node_run = np.concatenate([node_run, run + (node_run[-1] if len(node_run) else 0)])
+            tree = cKDTree(np.column_stack([node_x, node_y]))
+    num_nodes = len(node_x)
+
+    # Every node sits at the mean of the samples snapped onto it
+    count = np.bincount(node, minlength=num_nodes)
+    node_lon = np.bincount(node, weights=lon, minlength=num_nodes) / count
+    node_lat = np.bincount(node, weights=lat, minlength=num_nodes) / count
+    node_speed = np.bincount(node, weights=speed, minlength=num_nodes) / count
+
+    keep = drop_excursions(node_run[node], piece, max_len=6)
+    node, piece, trip = node[keep], piece[keep], trip[keep]
+
+    # Each trip is a walk from node to node, an edge is
+    # a step between two different nodes of the same stretch
+    step = (node[1:] != node[:-1]) & (piece[1:] == piece[:-1])
+    a, b, edge_trip = node[:-1][step], node[1:][step], trip[1:][step]
+
+    # Trips next to an earlier one now and then miss one of its nodes
+    a, b, index = fill_skips(a, b, node_run, max_skip=4)
+    edge_trip = edge_trip[index]
+
+    # Both directions of a road are the same corridor,
+    # keep every edge once and count the trips on it
+    u, v = np.minimum(a, b), np.maximum(a, b)
+    edge_code = u * num_nodes + v
+    edge_code, edge = np.unique(edge_code, return_inverse=True)
+    used_by = np.unique(edge.astype(np.int64) * len(dfs) + edge_trip)
+    trips = np.bincount(used_by // len(dfs), minlength=len(edge_code))
+
+    keep = trips >= min_trips
+    edge_code, trips = edge_code[keep], trips[keep]
+    u, v = edge_code // num_nodes, edge_code % num_nodes
+
+    chains, chain_edges = trace_corridors(u, v, num_nodes)
+
+    corridors = [np.column_stack([node_lon[nodes], node_lat[nodes], node_speed[nodes]]) for nodes in chains]
+    corridor_trips = np.array([trips[edges].max() for edges in chain_edges], dtype=np.int64)
+
+    return corridors, corridor_trips
@@ -0,0 +1,443 @@
+"""
+File: Ingest server for a fleet of GPS loggers
+Author: JosephGolden, JenniferLiu
+
+One process that many loggers send their NMEA lines to at the same
+time, over TCP or UDP. Every vehicle keeps its own LiveFixes, the
+load_file filters run one line at a time, and its fixes are stored in
+batches into a TraceStore, one trip per vehicle and connection.
+
+A TCP connection may start with a line VEHICLE <id>, otherwise the
+vehicle is named after the address it connects from. A UDP datagram
+holds whole lines, and may also start with VEHICLE <id>. A UDP vehicle
+that goes quiet for trip_gap seconds starts a new trip.
+
+All the writes go through one bounded queue to a single writer thread,
+SQLite only takes one writer at a time anyway. When the writer falls
+behind the queue fills up, and the TCP connections stop being read
+until there is room again, which slows the loggers down through TCP
+flow control. UDP has no way to push back, so a batch of UDP fixes
+that is ready while the queue is full is dropped and counted.
+
+With a stop site index, every vehicle also runs the one pass
+DwellStops over its fixes, and the writer merges the stops into the
+index as they end.
+
+python GPS_Server.py --tcp 0.0.0.0:9000 --udp 0.0.0.0:9001 --store fleet.sqlite
+"""
+
+import argparse
+import asyncio
+import contextlib
+import io
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from GPS_Store import TraceStore, COLUMNS
+from GPS_Stream import LiveFixes
+from GPS_Dwell import DwellStops
+from GPS_Sites import StopSites
+
+class Vehicle:
+    """
+    What the server keeps for every vehicle: its filters, the
+    trip it is on, and the fixes and stops not stored yet
+    """
+    def __init__(self, name, trip):
+        self.name = name
+        self.trip = trip
+        self.fixes = LiveFixes()
+        self.stops = DwellStops()
+        self.pending = []
+        self.pending_stops = []
+        self.last_flush = time.monotonic()
+        self.last_seen = time.monotonic()
+
+class IngestServer:
+    """
+    Parses the lines of every vehicle and hands batches of fixes
+    to a single writer thread that stores them
+    """
+    def __init__(self, store_path='fleet.sqlite', batch_size=500, flush_interval=2, queue_size=64,
+                 trip_gap=300, sites_path=None, site_radius=25):
+        """
+        :param store_path: TraceStore the trips are written to
+        :param batch_size: Fixes of a vehicle that are stored together
+        :param flush_interval: Most seconds a fix waits before it is stored
+        :param queue_size: Batches waiting for the writer before the readers are held up
+        :param trip_gap: Seconds a UDP vehicle has to be quiet for its next fix to start a new trip
+        :param sites_path: StopSites index the stops of every vehicle are merged into, None to not look for stops
+        :param site_radius: Meters from a stop site that a stop still counts as a visit of it
+        """
+        self.store_path = store_path
+        self.sites_path = sites_path
+        self.site_radius = site_radius
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.trip_gap = trip_gap
+        self.queue = asyncio.Queue(queue_size)
+        self.udp_vehicles = {}
+        self.vehicles = set()
+
+        # Trips started in the current second. Names carry the second
+        # they started in, so only those can still be taken again
+        self.trips = set()
+        self.trip_second = None
+        self.connections = set()
+        self.stats = {'connections': 0, 'lines': 0, 'fixes': 0, 'batches': 0, 'stored': 0,
+                      'dropped_batches': 0, 'queue_high': 0, 'stops': 0, 'failed_batches': 0}
+
+        # SQLite wants every call on the thread that opened it
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._store = None
+        self._sites = None
+        self.writer_task = None
+
+    def new_vehicle(self, name):
+        second = time.strftime('%Y%m%dT%H%M%S')
+        if second != self.trip_second:
+            self.trip_second = second
+            self.trips.clear()
+
+        trip = '{}/{}'.format(name, second)
+        # Two trips of one vehicle that start within the same second
+        first, count = trip, 1
+        while trip in self.trips:
+            trip = '{}_{}'.format(first, count)
+            count += 1
+        self.trips.add(trip)
+        vehicle = Vehicle(name, trip)
+        self.vehicles.add(vehicle)
+        return vehicle
+
+    def feed(self, vehicle, lines):
+        """
+        Run lines of a vehicle through its filters
+        :return: A batch (trip, fixes) to store, if the vehicle has one ready
+        """
+        self.stats['lines'] += len(lines)
+        vehicle.last_seen = time.monotonic()
+
+        # The parser prints the lines it can not read, one bad logger
+        # should not flood the output of the server
+        with contextlib.redirect_stdout(io.StringIO()):
+            fixes = vehicle.fixes.feed_lines(lines)
+        vehicle.pending += fixes
+        self.find_stops(vehicle, fixes)
+
+        if len(vehicle.pending) >= self.batch_size or \
+                (vehicle.pending and time.monotonic() - vehicle.last_flush >= self.flush_interval):
+            return self.take(vehicle)
+        return None
+
+    def find_stops(self, vehicle, fixes, final=False):
+        """
+        Run new fixes of a vehicle through its stop detector
+        :param final: The vehicle is gone, a stop it is still in is over
+        """
+        if self.sites_path is None:
+            return
+        for fix in fixes:
+            vehicle.pending_stops += vehicle.stops.feed(fix)
+        if final:
+            vehicle.pending_stops += vehicle.stops.flush()
+
+    def take(self, vehicle, final=False):
+        """
+        :param final: The vehicle is gone, every fix held back by its filters is final
+        :return: The batch (trip, fixes, stops) of the vehicle, None if it has none
+        """
+        if final:
+            fixes = vehicle.fixes.flush()
+            vehicle.pending += fixes
+            self.find_stops(vehicle, fixes, final=True)
+        vehicle.last_flush = time.monotonic()
+        if not vehicle.pending and not vehicle.pending_stops:
+            return None
+        batch = (vehicle.trip, vehicle.pending, vehicle.pending_stops)
+        vehicle.pending, vehicle.pending_stops = [], []
+        self.stats['fixes'] += len(batch[1])
+        return batch
+
+    async def put(self, batch):
+        """
+        Queue a batch for the writer, waiting while the queue is full.
+        A writer that is gone never makes room, the batch is lost then
+        """
+        if batch is None:
+            return
+        if self.queue.full() and self.writer_task is not None:
+            put = asyncio.ensure_future(self.queue.put(batch))
+            await asyncio.wait([put, self.writer_task], return_when=asyncio.FIRST_COMPLETED)
+            if not put.done():
+                put.cancel()
+                self.stats['failed_batches'] += 1
+                self.stats['fixes'] -= len(batch[1])
+                return
+        else:
+            self.queue.put_nowait(batch)
+        self.stats['queue_high'] = max(self.stats['queue_high'], self.queue.qsize())
+
+    async def handle_tcp(self, reader, writer):
+        self.stats['connections'] += 1
+        self.connections.add(asyncio.current_task())
+        peer = writer.get_extra_info('peername')
+        vehicle = None
+        partial = ''
+        try:
+            while True:
+                data = await reader.read(1 << 16)
+                if not data:
+                    break
+
+                # Only whole lines are parsed, the rest waits for the next read
+                lines = (partial + data.decode(errors='replace')).splitlines(keepends=True)
+                partial = lines.pop() if lines and not lines[-1].endswith(('\n', '\r')) else ''
+
+                if vehicle is None and lines:
+                    if lines[0].startswith('VEHICLE '):
+                        vehicle = self.new_vehicle(lines.pop(0)[8:].strip())
+                    else:
+                        vehicle = self.new_vehicle('{}:{}'.format(*peer[:2]))
+
+                # Backpressure, this connection is not read again until the writer has room
+                if lines:
+                    await self.put(self.feed(vehicle, lines))
+            if partial and vehicle is not None:
+                await self.put(self.feed(vehicle, [partial]))
+        except ConnectionError:
+            pass
+        finally:
+            if vehicle is not None:
+                await self.put(self.take(vehicle, final=True))
+                self.vehicles.discard(vehicle)
+            writer.close()
+            self.connections.discard(asyncio.current_task())
+
+    def handle_datagram(self, data, addr):
+        lines = data.decode(errors='replace').splitlines(keepends=True)
+        name = '{}:{}'.format(*addr[:2])
+        if lines and lines[0].startswith('VEHICLE '):
+            name = lines.pop(0)[8:].strip()
+
+        vehicle = self.udp_vehicles.get(name)
+        if vehicle is not None and time.monotonic() - vehicle.last_seen > self.trip_gap:
+            # Quiet for too long, the next fix starts a new trip
+            self._end_udp(name)
+            vehicle = None
+        if vehicle is None:
+            vehicle = self.udp_vehicles[name] = self.new_vehicle(name)
+
+        batch = self.feed(vehicle, lines)
+        if batch is not None:
+            try:
+                self.queue.put_nowait(batch)
+                self.stats['queue_high'] = max(self.stats['queue_high'], self.queue.qsize())
+            except asyncio.QueueFull:
+                # UDP can not be slowed down, the batch is lost
+                self.stats['dropped_batches'] += 1
+                self.stats['fixes'] -= len(batch[1])
+
+    def _end_udp(self, name):
+        vehicle = self.udp_vehicles.pop(name)
+        self.vehicles.discard(vehicle)
+        batch = self.take(vehicle, final=True)
+        if batch is not None:
+            try:
+                self.queue.put_nowait(batch)
+            except asyncio.QueueFull:
+                self.stats['dropped_batches'] += 1
+                self.stats['fixes'] -= len(batch[1])
+
+    async def writer(self):
+        """
+        Store the batches as they come, every batch waiting
+        in the queue goes into one transaction
+        """
+        loop = asyncio.get_running_loop()
+        self._store = await loop.run_in_executor(self._executor, TraceStore, self.store_path)
+        if self.sites_path is not None:
+            self._sites = await loop.run_in_executor(self._executor, StopSites, self.sites_path, self.site_radius)
+        while True:
+            batches = [await self.queue.get()]
+            while not self.queue.empty():
+                batches.append(self.queue.get_nowait())
+            try:
+                await loop.run_in_executor(self._executor, self._write_all, batches)
+            finally:
+                for _ in batches:
+                    self.queue.task_done()
+
+    def _write_all(self, batches):
+        """
+        Store the batches in one go, or one at a time if that fails, so
+        one bad batch only loses itself and the writer carries on
+        """
+        try:
+            self._write(batches)
+            return
+        except Exception as error:
+            if len(batches) == 1:
+                self._failed(batches[0], error)
+                return
+        for batch in batches:
+            try:
+                self._write([batch])
+            except Exception as error:
+                self._failed(batch, error)
+
+    def _failed(self, batch, error):
+        print('Could not store {} fixes and {} stops of {}: {!r}'.format(len(batch[1]), len(batch[2]), batch[0], error))
+        self.stats['failed_batches'] += 1
+        self.stats['fixes'] -= len(batch[1])
+
+    def _write(self, batches):
+        # All the fixes of one trip in the queue go in together
+        by_trip, stops_by_trip = {}, {}
+        for trip, fixes, stops in batches:
+            by_trip.setdefault(trip, []).extend(fixes)
+            stops_by_trip.setdefault(trip, []).extend(stops)
+        for trip, fixes in by_trip.items():
+            if fixes:
+                self._store.append(trip, pd.DataFrame(np.array(fixes, dtype=np.float64).reshape(-1, 4),
+                                                      columns=COLUMNS))
+        for trip, stops in stops_by_trip.items():
+            if stops:
+                self._sites.append(trip, [[stop['lon'], stop['lat'], stop['speed'], stop['dwell']]
+                                          for stop in stops])
+        self.stats['batches'] += len(batches)
+        self.stats['stored'] += sum(len(fixes) for fixes in by_trip.values())
+        self.stats['stops'] += sum(len(stops) for stops in stops_by_trip.values())
+
+    async def flusher(self):
+        """
+        Store the fixes and stops of vehicles that are sending slowly, so
+        nothing waits longer than flush_interval, and end quiet UDP trips
+        """
+        while True:
+            await asyncio.sleep(self.flush_interval / 2)
+            now = time.monotonic()
+            for vehicle in list(self.vehicles):
+                if (vehicle.pending or vehicle.pending_stops) and now - vehicle.last_flush >= self.flush_interval:
+                    await self.put(self.take(vehicle))
+            for name, vehicle in list(self.udp_vehicles.items()):
+                if now - vehicle.last_seen > self.trip_gap:
+                    self._end_udp(name)
+
+    async def reporter(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            self.report()
+
+    def report(self):
+        print('{connections} connections, {lines} lines, {fixes} fixes, {stored} stored in {batches} batches, '
+              '{stops} stops, queue high {queue_high}, dropped UDP batches {dropped_batches}, '
+              'failed batches {failed_batches}'.format(**self.stats))
+
+    async def close(self, drain_timeout=30):
+        """
+        Let the open connections send what they still have, store
+        everything still held, then close the store
+        :param drain_timeout: Most seconds to wait for the open connections
+        """
+        if self.connections:
+            done, pending = await asyncio.wait(set(self.connections), timeout=drain_timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+        for vehicle in list(self.vehicles):
+            await self.put(self.take(vehicle, final=True))
+
+        # Wait for the writer to store everything, unless it is gone
+        join = asyncio.ensure_future(self.queue.join())
+        waits = [join] if self.writer_task is None else [join, self.writer_task]
+        await asyncio.wait(waits, return_when=asyncio.FIRST_COMPLETED)
+        if not join.done():
+            join.cancel()
+            error = None if self.writer_task.cancelled() else self.writer_task.exception()
+            print('The writer stopped, {} batches were not stored: {!r}'.format(self.queue.qsize(), error))
+        if self._store is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._store.close)
+        if self._sites is not None:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._sites.close)
+        self._executor.shutdown()
+
+def parse_address(text):
+    host, _, port = text.rpartition(':')
+    return host or '0.0.0.0', int(port)
+
+async def serve(tcp=None, udp=None, report_every=10, duration=None, **options):
+    """
+    Run the ingest server
+    :param tcp: (host, port) to take TCP connections on, None for no TCP
+    :param udp: (host, port) to take UDP datagrams on, None for no UDP
+    :param report_every: Seconds between prints of the counters
+    :param duration: Stop after this many seconds, None runs until interrupted
+    :param options: Settings of the IngestServer
+    :return: The counters of the server
+    """
+    server = IngestServer(**options)
+    loop = asyncio.get_running_loop()
+    server.writer_task = asyncio.create_task(server.writer())
+    tasks = [server.writer_task, asyncio.create_task(server.flusher()),
+             asyncio.create_task(server.reporter(report_every))]
+
+    tcp_server = udp_transport = None
+    if tcp is not None:
+        tcp_server = await asyncio.start_server(server.handle_tcp, *tcp)
+        print('Taking TCP on {}:{}'.format(*tcp))
+    if udp is not None:
+        class Datagrams(asyncio.DatagramProtocol):
+            def datagram_received(self, data, addr):
+                server.handle_datagram(data, addr)
+        udp_transport, _ = await loop.create_datagram_endpoint(Datagrams, local_addr=udp)
+        print('Taking UDP on {}:{}'.format(*udp))
+
+    try:
+        # Also stop when the writer is gone, nothing would be stored any more
+        await asyncio.wait([server.writer_task], timeout=duration)
+    finally:
+        if tcp_server is not None:
+            tcp_server.close()
+        if udp_transport is not None:
+            udp_transport.close()
+        await server.close()
+        for task in tasks:
+            task.cancel()
+        server.report()
+
+    # The writer only ever ends by failing
+    if server.writer_task.done() and not server.writer_task.cancelled():
+        raise server.writer_task.exception()
+    return server.stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(usage='Take NMEA lines from many GPS loggers at once and store their trips')
+    parser.add_argument('--tcp', type=parse_address, default=None, metavar='HOST:PORT', help='Address to take TCP on')
+    parser.add_argument('--udp', type=parse_address, default=None, metavar='HOST:PORT', help='Address to take UDP on')
+    parser.add_argument('--store', type=str, default='fleet.sqlite', help='Trace store the trips are written to')
+    parser.add_argument('--batch', type=int, default=500, help='Fixes of a vehicle that are stored together')
+    parser.add_argument('--flush', type=float, default=2, help='Most seconds a fix waits before it is stored')
+    parser.add_argument('--queue', type=int, default=64, help='Batches waiting for the writer before TCP is held up')
+    parser.add_argument('--trip-gap', type=float, default=300, help='Seconds of quiet that end the trip of a UDP vehicle')
+    parser.add_argument('--sites', type=str, default=None, help='Stop site index the stops of every vehicle go into')
+    parser.add_argument('--site-radius', type=float, default=25,
+                        help='Meters from a stop site that a stop still counts as a visit of it')
+    parser.add_argument('--report', type=float, default=10, help='Seconds between prints of the counters')
+    parser.add_argument('--duration', type=float, default=None, help='Stop after this many seconds')
+    args = parser.parse_args()
+
+    if args.tcp is None and args.udp is None:
+        args.tcp = ('0.0.0.0', 9000)
+
+    try:
+        asyncio.run(serve(args.tcp, args.udp, args.report, args.duration, store_path=args.store,
+                          batch_size=args.batch, flush_interval=args.flush, queue_size=args.queue,
+                          trip_gap=args.trip_gap, sites_path=args.sites, site_radius=args.site_radius))
+    except KeyboardInterrupt:
+        pass
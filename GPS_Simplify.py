@@ -0,0 +1,114 @@
+"""
+File: Simplify GPS tracks before they are written out
+Author: JosephGolden, JenniferLiu
+
+A car that drives down a straight road records a point every second,
+and every one of them ends up in the KML file. Douglas-Peucker keeps
+only the points that the track would move more than a tolerance
+away from without. Corners are kept, straight runs collapse to their
+two ends. All the segments of one level of the recursion are split
+together, so the work is done with NumPy and not a loop per point.
+"""
+
+import numpy as np
+
+from GPS_Helper import project
+
+def douglas_peucker(x, y, tolerance, keep=None, max_length=None):
+    """
+    Douglas-Peucker simplification of a polyline
+    :param x: x of every point in meters
+    :param y: y of every point in meters
+    :param tolerance: Most the simplified line may be off the original, in meters
+    :param keep: Points that have to stay, the line is simplified between them
+    :param max_length: Segments longer than this in meters are split too, None for no limit
+    :return: Mask of the points that are kept
+    """
+    n = len(x)
+    kept = np.zeros(n, dtype=bool) if keep is None else np.array(keep, dtype=bool)
+    if n <= 2:
+        kept[:] = True
+        return kept
+    kept[[0, -1]] = True
+
+    # The segments between the points kept so far
+    anchors = np.flatnonzero(kept)
+    starts, ends = anchors[:-1], anchors[1:]
+
+    while len(starts) > 0:
+        # Only segments with points in between them can be split
+        inner = ends - starts - 1
+        starts, ends, inner = starts[inner > 0], ends[inner > 0], inner[inner > 0]
+        if len(starts) == 0:
+            break
+
+        # Every point in between, and the segment it is in
+        segment = np.repeat(np.arange(len(starts)), inner)
+        point = np.arange(inner.sum()) - np.repeat(np.cumsum(inner) - inner, inner) + starts[segment] + 1
+
+        # Distance from every point to the chord of its segment,
+        # a chord that starts and ends in the same place is a point
+        ax, ay = x[starts][segment], y[starts][segment]
+        dx, dy = x[ends][segment] - ax, y[ends][segment] - ay
+        length = dx * dx + dy * dy
+        t = np.clip(((x[point] - ax) * dx + (y[point] - ay) * dy) / np.where(length > 0, length, 1), 0, 1)
+        dist = np.hypot(x[point] - (ax + t * dx), y[point] - (ay + t * dy))
+
+        # The furthest point of every segment, split there if it is too far
+        offsets = np.cumsum(inner) - inner
+        furthest = np.maximum.reduceat(dist, offsets)
+        at_max = np.flatnonzero(dist == furthest[segment])
+        split = point[at_max[np.searchsorted(at_max, offsets)]]
+
+        far = furthest > tolerance
+        if max_length is not None:
+            far |= length[offsets] > max_length * max_length
+        kept[split[far]] = True
+        starts, ends = np.concatenate([starts[far], split[far]]), np.concatenate([split[far], ends[far]])
+
+    return kept
+
+def simplify_trip(df, tolerance=5, stop_speed=10, keep=None, max_step=None):
+    """
+    Simplify one trip. The stops and turns found on it stay, and so do
+    the first and last point of every run of slow points, where the car
+    pulled up and drove off. Turns that were not found stay anyway when
+    they are sharp enough, because they are corners
+    :param df: DataFrame [time, lon, lat, speed] of the trip
+    :param tolerance: Most the simplified trip may be off the original, in meters
+    :param stop_speed: Points at or below this speed start and end a stop, None keeps no stop ends
+    :param keep: Array of [lon, lat] of the points that have to stay, the stops and turns of the trip
+    :param max_step: Most meters between two points that are kept, unless the trip already jumped further
+    :return: The simplified DataFrame
+    """
+    lon = df['lon'].to_numpy(dtype=np.float64)
+    lat = df['lat'].to_numpy(dtype=np.float64)
+
+    kept = np.zeros(len(df), dtype=bool)
+    if keep is not None and len(keep) > 0:
+        # The stops and turns are points of the trip, find them by position
+        keep = np.asarray(keep, dtype=np.float64).reshape(-1, 2)
+        kept = np.isin(lon + 1j * lat, keep[:, 0] + 1j * keep[:, 1])
+    if stop_speed is not None and len(df) > 0:
+        # Both ends of every run of slow points
+        slow = df['speed'].to_numpy(dtype=np.float64) <= stop_speed
+        edge = np.diff(np.concatenate([[False], slow, [False]]).astype(np.int8))
+        kept[np.flatnonzero(edge == 1)] = True
+        kept[np.flatnonzero(edge == -1) - 1] = True
+
+    x, y = project(lon, lat)
+    kept = douglas_peucker(x, y, tolerance, kept, max_step)
+    print('Simplified trip: kept {} of {} points, dropped {}'.format(kept.sum(), len(df), len(df) - kept.sum()))
+
+    return df[kept].reset_index(drop=True)
+
+def simplify_polyline(coords, tolerance=5):
+    """
+    Simplify a line of [lon, lat, altitude] points
+    :param coords: Array of [lon, lat, altitude]
+    :param tolerance: Most the simplified line may be off the original, in meters
+    :return: The points that are kept
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    x, y = project(coords[:, 0], coords[:, 1])
+    return coords[douglas_peucker(x, y, tolerance)]
@@ -0,0 +1,207 @@
+"""
+File: Stop sites of the whole fleet
+Author: JosephGolden, JenniferLiu
+
+Every trip that drives through an intersection stops at about the same
+place, and each of them used to get a "Stop Light" pin of its own. Here
+the stops of every trip are merged into stop sites kept in one SQLite
+file. A stop within radius meters of a site counts as another visit of
+that site, which moves towards it, otherwise it starts a new site. A
+site keeps running sums only: how often it was visited, by how many
+trips, and the sum and sum of squares of the dwell times, so the mean
+and spread of the dwell come out without going over the visits again.
+
+An R-tree on the site centers finds the sites close to a stop, and
+draws the sites of a part of the map in one query. Every visit is also
+kept with its trip, so storing a trip again replaces what it added
+before rather than counting it twice.
+"""
+
+import math
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from GPS_Helper import EARTH_RADIUS, haversine_array
+
+SITE_COLUMNS = ['site', 'lon', 'lat', 'speed', 'visits', 'trips', 'dwell_mean', 'dwell_std']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites (
+    site INTEGER PRIMARY KEY,
+    lon_sum REAL NOT NULL,
+    lat_sum REAL NOT NULL,
+    speed_sum REAL NOT NULL,
+    visits INTEGER NOT NULL,
+    trips INTEGER NOT NULL,
+    dwell_sum REAL NOT NULL,
+    dwell_sq REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS visits (
+    trip TEXT NOT NULL,
+    site INTEGER NOT NULL REFERENCES sites(site),
+    lon REAL NOT NULL,
+    lat REAL NOT NULL,
+    speed REAL NOT NULL,
+    dwell REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS visits_trip ON visits(trip, site);
+CREATE VIRTUAL TABLE IF NOT EXISTS site_index USING rtree(
+    site, min_lon, max_lon, min_lat, max_lat
+);
+"""
+
+class StopSites:
+    """
+    Stop sites in an SQLite file, that the stops of every trip are merged into
+
+    sites = StopSites('sites.sqlite')
+    sites.add_trip('Txt/trip.txt', stops)
+    found = sites.query(bbox=(-77.7, 43.0, -77.6, 43.1), min_visits=3)
+    """
+
+    def __init__(self, path='sites.sqlite', radius=25):
+        """
+        :param path: The SQLite file, created if it does not exist
+        :param radius: Meters from a site that a stop still counts as a visit of it
+        """
+        self.path = path
+        self.radius = radius
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add_trip(self, trip, stops):
+        """
+        Merge the stops of a trip, replacing whatever the trip added before
+        :param trip: Name of the trip, the path of its raw file
+        :param stops: Array of [lon, lat, speed, dwell] of every stop
+        :return: Number of stops that visited a known site, and number of new sites
+        """
+        with self.conn:
+            self._remove(trip)
+            return self._merge(trip, stops)
+
+    def append(self, trip, stops):
+        """
+        Merge more stops of a trip, for trips that are still being driven
+        :param trip: Name of the trip
+        :param stops: Array of [lon, lat, speed, dwell] of every stop
+        :return: Number of stops that visited a known site, and number of new sites
+        """
+        with self.conn:
+            return self._merge(trip, stops)
+
+    def remove(self, trip):
+        """
+        Take the visits of a trip out of the sites
+        :param trip: Name of the trip
+        """
+        with self.conn:
+            self._remove(trip)
+
+    def query(self, bbox=None, min_visits=1):
+        """
+        The sites inside a bounding box
+        :param bbox: (west, south, east, north) in degrees, None for everywhere
+        :param min_visits: Leave out the sites visited fewer times than this
+        :return: DataFrame with SITE_COLUMNS, the most visited sites first
+        """
+        sql = ('SELECT s.site, s.lon_sum / s.visits, s.lat_sum / s.visits, s.speed_sum / s.visits, s.visits, '
+               's.trips, s.dwell_sum, s.dwell_sq FROM sites s')
+        params = [min_visits]
+        if bbox is not None:
+            west, south, east, north = bbox
+            sql += (' JOIN site_index i ON i.site = s.site'
+                    ' WHERE i.max_lon >= ? AND i.min_lon <= ? AND i.max_lat >= ? AND i.min_lat <= ? AND')
+            params = [west, east, south, north] + params
+        else:
+            sql += ' WHERE'
+        sql += ' s.visits >= ? ORDER BY s.visits DESC, s.site'
+
+        rows = np.array(self.conn.execute(sql, params).fetchall(), dtype=np.float64).reshape(-1, 8)
+        visits, dwell_sum, dwell_sq = rows[:, 4], rows[:, 6], rows[:, 7]
+
+        # Spread of the dwell from its running sums, rounding can take it just below 0
+        mean = dwell_sum / np.maximum(visits, 1)
+        std = np.sqrt(np.maximum(dwell_sq / np.maximum(visits, 1) - mean ** 2, 0))
+
+        found = pd.DataFrame({'site': rows[:, 0].astype(np.int64), 'lon': rows[:, 1], 'lat': rows[:, 2],
+                              'speed': rows[:, 3], 'visits': visits.astype(np.int64),
+                              'trips': rows[:, 5].astype(np.int64), 'dwell_mean': mean, 'dwell_std': std})
+        return found[SITE_COLUMNS]
+
+    def _nearest(self, lon, lat):
+        """
+        :return: The site closest to (lon, lat) within radius, None if there is none
+        """
+        # Box of radius meters around the stop, the sites in it are candidates
+        dlat = math.degrees(self.radius / EARTH_RADIUS)
+        dlon = dlat / max(math.cos(math.radians(lat)), 1e-6)
+        rows = self.conn.execute(
+            'SELECT s.site, s.lon_sum / s.visits, s.lat_sum / s.visits FROM site_index i '
+            'JOIN sites s ON s.site = i.site '
+            'WHERE i.max_lon >= ? AND i.min_lon <= ? AND i.max_lat >= ? AND i.min_lat <= ?',
+            (lon - dlon, lon + dlon, lat - dlat, lat + dlat)).fetchall()
+        if not rows:
+            return None
+
+        sites = np.array(rows, dtype=np.float64)
+        dist = haversine_array(sites[:, 1], sites[:, 2], lon, lat)
+        closest = int(np.argmin(dist))
+        return int(sites[closest, 0]) if dist[closest] <= self.radius else None
+
+    def _merge(self, trip, stops):
+        merged = new = 0
+        for lon, lat, speed, dwell in np.asarray(stops, dtype=np.float64).reshape(-1, 4).tolist():
+            site = self._nearest(lon, lat)
+            if site is None:
+                site = self.conn.execute(
+                    'INSERT INTO sites (lon_sum, lat_sum, speed_sum, visits, trips, dwell_sum, dwell_sq) '
+                    'VALUES (0, 0, 0, 0, 0, 0, 0)').lastrowid
+                self.conn.execute('INSERT INTO site_index VALUES (?, ?, ?, ?, ?)', (site, lon, lon, lat, lat))
+                new += 1
+            else:
+                merged += 1
+
+            # The first visit of this trip to the site adds a trip to it
+            first = self.conn.execute('SELECT 1 FROM visits WHERE trip = ? AND site = ? LIMIT 1',
+                                      (trip, site)).fetchone() is None
+            self.conn.execute('INSERT INTO visits VALUES (?, ?, ?, ?, ?, ?)', (trip, site, lon, lat, speed, dwell))
+            self._update(site, lon, lat, speed, dwell, 1, int(first))
+        return merged, new
+
+    def _remove(self, trip):
+        for site, lon, lat, speed, visits, dwell, dwell_sq in self.conn.execute(
+                'SELECT site, SUM(lon), SUM(lat), SUM(speed), COUNT(*), SUM(dwell), SUM(dwell * dwell) '
+                'FROM visits WHERE trip = ? GROUP BY site', (trip,)).fetchall():
+            self._update(site, -lon, -lat, -speed, -dwell, -visits, -1, -dwell_sq)
+        self.conn.execute('DELETE FROM visits WHERE trip = ?', (trip,))
+
+        # Sites that only this trip had visited are gone
+        self.conn.execute('DELETE FROM site_index WHERE site IN (SELECT site FROM sites WHERE visits <= 0)')
+        self.conn.execute('DELETE FROM sites WHERE visits <= 0')
+
+    def _update(self, site, lon, lat, speed, dwell, visits, trips, dwell_sq=None):
+        """
+        Add to the running sums of a site, and move it to its new center
+        """
+        if dwell_sq is None:
+            dwell_sq = dwell * dwell
+        self.conn.execute('UPDATE sites SET lon_sum = lon_sum + ?, lat_sum = lat_sum + ?, speed_sum = speed_sum + ?, '
+                          'visits = visits + ?, trips = trips + ?, dwell_sum = dwell_sum + ?, dwell_sq = dwell_sq + ? '
+                          'WHERE site = ?', (lon, lat, speed, visits, trips, dwell, dwell_sq, site))
+        lon_sum, lat_sum, count = self.conn.execute('SELECT lon_sum, lat_sum, visits FROM sites WHERE site = ?',
+                                                    (site,)).fetchone()
+        if count > 0:
+            self.conn.execute('UPDATE site_index SET min_lon = ?, max_lon = ?, min_lat = ?, max_lat = ? WHERE site = ?',
+                              (lon_sum / count, lon_sum / count, lat_sum / count, lat_sum / count, site))
@@ -0,0 +1,240 @@
+"""
+File: Persistent store of parsed GPS traces
+Author: JosephGolden, JenniferLiu
+
+Keeps every trip that was ever loaded in one SQLite file, so that the
+raw .txt files do not have to be parsed again to look at a part of
+the map. A trip is stored in blocks of consecutive points, with every
+column of a block kept as one array. An R-tree indexes the box every
+block covers in longitude, latitude and time, so a query only reads
+the blocks that can have points in it.
+"""
+
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from GPS_Helper import load_file
+
+COLUMNS = ['time', 'lon', 'lat', 'speed']
+
+# Points in every block. Smaller blocks fit a query more tightly,
+# bigger blocks make for a smaller index
+BLOCK_SIZE = 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS trips (
+    trip INTEGER PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL,
+    size INTEGER,
+    mtime INTEGER,
+    points INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS blocks (
+    block INTEGER PRIMARY KEY,
+    trip INTEGER NOT NULL REFERENCES trips(trip),
+    first INTEGER NOT NULL,
+    time BLOB NOT NULL,
+    lon BLOB NOT NULL,
+    lat BLOB NOT NULL,
+    speed BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS blocks_trip ON blocks(trip, first);
+CREATE VIRTUAL TABLE IF NOT EXISTS block_index USING rtree(
+    block, min_lon, max_lon, min_lat, max_lat, min_time, max_time
+);
+"""
+
+class TraceStore:
+    """
+    Trips in an SQLite file, that can be queried by bounding box and time
+
+    store = TraceStore('traces.sqlite')
+    store.add_file('Txt/trip.txt')
+    names, dfs = store.query_trips(bbox=(-77.7, 43.0, -77.6, 43.1), time=(141500, 143000))
+    """
+
+    def __init__(self, path='traces.sqlite'):
+        """
+        :param path: The SQLite file, created if it does not exist
+        """
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def add(self, name, df, size=None, mtime=None):
+        """
+        Store a trip, replacing any trip of the same name
+        :param name: Name of the trip, the path of its raw file
+        :param df: DataFrame [time, lon, lat, speed] of the trip
+        :param size: Size of the raw file, to tell if it changed
+        :param mtime: Modification time of the raw file in ns, to tell if it changed
+        :return: Id of the trip
+        """
+        with self.conn:
+            self._remove(name)
+            trip = self.conn.execute('INSERT INTO trips (name, size, mtime, points) VALUES (?, ?, ?, ?)',
+                                     (name, size, mtime, len(df))).lastrowid
+            self._insert_blocks(trip, df, 0)
+        return trip
+
+    def append(self, name, df):
+        """
+        Add points to the end of a trip, for trips that are still
+        being driven. The trip is made if it does not exist yet
+        :param name: Name of the trip
+        :param df: DataFrame [time, lon, lat, speed] of the new points
+        :return: Id of the trip
+        """
+        with self.conn:
+            row = self.conn.execute('SELECT trip, points FROM trips WHERE name = ?', (name,)).fetchone()
+            if row is None:
+                trip, points = self.conn.execute('INSERT INTO trips (name, points) VALUES (?, 0)',
+                                                 (name,)).lastrowid, 0
+            else:
+                trip, points = row
+            self._insert_blocks(trip, df, points)
+            self.conn.execute('UPDATE trips SET points = ? WHERE trip = ?', (points + len(df), trip))
+        return trip
+
+    def add_file(self, file, df=None, engine='numpy'):
+        """
+        Store the trip of a raw file, unless it is stored already
+        and the file has not changed since
+        :param file: The GPS trace file
+        :param df: The file already loaded, None to load it here
+        :param engine: Parser used to load the file, see load_file
+        :return: True if the trip was stored, False if it was up to date
+        """
+        name = os.path.abspath(file)
+        stat = os.stat(file)
+
+        row = self.conn.execute('SELECT size, mtime FROM trips WHERE name = ?', (name,)).fetchone()
+        if row is not None and row == (stat.st_size, stat.st_mtime_ns):
+            return False
+
+        if df is None:
+            df = load_file(file, engine=engine)
+        self.add(name, df, stat.st_size, stat.st_mtime_ns)
+        return True
+
+    def remove(self, name):
+        """
+        Drop a trip from the store
+        :param name: Name of the trip
+        """
+        with self.conn:
+            self._remove(name)
+
+    def trips(self):
+        """
+        :return: DataFrame of the stored trips [trip, name, points]
+        """
+        return pd.read_sql_query('SELECT trip, name, points FROM trips ORDER BY trip', self.conn)
+
+    def query(self, bbox=None, time=None, trips=None):
+        """
+        All the points inside a bounding box and time range
+        :param bbox: (west, south, east, north) in degrees, None for everywhere
+        :param time: (start, end) in the time column of the trips, None for any time
+        :param trips: Ids of the trips to look in, None for every trip
+        :return: DataFrame [trip, time, lon, lat, speed], in trip order
+        """
+        where, params = [], []
+        if bbox is not None:
+            west, south, east, north = bbox
+            where.append('i.max_lon >= ? AND i.min_lon <= ? AND i.max_lat >= ? AND i.min_lat <= ?')
+            params += [west, east, south, north]
+        if time is not None:
+            where.append('i.max_time >= ? AND i.min_time <= ?')
+            params += list(time)
+        if trips is not None:
+            trips = [int(trip) for trip in trips]
+            where.append('b.trip IN ({})'.format(','.join('?' * len(trips))))
+            params += trips
+
+        # Only the blocks that overlap the query are read
+        sql = 'SELECT b.trip, b.time, b.lon, b.lat, b.speed FROM blocks b'
+        if bbox is not None or time is not None:
+            sql += ' JOIN block_index i ON i.block = b.block'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY b.trip, b.first'
+
+        trip_ids, blocks = [], {column: [] for column in COLUMNS}
+        for row in self.conn.execute(sql, params):
+            values = [np.frombuffer(blob, dtype=np.float64) for blob in row[1:]]
+            trip_ids.append(np.full(len(values[0]), row[0], dtype=np.int64))
+            for column, array in zip(COLUMNS, values):
+                blocks[column].append(array)
+
+        df = pd.DataFrame({'trip': np.concatenate(trip_ids + [np.empty(0, dtype=np.int64)])})
+        for column in COLUMNS:
+            df[column] = np.concatenate(blocks[column] + [np.empty(0)])
+
+        # The blocks are only roughly in the box, keep the points that are
+        mask = np.ones(len(df), dtype=bool)
+        if bbox is not None:
+            mask &= df['lon'].between(west, east).to_numpy() & df['lat'].between(south, north).to_numpy()
+        if time is not None:
+            mask &= df['time'].between(*time).to_numpy()
+
+        return df[mask].reset_index(drop=True)
+
+    def query_trips(self, bbox=None, time=None, trips=None):
+        """
+        Same as query, split back into one DataFrame per trip, the way
+        load_files returns them so convert_to_kml can take them
+        :return: the names of the trips, and a DataFrame [time, lon, lat, speed] for each
+        """
+        df = self.query(bbox, time, trips)
+
+        # The points come sorted by trip, so every trip is one slice
+        trip = df['trip'].to_numpy()
+        bounds = np.flatnonzero(np.concatenate([[True], trip[1:] != trip[:-1], [True]]))
+        if len(df) == 0:
+            bounds = np.empty(0, dtype=np.int64)
+
+        names = dict(self.conn.execute('SELECT trip, name FROM trips'))
+        trip_names, dfs = [], []
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            trip_names.append(names[int(trip[start])])
+            dfs.append(df.iloc[start:end][COLUMNS].reset_index(drop=True))
+
+        return trip_names, dfs
+
+    def _insert_blocks(self, trip, df, offset):
+        """
+        Store the points of df in blocks of BLOCK_SIZE, the first
+        of them at position offset of the trip
+        """
+        columns = {column: df[column].to_numpy(dtype=np.float64) for column in COLUMNS}
+
+        for first in range(0, len(df), BLOCK_SIZE):
+            block = {column: values[first:first + BLOCK_SIZE] for column, values in columns.items()}
+            block_id = self.conn.execute(
+                'INSERT INTO blocks (trip, first, time, lon, lat, speed) VALUES (?, ?, ?, ?, ?, ?)',
+                (trip, offset + first) + tuple(block[column].tobytes() for column in COLUMNS)).lastrowid
+            self.conn.execute('INSERT INTO block_index VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (block_id, np.nanmin(block['lon']), np.nanmax(block['lon']),
+                               np.nanmin(block['lat']), np.nanmax(block['lat']),
+                               np.nanmin(block['time']), np.nanmax(block['time'])))
+
+    def _remove(self, name):
+        row = self.conn.execute('SELECT trip FROM trips WHERE name = ?', (name,)).fetchone()
+        if row is None:
+            return
+        self.conn.execute('DELETE FROM block_index WHERE block IN (SELECT block FROM blocks WHERE trip = ?)', row)
+        self.conn.execute('DELETE FROM blocks WHERE trip = ?', row)
+        self.conn.execute('DELETE FROM trips WHERE trip = ?', row)
@@ -0,0 +1,375 @@
+"""
+File: Live GPS stream
+Author: JosephGolden, JenniferLiu
+
+Follows a GPS log while the logger is still writing it, a growing
+file, a pipe or a serial port, and finds the stops and turns as the
+fixes come in instead of once the trip is over. Every line goes
+through the same filters as load_file, one line at a time. Turns are
+found with the rolling window of four fixes that classify_turn looks
+at, so they come out one fix late. Stops are clustered with the same
+DBSCAN as DBScan_Stops, one slow stretch at a time, as soon as the car
+drives off again, or found one fix at a time by DwellStops. A KML file
+of the track, stops and turns so far is rewritten every few seconds,
+with a NetworkLink that Google Earth reloads on the same interval.
+"""
+
+import contextlib
+import io
+import json
+import os
+import stat
+import sys
+import time
+from collections import deque
+from time import perf_counter
+
+import numpy as np
+
+from GPS_Helper import DEDUP_WINDOW, _ParseState, _parse_python, bearing_consecutive
+from GPS_Agglomeration import DBScan_Stops, _wrap_angle
+from GPS_KML import KMLWriter, style_xml, refresh_link_xml, HEADER, FOOTER, YELLOW, RED
+from GPS_Simplify import simplify_polyline
+from GPS_Dwell import DwellStops
+
+def follow(file, poll=0.5, idle_timeout=None):
+    """
+    Lines of a file as they are written, like tail -f. Pipes, FIFOs and
+    serial ports are read until the writer closes them. A regular file
+    is read until it stops growing for idle_timeout seconds, and is read
+    again from the top if it is truncated or replaced
+    :param file: Path of the log, - for standard input
+    :param poll: Seconds between looks at a file that is not growing
+    :param idle_timeout: Stop once a file did not grow for this many seconds, None follows it for ever
+    :return: Generator of whole lines
+    """
+    if file == '-':
+        yield from sys.stdin
+        return
+
+    if not stat.S_ISREG(os.stat(file).st_mode):
+        # Reading blocks until there is a line, and ends with the writer
+        with open(file, errors='replace') as f:
+            yield from f
+        return
+
+    f = open(file, errors='replace')
+    try:
+        partial = ''
+        idle = 0
+        while True:
+            line = f.readline()
+            if line:
+                idle = 0
+                partial += line
+                # The logger may be half way through writing a line
+                if partial.endswith('\n'):
+                    yield partial
+                    partial = ''
+                continue
+
+            try:
+                current = os.stat(file)
+            except FileNotFoundError:
+                current = None
+            if current is not None and (current.st_ino != os.fstat(f.fileno()).st_ino
+                                        or current.st_size < f.tell()):
+                # The log was rotated or started over
+                f.close()
+                f = open(file, errors='replace')
+                partial = ''
+                continue
+
+            if idle_timeout is not None and idle >= idle_timeout:
+                break
+            time.sleep(poll)
+            idle += poll
+
+        # A last line without its newline
+        if partial:
+            yield partial
+    finally:
+        f.close()
+
+class LiveFixes:
+    """
+    The filters of load_file, fed one line at a time. A failing $GPGGA
+    drops the fix before it, so the newest fix is held back until the
+    next line could have dropped it. Duplicate positions are dropped
+    like load_file does, remembering the last dedup_window of them
+    """
+    def __init__(self, hold=1, dedup_window=DEDUP_WINDOW):
+        self.state = _ParseState()
+        self.hold = hold
+        self.dedup_window = dedup_window
+        self.seen = set()
+        self.seen_order = deque()
+
+    def feed(self, line):
+        """
+        :param line: One line of the log
+        :return: The fixes that are final now, as (time, lon, lat, speed)
+        """
+        _parse_python([line], self.state)
+        return self._release(len(self.state.entry['time']) - self.hold)
+
+    def feed_lines(self, lines):
+        """
+        Same as feed for many lines at once, a lot cheaper than a line at a time
+        :param lines: Lines of the log
+        :return: The fixes that are final now, as (time, lon, lat, speed)
+        """
+        _parse_python(lines, self.state)
+        return self._release(len(self.state.entry['time']) - self.hold)
+
+    def flush(self):
+        """
+        The log ended, every fix held back is final
+        """
+        return self._release(len(self.state.entry['time']))
+
+    def _release(self, count):
+        if count <= 0:
+            return []
+        entry = self.state.entry
+        fixes = list(zip(entry['time'][:count], entry['lon'][:count], entry['lat'][:count], entry['speed'][:count]))
+        self.state.entry = {key: value[count:] for key, value in entry.items()}
+
+        new = []
+        for fix in fixes:
+            key = (fix[2], fix[1])
+            if key in self.seen:
+                continue
+            self.seen.add(key)
+            self.seen_order.append(key)
+            new.append(fix)
+        while len(self.seen_order) > self.dedup_window:
+            self.seen.discard(self.seen_order.popleft())
+        return new
+
+class LiveTurns:
+    """
+    classify_turn over a rolling window of four fixes. The change of
+    heading at a fix needs the fix after it, so every turn is found
+    one fix after it happened
+    """
+    def __init__(self):
+        self.window = deque(maxlen=4)
+
+    def feed(self, fix):
+        """
+        :param fix: (time, lon, lat, speed)
+        :return: List with the turn event of the fix before, if it was a turn
+        """
+        self.window.append(fix)
+        if len(self.window) < 4:
+            return []
+
+        _, lon, lat, speed = (np.array(column, dtype=np.float64) for column in zip(*self.window))
+
+        # Headings into the last three fixes, the middle one is the fix looked at
+        heading = bearing_consecutive(lon, lat)
+        delta1 = _wrap_angle(heading[2] - heading[1])
+        delta2 = _wrap_angle(heading[2] - heading[0])
+        delta1 = 0 if abs(delta1) > 150 else delta1
+        delta2 = 0 if abs(delta2) > 150 else delta2
+        delta = (delta1 + delta2) / 2
+
+        if not 20 < abs(delta) < 170:
+            return []
+
+        when, lon, lat, speed = self.window[2]
+        return [{'type': 'turn', 'time': when, 'lon': lon, 'lat': lat, 'speed': speed,
+                 'accel': speed - self.window[1][3], 'heading': float(heading[1]),
+                 'delta': float(delta), 'right': bool(delta < 0)}]
+
+class LiveStops:
+    """
+    DBScan_Stops one slow stretch at a time. The slow fixes are kept
+    until the car has gone faster than max_speed for settle fixes in a
+    row, then that stretch is clustered and its stops come out
+    """
+    def __init__(self, eps=10, min_samples=15, max_speed=10, settle=5, max_points=20000):
+        """
+        :param eps: Neighbourhood radius in meters, like DBScan_Stops
+        :param min_samples: Number of fixes within eps that make a stop, like DBScan_Stops
+        :param max_speed: Fixes faster than this are never part of a stop
+        :param settle: Fast fixes in a row that end a slow stretch
+        :param max_points: A slow stretch this long is clustered without waiting for its end
+        """
+        self.eps = eps
+        self.min_samples = min_samples
+        self.max_speed = max_speed
+        self.settle = settle
+        self.max_points = max_points
+        self.slow = []
+        self.fast = 0
+
+    def feed(self, fix):
+        """
+        :param fix: (time, lon, lat, speed)
+        :return: The stop events of the slow stretch that just ended
+        """
+        if fix[3] <= self.max_speed:
+            self.slow.append(fix)
+            self.fast = 0
+            if len(self.slow) >= self.max_points:
+                return self.flush()
+            return []
+
+        self.fast += 1
+        if self.fast >= self.settle and self.slow:
+            return self.flush()
+        return []
+
+    def flush(self):
+        """
+        Cluster what is left of the slow stretch
+        :return: The stop events found in it
+        """
+        if len(self.slow) < self.min_samples:
+            self.slow = []
+            return []
+
+        coords = np.array(self.slow, dtype=np.float64)
+        self.slow = []
+        with contextlib.redirect_stdout(io.StringIO()):
+            medoids, clusters = DBScan_Stops(coords, self.eps, self.min_samples, self.max_speed)
+
+        events = []
+        for medoid, cluster in zip(medoids.itertuples(), clusters):
+            events.append({'type': 'stop', 'time': float(cluster[:, 0].min()), 'end': float(cluster[:, 0].max()),
+                           'lon': medoid.lon, 'lat': medoid.lat, 'speed': medoid.speed, 'points': len(cluster)})
+        return events
+
+class LiveKML:
+    """
+    KML of the track, stops and turns so far, rewritten at most every
+    interval seconds. The file is replaced in one go, so Google Earth
+    never loads half of it
+    """
+    def __init__(self, path, interval=5, simplify=5):
+        """
+        :param path: The KML file, a NetworkLink to it is written next to it as <name>_link.kml
+        :param interval: Seconds between rewrites, and between reloads of the NetworkLink
+        :param simplify: Tolerance in meters the track is simplified with, 0 writes every fix
+        """
+        self.path = path
+        self.interval = interval
+        self.simplify = simplify
+        self.track = []
+        self.stops = []
+        self.turns = []
+        self.written = None
+
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        link = os.path.splitext(path)[0] + '_link.kml'
+        with open(link, 'w', encoding='utf-8') as f:
+            f.write(HEADER)
+            f.write(refresh_link_xml('Live GPS', os.path.basename(path), interval))
+            f.write(FOOTER)
+        self.write()
+
+    def add_fix(self, fix):
+        self.track.append((fix[1], fix[2], fix[3]))
+
+    def add_event(self, event):
+        coord = (event['lon'], event['lat'], event['speed'])
+        if event['type'] == 'stop':
+            self.stops.append(coord)
+        else:
+            self.turns.append((coord, "Right Turn" if event['right'] else "Left Turn"))
+
+    def refresh(self):
+        """
+        Rewrite the file if the last write is interval seconds old
+        """
+        if perf_counter() - self.written >= self.interval:
+            self.write()
+
+    def write(self):
+        styles = [style_xml('stop', label_color=YELLOW, label_scale=1),
+                  style_xml('turn', label_color=RED, label_scale=1),
+                  style_xml('route', line_color=YELLOW, line_width=5)]
+
+        # KMLWriter only replaces the file once it is complete
+        with KMLWriter(self.path, styles, name='Live GPS') as kml:
+            if len(self.track) > 1:
+                track = np.array(self.track)
+                if self.simplify > 0:
+                    track = simplify_polyline(track, self.simplify)
+                kml.line('Track', track.tolist(), 'route')
+            kml.points("Stop Light", self.stops, 'stop')
+            kml.points([name for _, name in self.turns], [coord for coord, _ in self.turns], 'turn')
+        self.written = perf_counter()
+
+def format_event(event):
+    if event['type'] == 'stop':
+        return 'STOP  {:.1f}-{:.1f}  {:.6f}, {:.6f}  ({} fixes{})'.format(
+            event['time'], event['end'], event['lat'], event['lon'], event['points'],
+            ', {:.1f}s'.format(event['dwell']) if 'dwell' in event else '')
+    return 'TURN  {:.1f}  {:.6f}, {:.6f}  {}'.format(
+        event['time'], event['lat'], event['lon'], 'right' if event['right'] else 'left')
+
+def run(file, kml_path='kml/live.kml', refresh=5, poll=0.5, idle_timeout=None, events_file=None, simplify=5,
+        stop_detector='dbscan'):
+    """
+    Follow a GPS log and report its stops and turns as they happen
+    :param file: Path of the log, a pipe or a serial port, - for standard input
+    :param kml_path: KML file kept up to date with the track, stops and turns
+    :param refresh: Seconds between rewrites of the KML file
+    :param poll: Seconds between looks at a file that is not growing
+    :param idle_timeout: Stop once a file did not grow for this many seconds, None follows it for ever
+    :param events_file: Also write every event to this file as a line of JSON
+    :param simplify: Tolerance in meters the track is simplified with, 0 writes every fix
+    :param stop_detector: 'dbscan' clusters every slow stretch, 'dwell' finds the stops in one pass
+    :return: List of all the events
+    """
+    fixes, turns = LiveFixes(), LiveTurns()
+    stops = DwellStops() if stop_detector == 'dwell' else LiveStops()
+    kml = LiveKML(kml_path, refresh, simplify)
+    events_out = open(events_file, 'a') if events_file is not None else None
+
+    all_events = []
+    latency = []
+    num_fixes = [0]
+
+    def handle(new_fixes, new_events):
+        num_fixes[0] += len(new_fixes)
+        for fix in new_fixes:
+            kml.add_fix(fix)
+            new_events += stops.feed(fix) + turns.feed(fix)
+        for event in new_events:
+            print(format_event(event))
+            kml.add_event(event)
+            if events_out is not None:
+                events_out.write(json.dumps(event) + '\n')
+                events_out.flush()
+        all_events.extend(new_events)
+
+    print('Following ' + file)
+    try:
+        for line in follow(file, poll, idle_timeout):
+            arrived = perf_counter()
+            new_fixes = fixes.feed(line)
+            handle(new_fixes, [])
+            if new_fixes:
+                latency.append(perf_counter() - arrived)
+            kml.refresh()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # Whatever is still held back is final now. The last fixes go
+        # through the stop detector before it is flushed, a trip that
+        # ends parked would lose the end of its last stop otherwise
+        handle(fixes.flush(), [])
+        handle([], stops.flush())
+        kml.write()
+        if events_out is not None:
+            events_out.close()
+
+    print('{} fixes, {} stops, {} turns'.format(num_fixes[0], len(kml.stops), len(kml.turns)))
+    if latency:
+        print('Latency per line with fixes: mean {:.3f} ms, max {:.3f} ms'.format(
+            1000 * np.mean(latency), 1000 * np.max(latency)))
+    return all_events
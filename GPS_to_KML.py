@@ -7,11 +7,12 @@ Objective: Convert a txt file containing GPS data into a .KML file
 """
 
 import argparse
+import sys
 from os.path import join
 import os
 
 # KML Utilities
-import simplekml
+from GPS_KML import KMLWriter, TiledKMLWriter, style_xml, YELLOW, RED
 
 # Aux Lib
 import pandas as pd
@@ -20,27 +21,141 @@ import numpy as np
 
 
 # Own code
-from GPS_Helper import load_file
+from GPS_Helper import load_file, load_files
+from GPS_Cache import TraceCache, ResultCache
+from GPS_Store import TraceStore
+from GPS_Routes import merge_routes
+from GPS_Simplify import simplify_polyline, simplify_trip
+from GPS_Profile import PROFILER
+from GPS_Stream import run as follow_stream
+from GPS_Dwell import dwell_stops, dwell_seconds
+from GPS_Sites import StopSites
 from GPS_Agglomeration import *
 
-def convert_to_kml(file_name, dfs, route_files):
+def convert_to_kml(file_name, dfs, route_files, jobs=1, kml_format='kml', tile_size=None, simplify=5,
+                   files=None, results=None, stop_detector='dbscan', sites=None, merge_sites=True, min_visits=1,
+                   clusters=None, centroids_file=None):
     """
     Create a KML file from the input data. This
     is also the main function that calls
     the classifiers
     :param name: Output file name
     :param df: The data to parse into a KML file
+    :param jobs: Number of processes used for classifying turns. None uses every core
+    :param kml_format: kml, or kmz to zip the output
+    :param tile_size: Split the output into tiles this many degrees wide, None writes one document
+    :param simplify: Tolerance in meters the trips and route lines are simplified with, 0 keeps every point
+    :param files: The file every path was loaded from, needed to reuse results
+    :param results: GPS_Cache.ResultCache to reuse the stops and turns of unchanged files, None finds them all
+    :param stop_detector: 'dbscan' for DBScan_Stops, 'dwell' for the one pass dwell_stops
+    :param sites: GPS_Sites.StopSites the stops are drawn from, None draws the stops of every path
+    :param merge_sites: Merge the stops of the paths into the sites first, only for whole trips
+    :param min_visits: Only draw the sites visited at least this many times
+    :param clusters: Also draw the medoids of this many k-means clusters of every point, None draws none
+    :param centroids_file: Warm start the k-means from the centroids saved in this .npz file, see write_placemarks
     """
-    # All of the points in all of the various paths
-    kml = simplekml.Kml()
-
-    complete_dfs = pd.DataFrame()
+    # Name of the final KML File
+    if file_name.__contains__('/'):
+        kml_path = 'kml/' + str(file_name).split("/")[1].split(".")[0] + "." + kml_format
+    else:
+        kml_path = 'kml/' + str(file_name).split(".")[0] + "." + kml_format
+
+    # Every style is written once, the placemarks refer to it
+    styles = [style_xml('stop', label_color=YELLOW, label_scale=1),
+              style_xml('turn', label_color=RED, label_scale=1),
+              style_xml('route', line_color=YELLOW, line_width=5)]
+    if clusters is not None:
+        styles.append(style_xml('cluster', label_color=YELLOW, label_scale=0.8))
+
+    # The placemarks are written to the file as soon as they are found
+    if tile_size is None:
+        kml = KMLWriter(kml_path, styles, kmz=kml_format == 'kmz')
+    else:
+        kml = TiledKMLWriter(kml_path, styles, kmz=kml_format == 'kmz', tile_size=tile_size)
+    with PROFILER.stage('convert_to_kml', rows=sum(len(df) for df in dfs)):
+        with kml:
+            write_placemarks(kml, dfs, jobs, simplify, files, results, stop_detector, sites, merge_sites, min_visits,
+                             clusters, centroids_file)
 
-    # Stores the agglomerated paths
-    # For each path, create a separate
-    # list, so we do not end up with
-    # lines that are on non-paths
-    segments = []
+def find_stops_and_turns(dfs, files=None, results=None, jobs=1, stop_detector='dbscan'):
+    """
+    Stops and turns of every path. Given a ResultCache, the paths whose
+    file has not changed since the last run reuse what was found then,
+    and only the new and changed files are worked on
+    :param dfs: The data to look for stops and turns in
+    :param files: The file every path was loaded from, needed to reuse results
+    :param results: GPS_Cache.ResultCache, None finds the stops and turns of every path
+    :param jobs: Number of processes used for classifying turns. None uses every core
+    :param stop_detector: 'dbscan' for DBScan_Stops, 'dwell' for the one pass dwell_stops
+    :return: list with an array of stops [lon, lat, speed, dwell] for every path,
+             a DataFrame of all the turns with the index of their path,
+             and the index of every path whose results were not reused
+    """
+    stops = [None] * len(dfs)
+    turns = [None] * len(dfs)
+
+    if results is not None:
+        for index, file in enumerate(files):
+            found = results.get(file)
+            if found is not None:
+                stops[index], turns[index] = found
+    todo = [index for index in range(len(dfs)) if stops[index] is None]
+
+    # Find the stops of every path
+    for index in todo:
+        with PROFILER.for_file(files[index] if files is not None else None):
+            if stop_detector == 'dwell':
+                medoids = dwell_stops(dfs[index].values)
+            else:
+                medoids, clusters = DBScan_Stops(dfs[index].values)
+                # How long every stop lasted, from the first to the last of its points
+                spans = np.array([(cluster[:, 0].min(), cluster[:, 0].max()) for cluster in clusters]).reshape(-1, 2)
+                spans = spans[medoids['index'].to_numpy()]
+                medoids['dwell'] = dwell_seconds(spans[:, 0], spans[:, 1])
+        stops[index] = medoids[['lon', 'lat', 'speed', 'dwell']].values
+
+    # Classify the turns, one trip at a time
+    new_turns = classify_turns_by_trip([dfs[index] for index in todo], jobs=jobs)
+    by_trip = dict(list(new_turns.groupby('trip')))
+    for position, index in enumerate(todo):
+        trip_turns = by_trip.get(position, new_turns.iloc[:0])
+        turns[index] = trip_turns[TURN_COLUMNS].reset_index(drop=True)
+
+    if results is not None:
+        for index in todo:
+            results.put(files[index], stops[index], turns[index])
+        added, changed, removed = results.commit()
+        print('Reused the stops and turns of {} of {} files ({} added, {} changed, {} removed since the last run)'
+              .format(len(dfs) - len(todo), len(dfs), added, changed, removed))
+
+    for trip, trip_turns in enumerate(turns):
+        trip_turns.insert(0, 'trip', trip)
+    if len(turns) == 0:
+        return stops, pd.DataFrame(columns=['trip'] + TURN_COLUMNS), todo
+
+    return stops, pd.concat(turns, ignore_index=True), todo
+
+def write_placemarks(kml, dfs, jobs=1, simplify=5, files=None, results=None, stop_detector='dbscan',
+                     sites=None, merge_sites=True, min_visits=1, clusters=None, centroids_file=None):
+    """
+    Find the stops, turns and routes of the paths, and write
+    them to the KML file as they are found
+    :param kml: The KMLWriter or TiledKMLWriter to write to
+    :param dfs: The data to parse into a KML file
+    :param jobs: Number of processes used for classifying turns. None uses every core
+    :param simplify: Tolerance in meters the trips and route lines are simplified with, 0 keeps every point
+    :param files: The file every path was loaded from, needed to reuse results
+    :param results: GPS_Cache.ResultCache to reuse the stops and turns of unchanged files, None finds them all
+    :param stop_detector: 'dbscan' for DBScan_Stops, 'dwell' for the one pass dwell_stops
+    :param sites: GPS_Sites.StopSites the stops are drawn from, None draws the stops of every path
+    :param merge_sites: Merge the stops of the paths into the sites first, only for whole trips
+    :param min_visits: Only draw the sites visited at least this many times
+    :param clusters: Also draw the medoids of this many k-means clusters of every point, None draws none
+    :param centroids_file: Warm start the k-means from the centroids saved in this .npz file, and
+                           only fit the paths whose results were not reused. None fits every point at once.
+                           The centroids are fit again from scratch when a file changed or was removed,
+                           they can not take out the points of its old version
+    """
 
     # Raw segments are the paths that
     # have no yet been clustered. The problem
@@ -52,12 +167,29 @@ def convert_to_kml(file_name, dfs, route_files):
     #raw_segments = []
 
 
-    # Merge all of the individual dataframe
-    # containing a path from each file
-    # into 1 single DataFrame Object
-    for index, df in enumerate(dfs):
-        complete_dfs = pd.concat([complete_dfs, df], axis=0)
-
+    stops, turns, todo = find_stops_and_turns(dfs, files, results, jobs, stop_detector)
+    found_stops = stops
+
+    # Many trips stop at the same intersections, draw every
+    # stop site once instead of a pin for every stop
+    if sites is not None:
+        if merge_sites:
+            merged, new = 0, 0
+            for name, trip_stops in zip(files, stops):
+                # Same trip name as the trace store gives a file
+                trip = os.path.abspath(name) if os.path.isfile(name) else name
+                counts = sites.add_trip(trip, trip_stops)
+                merged, new = merged + counts[0], new + counts[1]
+            print('Stop sites: {} stops merged into known sites, {} new sites'.format(merged, new))
+
+        # The sites around the paths, the whole fleet's visits included
+        lon = np.concatenate([df['lon'].to_numpy() for df in dfs] + [np.empty(0)])
+        lat = np.concatenate([df['lat'].to_numpy() for df in dfs] + [np.empty(0)])
+        if len(lon) > 0:
+            write_sites(kml, sites, (np.nanmin(lon), np.nanmin(lat), np.nanmax(lon), np.nanmax(lat)), min_visits)
+        stops = []
+
+    for trip_stops in stops:
         """
         raw_segment = []
 
@@ -69,76 +201,117 @@ def convert_to_kml(file_name, dfs, route_files):
         raw_segments += raw_segment
         """
 
-        medoids, clusters = DBScan_Cluster(df.values)
-        
-        # Create a placemark for every stop sign found
-        for medoid_id in range(1, len(medoids)):
-            #print(medoids['lon'][medoid_id])
-            # Only create a stop sign if the cluster
-            # is not empty
-            pnt = kml.newpoint(name="Stop Light")
-            pnt.coords = [(medoids['lon'][medoid_id], medoids['lat'][medoid_id], medoids['speed'][medoid_id])]
-            pnt.style.labelstyle.color = simplekml.Color.yellow
-            pnt.style.labelstyle.scale = 1
-
-    # Classify the turns
-    turns = classify_turn(complete_dfs)
+        # Create a placemark for every stop sign found,
+        # the noise points are not a stop
+        kml.points("Stop Light", trip_stops[:, :3].tolist(), 'stop')
+
     print("Number of turns found")
     print(len(turns))
-    print(turns[:10])
+    print(turns.head(10))
 
     # Create a turn point
     # on the GPS Data
-    for turn in turns:
-        if not turn[-1]:
-            pnt = kml.newpoint(name="Left Turn")
+    names = np.where(turns['right'], "Right Turn", "Left Turn").tolist()
+    kml.points(names, turns[['lon', 'lat', 'speed']].values.tolist(), 'turn')
+
+    # Straight runs of a trip only need their two ends. The stops and
+    # turns were found on every point and stay, the clustering and the
+    # routes after this only get the points that are left
+    if simplify > 0:
+        total = sum(len(df) for df in dfs)
+        by_trip = dict(list(turns.groupby('trip')))
+        simplified = []
+        with PROFILER.stage('simplify_trip', rows=total):
+            for trip, df in enumerate(dfs):
+                keep = [found_stops[trip][:, :2]]
+                if trip in by_trip:
+                    keep.append(by_trip[trip][['lon', 'lat']].to_numpy(dtype=np.float64))
+                # Steps stay shorter than the gaps merge_routes takes for a lost fix
+                simplified.append(simplify_trip(df, simplify, keep=np.concatenate(keep), max_step=100))
+        dfs = simplified
+        kept = sum(len(df) for df in dfs)
+        print('Simplified trips: kept {} of {} points, dropped {}'.format(kept, total, total - kept))
+
+    # Group the points that are next to each other with K-Means. Warm
+    # started, a new trip only moves the centroids of the last run
+    # instead of clustering every point again
+    if clusters is not None:
+        coords = np.concatenate([df.values for df in dfs] + [np.empty((0, 4))])
+        if len(coords) < clusters:
+            print('Not clustering {} points into {} clusters'.format(len(coords), clusters))
         else:
-            pnt = kml.newpoint(name="Right Turn")
-        pnt.coords = [[turn[0], turn[1], turn[2]]]
-        pnt.style.labelstyle.color = simplekml.Color.red
-        pnt.style.labelstyle.scale = 1
-
-    """
-    print("Starting K-Means")
-    # Run K-Means to merge points that are
-    # next to each other. This is to
-    # resolve the issue with multiple GPS Data having
+            fit = np.concatenate([dfs[index].values for index in todo] + [np.empty((0, 4))])
+
+            # The saved centroids hold the points of every file they were
+            # fit with. Only a run that just added files can carry on from
+            # them, otherwise they are thrown away and every point is fit
+            changes = results.changes if results is not None else None
+            if centroids_file is not None and (changes is None or changes[1] > 0 or changes[2] > 0
+                                               or len(todo) == len(dfs)):
+                if os.path.exists(centroids_file):
+                    os.remove(centroids_file)
+                    print('Fitting the k-means centroids again from scratch')
+                fit = None
+
+            with PROFILER.stage('k_means', rows=len(coords if fit is None else fit)):
+                medoids = k_means(coords, clusters, incremental=centroids_file is not None,
+                                  centroids_file=centroids_file, fit=fit)
+            kml.points("Cluster", medoids[['lon', 'lat', 'speed']].values.tolist(), 'cluster')
+
+    # Merge the paths that drove down the same roads,
+    # this is to resolve the issue with multiple GPS Data having
     # very similar paths, but due to DOS, it is slightly off
-    kmeans_clusters = k_means(complete_dfs.values, 200)
-
-    # For each medoid found, add it to the full segments
-    for index in range(1, kmeans_clusters.shape[0]):
-        segments.append([(kmeans_clusters['lon'][index], kmeans_clusters['lat'][index], kmeans_clusters['speed'][index])])
-        #complete_dfs = pd.concat([complete_dfs, cluster], axis=0)
-
-    print(len(segments))
-    #print(segments[:10])
-
-    # Due to issue with line string creating
-    # attempting to connecting
-    # every possible points. There were routes
-    # that didn't make sense
-    # so for every path, create a new linestring object
-    for idx, segment in enumerate(segments):
+    with PROFILER.stage('merge_routes', rows=sum(len(df) for df in dfs)):
+        corridors, corridor_trips = merge_routes(dfs)
+    print("Number of corridors found")
+    print(len(corridors))
+
+    # Straight runs of a route only need their two ends, the
+    # stops and turns were found on every point already
+    if simplify > 0:
+        total = sum(len(corridor) for corridor in corridors)
+        with PROFILER.stage('simplify_polyline', rows=total):
+            corridors = [simplify_polyline(corridor, simplify) for corridor in corridors]
+        kept = sum(len(corridor) for corridor in corridors)
+        print('Simplified routes: kept {} of {} points, dropped {}'.format(kept, total, total - kept))
+
+    # Every corridor is 1 linestring, and is only
+    # drawn once however many paths went down it
+    for idx, (corridor, trips) in enumerate(zip(corridors, corridor_trips)):
         # Set Route Name
-        route_name = 'Route '
-
-        # Creates a linestring object
-        # Sets it to yellow, with a size of 5
-        lin = kml.newlinestring(name=route_name, coords=segment)
-        lin.style.linestyle.color = simplekml.Color.yellow
-        lin.style.linestyle.width = 5
-        lin.altitudemode = simplekml.AltitudeMode.relativetoground
-        lin.extrude = 1
-    """
+        route_name = 'Route ' + str(idx + 1)
 
-    # Save the final KML File
-    if file_name.__contains__('/'):
-        kml.save('kml/' + str(file_name).split("/")[1].split(".")[0] + ".kml")
-    else:
-        kml.save('kml/' + str(file_name).split(".")[0] + ".kml")
+        # Creates a linestring object, yellow with a size of 5
+        kml.line(route_name, corridor.tolist(), 'route',
+                 description='Driven by {} of {} paths'.format(trips, len(dfs)))
 
 
+def write_sites(kml, sites, bbox=None, min_visits=1):
+    """
+    A "Stop Light" placemark for every stop site, out of one query of the site index
+    :param kml: The KMLWriter or TiledKMLWriter to write to
+    :param sites: GPS_Sites.StopSites to draw
+    :param bbox: (west, south, east, north) in degrees, None for every site
+    :param min_visits: Only draw the sites visited at least this many times
+    :return: Number of sites drawn
+    """
+    found = sites.query(bbox, min_visits)
+    descriptions = ['Stopped here {} times on {} trips, for {:.0f}s on average (+/- {:.0f}s)'.format(
+        visits, trips, mean, std) for visits, trips, mean, std in
+        zip(found['visits'], found['trips'], found['dwell_mean'], found['dwell_std'])]
+    kml.points("Stop Light", found[['lon', 'lat', 'speed']].values.tolist(), 'stop', descriptions)
+    print('Drew {} stop sites'.format(len(found)))
+    return len(found)
+
+def float_list(text):
+    """
+    Argument type for a comma separated list of numbers
+    """
+    try:
+        return tuple(float(value) for value in text.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError('expected comma separated numbers, got ' + text)
+
 if __name__=="__main__":
     """
     Read the files that user specified for turning it into 
@@ -147,46 +320,174 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser(usage='Parse GPS data and create 1 single KML file')
     parser.add_argument('-f', '--file', type=str, help='File to parse')
     parser.add_argument('-d', '--dir', type=str, help='Directory to parse')
+    parser.add_argument('-e', '--engine', type=str, default='numpy', choices=['numpy', 'python'],
+                        help='Parser used to load the GPS files')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='Number of processes used to load the files and classify turns, 0 uses every core')
+    parser.add_argument('--no-cache', action='store_true', help='Always parse the raw files, skip the trace cache')
+    parser.add_argument('--rebuild-cache', action='store_true', help='Parse the raw files again and refresh the trace cache')
+    parser.add_argument('--cache-dir', type=str, default='.gps_cache', help='Where the trace cache lives')
+    parser.add_argument('--cache-size', type=int, default=512, help='Size limit of the trace cache in MB')
+    parser.add_argument('--format', type=str, default='kml', choices=['kml', 'kmz'],
+                        help='Write a plain .kml, or zip it into a .kmz')
+    parser.add_argument('--tiles', type=float, default=None, metavar='DEGREES',
+                        help='Split the output into tiles this many degrees wide, that are only loaded when on screen')
+    parser.add_argument('--simplify', type=float, default=5, metavar='METERS',
+                        help='Simplify the trips and route lines to within this many meters, 0 keeps every point')
+    parser.add_argument('-s', '--store', type=str, help='Trace store the loaded files are added to, and queried from')
+    parser.add_argument('--bbox', type=float_list, metavar='WEST,SOUTH,EAST,NORTH',
+                        help='Only the points of the trace store inside this box')
+    parser.add_argument('--time', type=float_list, metavar='START,END',
+                        help='Only the points of the trace store between these times')
+    parser.add_argument('--stops', type=str, default='dbscan', choices=['dbscan', 'dwell'],
+                        help='Find the stops with DBSCAN over the whole trace, or in one pass over the fixes')
+    parser.add_argument('--sites', type=str, metavar='SQLITE',
+                        help='Stop site index the stops of every trip are merged into, and drawn from. '
+                             'Given on its own, draws every site in it to kml/stop_sites.kml')
+    parser.add_argument('--site-radius', type=float, default=25,
+                        help='Meters from a stop site that a stop still counts as a visit of it')
+    parser.add_argument('--min-visits', type=int, default=1, help='Only draw the stop sites visited this many times')
+    parser.add_argument('-i', '--incremental', action='store_true',
+                        help='Reuse the stops and turns of the files that did not change since the last run')
+    parser.add_argument('--clusters', type=int, default=None, metavar='N',
+                        help='Also draw the medoids of N k-means clusters of every point. With -i the centroids '
+                             'are saved, and the next run only fits the files that were added or changed')
+    parser.add_argument('--follow', type=str, metavar='LOG',
+                        help='Follow a log that is still being written, a file, pipe or serial port, - for stdin, '
+                             'and report its stops and turns as they happen')
+    parser.add_argument('--refresh', type=float, default=5,
+                        help='Seconds between rewrites of kml/live.kml while following a log')
+    parser.add_argument('--idle-timeout', type=float, default=None,
+                        help='Stop following a file once it did not grow for this many seconds')
+    parser.add_argument('--events', type=str, help='Also write the events of a followed log to this JSON lines file')
+    parser.add_argument('--profile', nargs='?', const='', default=None, metavar='JSON',
+                        help='Print the time and memory of every stage, and write them to this JSON file if given')
     args = parser.parse_args()
 
+    query = args.bbox is not None or args.time is not None
+    if args.bbox is not None and len(args.bbox) != 4:
+        parser.error('--bbox needs WEST,SOUTH,EAST,NORTH')
+    if args.time is not None and len(args.time) != 2:
+        parser.error('--time needs START,END')
+    if query and args.store is None:
+        parser.error('--bbox and --time query the trace store, give it with --store')
+    if args.tiles is not None and args.tiles <= 0:
+        parser.error('--tiles needs a tile size above 0 degrees')
+    if args.jobs < 0:
+        parser.error('--jobs needs 0 for every core, or a number of processes')
+    if args.cache_size < 0:
+        parser.error('--cache-size can not be negative')
+    if args.simplify < 0:
+        parser.error('--simplify can not be negative, 0 keeps every point')
+    if args.site_radius <= 0:
+        parser.error('--site-radius needs a radius above 0 meters')
+    if args.min_visits < 0:
+        parser.error('--min-visits can not be negative')
+    if args.clusters is not None and args.clusters <= 0:
+        parser.error('--clusters needs at least 1 cluster')
+    if args.refresh <= 0:
+        parser.error('--refresh needs a number of seconds above 0')
+    if args.idle_timeout is not None and args.idle_timeout <= 0:
+        parser.error('--idle-timeout needs a number of seconds above 0')
+
+    if args.jobs == 0:
+        args.jobs = None
+
+    # Live mode, everything is found as the log is written
+    if args.follow is not None:
+        follow_stream(args.follow, 'kml/live.kml', refresh=args.refresh, idle_timeout=args.idle_timeout,
+                      events_file=args.events, simplify=args.simplify, stop_detector=args.stops)
+        sys.exit(0)
+
+    if args.profile is not None:
+        PROFILER.enable()
+
+    cache = None
+    if not args.no_cache:
+        cache = TraceCache(args.cache_dir, args.cache_size * 1024 * 1024)
+
     # Parsing single file
     if args.file is not None:
-        df = load_file(args.file)
-        convert_to_kml(args.file, [df], [args.file])
+        with PROFILER.stage('load_file', file=args.file) as record:
+            if cache is None:
+                df = load_file(args.file, engine=args.engine)
+            else:
+                df = cache.load(args.file, engine=args.engine, rebuild=args.rebuild_cache)
+                cache.prune_keys()
+            record['rows'] = len(df)
+        file_name, all_dfs, loaded = args.file, [df], [args.file]
     elif args.dir is not None:
         files = [f for f in os.listdir(args.dir) if os.path.isfile(join(args.dir, f))]
 
         # Name of destination path
         des_path = 'Kml/assimilated_'
 
-        # Merge all df into 1 single df
-        all_dfs = []
-
-        # Route Files
-        route_files = []
-
-        for file in files:
-            filename = str(os.fsdecode(file))
-
-            # The real path, with necessary appending
-            realPath = 'Txt/' + filename
-
-            # If the file ends with .txt, it is a permissible file
-            if filename.lower().endswith('.txt'):
-                # Append route file
-                route_files.append(filename)
-
-                # Convert a GPS file into DataFrame object
-                df = load_file(realPath)
-
-                # Create a list of dataframes object for
-                # each path
-                all_dfs.append(df)
-
-                # Concatenate all of the individual df from each
-                # file into one big one
-                print("File: " + filename)
-
-        convert_to_kml(des_path, all_dfs, route_files)
-
-
+        # If the file ends with .txt, it is a permissible file
+        txt_files = [join(args.dir, str(os.fsdecode(f))) for f in files if str(os.fsdecode(f)).lower().endswith('.txt')]
+
+        # Convert every GPS file into DataFrame object, and
+        # create a list of dataframes object for each path.
+        # The files come back sorted by name whatever the number of jobs
+        all_dfs, loaded = load_files(txt_files, engine=args.engine, jobs=args.jobs,
+                                     cache=cache, rebuild_cache=args.rebuild_cache)
+        file_name = des_path
+    elif args.store is not None:
+        # Everything comes out of the trace store
+        file_name, all_dfs, loaded = 'Kml/store_query', None, []
+    elif args.sites is not None:
+        # Only the stop sites, one query of the site index
+        styles = [style_xml('stop', label_color=YELLOW, label_scale=1)]
+        kml_path = 'kml/stop_sites.' + args.format
+        if args.tiles is None:
+            kml = KMLWriter(kml_path, styles, kmz=args.format == 'kmz')
+        else:
+            kml = TiledKMLWriter(kml_path, styles, kmz=args.format == 'kmz', tile_size=args.tiles)
+        with StopSites(args.sites, args.site_radius) as sites, kml:
+            write_sites(kml, sites, args.bbox, args.min_visits)
+        print('Stop sites written to ' + kml_path)
+        sys.exit(0)
+    else:
+        parser.error('give a file with -f, a directory with -d, or a trace store with --store')
+
+    if args.store is not None:
+        with TraceStore(args.store) as store:
+            # Only files that are new or changed are stored again
+            for file, df in zip(loaded, all_dfs or []):
+                store.add_file(file, df)
+
+            # Only the trips and points that fall in the query
+            if query or all_dfs is None:
+                loaded, all_dfs = store.query_trips(bbox=args.bbox, time=args.time)
+                print('Trace store query: {} points in {} trips'.format(sum(len(df) for df in all_dfs), len(all_dfs)))
+
+    # Results can only be reused for whole files, not for a part of the store
+    results = None
+    if args.incremental and not query and (args.file is not None or args.dir is not None):
+        results = ResultCache(args.cache_dir, {'stops': args.stops})
+
+    # The centroids live next to the results they were fit together with
+    centroids_file = None
+    if results is not None and args.clusters is not None:
+        os.makedirs(args.cache_dir, exist_ok=True)
+        centroids_file = join(args.cache_dir, 'kmeans_{}.npz'.format(args.clusters))
+
+    # Route Files
+    route_files = [os.path.basename(f) for f in loaded]
+
+    # Parts of trips out of the store would take the rest of their
+    # stops out of the site index, those only draw from it
+    sites = StopSites(args.sites, args.site_radius) if args.sites is not None else None
+
+    convert_to_kml(file_name, all_dfs, route_files, jobs=args.jobs, kml_format=args.format,
+                   tile_size=args.tiles, simplify=args.simplify, files=loaded, results=results,
+                   stop_detector=args.stops, sites=sites, merge_sites=not query, min_visits=args.min_visits,
+                   clusters=args.clusters, centroids_file=centroids_file)
+
+    if sites is not None:
+        sites.close()
+
+    if args.profile is not None:
+        PROFILER.report()
+        if args.profile:
+            PROFILER.dump(args.profile)
+            print('Profile written to ' + args.profile)
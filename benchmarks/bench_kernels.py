@@ -0,0 +1,81 @@
+"""
+File: Micro-benchmark of the distance and bearing kernels
+Author: JosephGolden, JenniferLiu
+
+Times the per point math loops that the pipeline used to run against
+the NumPy kernels in GPS_Helper, on the sample traces.
+
+python benchmarks/bench_kernels.py [trace files...]
+"""
+
+import contextlib
+import io
+import math
+import os
+import sys
+import timeit
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from GPS_Helper import load_file, haversine_array, haversine_consecutive, bearing_consecutive
+
+SAMPLES = [os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'sample_kml', name)
+           for name in ('ZJ42_EC0_to_RIT.TXT', 'ZJ42_L2C_trip_home.TXT')]
+
+def math_haversine(lon1, lat1, lon2, lat2):
+    # The scalar formula, as it was before the kernels
+    phi_1 = math.radians(lat1)
+    phi_2 = math.radians(lat2)
+    delta_phi = math.radians(lat2 - lat1)
+    delta_lambda = math.radians(lon2 - lon1)
+    a = math.sin(delta_phi / 2.0) ** 2 + math.cos(phi_1) * math.cos(phi_2) * math.sin(delta_lambda / 2.0) ** 2
+    return 6371000 * (2 * math.atan2(math.sqrt(a), math.sqrt(1 - a)))
+
+def math_bearing(x_lon, x_lat, y_lon, y_lat):
+    dy = y_lat - x_lat
+    dx = math.cos(math.pi / 180 * x_lat) * (y_lon - x_lon)
+    return round(math.degrees(math.atan2(dy, dx)), 2)
+
+def best_of(func, repeat=5):
+    """
+    :return: Fastest of repeat runs, in seconds
+    """
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+def bench(file):
+    with contextlib.redirect_stdout(io.StringIO()):
+        df = load_file(file)
+
+    lon = df['lon'].to_numpy()
+    lat = df['lat'].to_numpy()
+    lons, lats = lon.tolist(), lat.tolist()
+    n = len(lons)
+
+    cases = [
+        ('consecutive distance',
+         lambda: [math_haversine(lons[i], lats[i], lons[i + 1], lats[i + 1]) for i in range(n - 1)],
+         lambda: haversine_consecutive(lon, lat)),
+        ('distance to a point',
+         lambda: [math_haversine(lons[i], lats[i], lons[0], lats[0]) for i in range(n)],
+         lambda: haversine_array(lon, lat, lon[0], lat[0])),
+        ('consecutive bearing',
+         lambda: [math_bearing(lons[i], lats[i], lons[i + 1], lats[i + 1]) for i in range(n - 1)],
+         lambda: bearing_consecutive(lon, lat)),
+    ]
+
+    print('{} ({} points)'.format(os.path.basename(file), n))
+    print('  {:<22}{:>12}{:>12}{:>10}'.format('kernel', 'loop ms', 'numpy ms', 'speedup'))
+    for name, loop, vectorized in cases:
+        # Both versions must agree before their timings mean anything
+        assert np.allclose(loop(), vectorized(), rtol=0, atol=1e-6)
+
+        loop_time = best_of(loop)
+        numpy_time = best_of(vectorized)
+        print('  {:<22}{:>12.3f}{:>12.3f}{:>9.1f}x'.format(name, loop_time * 1000, numpy_time * 1000,
+                                                           loop_time / numpy_time))
+
+if __name__ == "__main__":
+    for file in sys.argv[1:] or SAMPLES:
+        bench(file)
@@ -0,0 +1,62 @@
+"""
+File: Benchmark of the stop detection
+Author: JosephGolden, JenniferLiu
+
+Times DBScan_Cluster, the manhattan DBSCAN over every point, against
+DBScan_Stops, the haversine DBSCAN over the slow points, on the sample
+traces and on a synthetic log of many points from nmea_synth, the same
+logs bench_suite runs on.
+
+python benchmarks/bench_stops.py [--points N] [trace files...]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from GPS_Helper import load_file
+from GPS_Agglomeration import DBScan_Cluster, DBScan_Stops
+from nmea_synth import cached_trace
+
+SAMPLES = [os.path.join(HERE, '..', 'sample_kml', name)
+           for name in ('ZJ42_EC0_to_RIT.TXT', 'ZJ42_L2C_trip_home.TXT')]
+
+# DBScan_Cluster keeps every point in memory several times over,
+# so it is left out of the runs above this many points
+MAX_OLD_POINTS = 1000000
+
+def timed(func, coords):
+    """
+    :return: Seconds taken, number of stops found
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = perf_counter()
+        medoids, clusters = func(coords)
+        return perf_counter() - start, len(clusters)
+
+def bench(name, coords):
+    print('{} ({} points)'.format(name, len(coords)))
+    for func in (DBScan_Cluster, DBScan_Stops):
+        if func is DBScan_Cluster and len(coords) > MAX_OLD_POINTS:
+            print('  {:<16}{:>12}'.format(func.__name__, 'skipped'))
+            continue
+        seconds, stops = timed(func, coords)
+        print('  {:<16}{:>10.3f} s{:>8} clusters'.format(func.__name__, seconds, stops))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=10000000, help='Fixes in the synthetic log')
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'data'), help='Where the synthetic logs are kept')
+    parser.add_argument('files', nargs='*', default=SAMPLES)
+    args = parser.parse_args()
+
+    for file in args.files + [cached_trace(args.points, args.data_dir)]:
+        with contextlib.redirect_stdout(io.StringIO()):
+            df = load_file(file)
+        bench(os.path.basename(file), df.values)
@@ -0,0 +1,176 @@
+"""
+File: Benchmark suite of the whole pipeline
+Author: JosephGolden, JenniferLiu
+
+Times every stage of the pipeline on synthetic logs from nmea_synth,
+10 thousand, 1 million and 10 million fixes by default. The logs are
+written once into benchmarks/data and reused after that. Every run is
+added as one line to benchmarks/results.jsonl, and compared with the
+last run on the same machine. A stage that got slower than the
+tolerance is a regression, and makes the suite exit with status 1.
+
+python benchmarks/bench_suite.py [--sizes 10000,1000000] [--repeat 3] [--tolerance 1.25]
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+from time import perf_counter
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from GPS_Helper import load_file
+from GPS_Agglomeration import DBScan_Cluster, DBScan_Stops, get_medoid, classify_turn
+from GPS_Dwell import dwell_stops
+from GPS_to_KML import convert_to_kml
+from bench_stops import MAX_OLD_POINTS
+from nmea_synth import cached_trace
+
+SIZES = [10000, 1000000, 10000000]
+
+# Stages bigger than this are only run once, they take long enough
+# for one run to be steady
+MAX_REPEAT_POINTS = 1000000
+
+# Differences smaller than this are noise, whatever the ratio
+MIN_SECONDS = 0.005
+
+def timed(func, repeat):
+    """
+    Run func repeat times, with its prints muted
+    :return: Fastest run in seconds, and what the last run returned
+    """
+    best = None
+    for _ in range(repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = perf_counter()
+            result = func()
+            seconds = perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best, result
+
+def write_kml(df):
+    """
+    The whole KML output of one trip, stops, turns and routes
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        cwd = os.getcwd()
+        os.chdir(tmp)
+        try:
+            os.makedirs('kml')
+            convert_to_kml('bench', [df], ['bench'])
+            return os.path.getsize(os.path.join('kml', 'bench.kml'))
+        finally:
+            os.chdir(cwd)
+
+def bench(points, data_dir, repeat):
+    """
+    Time every stage on a synthetic log
+    :return: dict of stage to seconds, the number of rows the log parsed to,
+             and the stages that were left out at this size
+    """
+    path = cached_trace(points, data_dir)
+    repeat = repeat if points <= MAX_REPEAT_POINTS else 1
+
+    times = {}
+    skipped = []
+    times['load_file'], df = timed(lambda: load_file(path), repeat)
+    coords = df.values
+
+    if len(coords) <= MAX_OLD_POINTS:
+        times['DBScan_Cluster'], _ = timed(lambda: DBScan_Cluster(coords), repeat)
+    else:
+        skipped.append('DBScan_Cluster')
+    times['DBScan_Stops'], (medoids, clusters) = timed(lambda: DBScan_Stops(coords), repeat)
+    times['get_medoid'], _ = timed(lambda: get_medoid(clusters), repeat)
+    times['dwell_stops'], _ = timed(lambda: dwell_stops(coords), repeat)
+    times['classify_turn'], _ = timed(lambda: classify_turn(df), repeat)
+    times['kml_output'], _ = timed(lambda: write_kml(df), repeat)
+
+    return times, len(df), skipped
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def last_run(results_file, host, points):
+    """
+    The latest stored run on this machine with this many points
+    """
+    last = None
+    try:
+        with open(results_file) as f:
+            for line in f:
+                run = json.loads(line)
+                if run['host'] == host and run['points'] == points:
+                    last = run
+    except (OSError, ValueError):
+        pass
+    return last
+
+def compare(times, before, tolerance):
+    """
+    Print every stage next to the last run
+    :return: the stages that got slower than the tolerance
+    """
+    slower = []
+    print('  {:<16}{:>12}{:>12}{:>9}'.format('stage', 'seconds', 'before', 'ratio'))
+    for stage, seconds in times.items():
+        was = before['times'].get(stage) if before else None
+        if was is None:
+            print('  {:<16}{:>12.4f}{:>12}{:>9}'.format(stage, seconds, '-', '-'))
+            continue
+        ratio = seconds / was if was > 0 else float('inf')
+        flag = ''
+        if ratio > tolerance and seconds - was > MIN_SECONDS:
+            flag = '  REGRESSION'
+            slower.append(stage)
+        print('  {:<16}{:>12.4f}{:>12.4f}{:>8.2f}x{}'.format(stage, seconds, was, ratio, flag))
+    return slower
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=lambda text: [int(size) for size in text.split(',')], default=SIZES,
+                        help='Comma separated numbers of fixes in the synthetic logs')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every stage, the fastest counts')
+    parser.add_argument('--tolerance', type=float, default=1.25, help='Slowdown that counts as a regression')
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'data'), help='Where the synthetic logs are kept')
+    parser.add_argument('--results', default=os.path.join(HERE, 'results.jsonl'), help='History of the runs')
+    parser.add_argument('--no-save', action='store_true', help='Compare with the history, but do not add to it')
+    args = parser.parse_args()
+
+    host = platform.node()
+    regressions = []
+    for points in args.sizes:
+        times, rows, skipped = bench(points, args.data_dir, args.repeat)
+        before = last_run(args.results, host, points)
+
+        print('{} fixes, {} rows after parsing{}'.format(
+            points, rows, ', last run {}'.format(before['date']) if before else ''))
+        regressions += ['{} at {}'.format(stage, points) for stage in compare(times, before, args.tolerance)]
+        for stage in skipped:
+            print('  {:<16}{:>12}  (more than {} points)'.format(stage, 'skipped', MAX_OLD_POINTS))
+
+        if not args.no_save:
+            run = {'date': datetime.datetime.now().isoformat(timespec='seconds'), 'host': host,
+                   'revision': git_revision(), 'python': platform.python_version(), 'numpy': np.__version__,
+                   'points': points, 'rows': rows, 'repeat': args.repeat, 'times': times, 'skipped': skipped}
+            with open(args.results, 'a') as f:
+                f.write(json.dumps(run) + '\n')
+
+    if regressions:
+        print('Regressions: ' + ', '.join(regressions))
+        sys.exit(1)
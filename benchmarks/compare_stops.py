@@ -0,0 +1,112 @@
+"""
+File: One pass stops against DBSCAN
+Author: JosephGolden, JenniferLiu
+
+Finds the stops of every trace with DBScan_Stops and with dwell_stops
+and matches them up. A dwell stop matches a DBSCAN stop when their
+medoids are within --match meters and their times overlap. Prints how
+many stops each found, the ones only one of them found, how far apart
+the matched medoids are, and how long each took.
+
+python benchmarks/compare_stops.py [--points 1000000] [--match 25] [trace files...]
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+from time import perf_counter
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from GPS_Helper import load_file, haversine_array
+from GPS_Agglomeration import DBScan_Stops
+from GPS_Dwell import dwell_stops
+from nmea_synth import cached_trace
+
+SAMPLES = [os.path.join(HERE, '..', 'sample_kml', name)
+           for name in ('ZJ42_EC0_to_RIT.TXT', 'ZJ42_L2C_trip_home.TXT')]
+
+def dbscan_stops(coords):
+    """
+    DBScan_Stops with the start and end of every stop
+    :return: array of [lon, lat, start, end]
+    """
+    medoids, clusters = DBScan_Stops(coords)
+    spans = [(cluster[:, 0].min(), cluster[:, 0].max()) for cluster in clusters]
+    # The medoids drop duplicated coordinates, keep the spans that go with them
+    spans = np.array(spans).reshape(-1, 2)[medoids['index'].values]
+    return np.column_stack([medoids['lon'].values, medoids['lat'].values, spans])
+
+def match(found, expected, meters):
+    """
+    Pair every expected stop with a found stop close by that overlaps it in time
+    :return: list of (expected, found) index pairs, each stop is used at most once
+    """
+    pairs, used = [], set()
+    for e, (lon, lat, start, end) in enumerate(expected):
+        if len(found) == 0:
+            break
+        dist = haversine_array(found[:, 0], found[:, 1], lon, lat)
+        overlap = (found[:, 2] <= end) & (found[:, 3] >= start)
+        for f in np.argsort(dist):
+            if dist[f] > meters:
+                break
+            if overlap[f] and f not in used:
+                pairs.append((e, f))
+                used.add(f)
+                break
+    return pairs
+
+def compare(name, coords, meters):
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = perf_counter()
+        expected = dbscan_stops(coords)
+        dbscan_seconds = perf_counter() - start
+
+        start = perf_counter()
+        stops = dwell_stops(coords)
+        dwell_seconds = perf_counter() - start
+    found = stops[['lon', 'lat', 'start', 'end']].values
+
+    pairs = match(found, expected, meters)
+    offsets = [float(haversine_array(found[f, 0], found[f, 1], expected[e, 0], expected[e, 1])) for e, f in pairs]
+
+    print('{}: {} fixes'.format(name, len(coords)))
+    print('  DBSCAN {} stops in {:.3f}s, one pass {} stops in {:.3f}s'.format(
+        len(expected), dbscan_seconds, len(found), dwell_seconds))
+    print('  matched {}, DBSCAN only {}, one pass only {}, medoids apart median {:.1f} m, max {:.1f} m'.format(
+        len(pairs), len(expected) - len(pairs), len(found) - len(pairs),
+        np.median(offsets) if offsets else 0, max(offsets, default=0)))
+
+    matched = {e for e, _ in pairs}
+    for e in range(len(expected)):
+        if e not in matched:
+            print('  DBSCAN only: {:.1f}-{:.1f} at {:.6f}, {:.6f}'.format(
+                expected[e, 2], expected[e, 3], expected[e, 1], expected[e, 0]))
+    return len(expected), len(found), len(pairs)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=None, help='Also compare on a synthetic log of this many fixes')
+    parser.add_argument('--match', type=float, default=25, help='Meters between medoids that still match')
+    parser.add_argument('--data-dir', default=os.path.join(HERE, 'data'), help='Where the synthetic logs are kept')
+    parser.add_argument('files', nargs='*', default=SAMPLES)
+    args = parser.parse_args()
+
+    files = list(args.files)
+    if args.points is not None:
+        files.append(cached_trace(args.points, args.data_dir))
+
+    totals = np.zeros(3, dtype=int)
+    for file in files:
+        with contextlib.redirect_stdout(io.StringIO()):
+            df = load_file(file)
+        totals += compare(os.path.basename(file), df.values, args.match)
+
+    print('Total: DBSCAN {} stops, one pass {} stops, {} matched ({:.0%} of the DBSCAN stops)'.format(
+        totals[0], totals[1], totals[2], totals[2] / max(totals[0], 1)))
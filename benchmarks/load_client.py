@@ -0,0 +1,192 @@
+"""
+File: Load generator for the ingest server
+Author: JosephGolden, JenniferLiu
+
+Replays GPS logs into GPS_Server.py as a fleet of vehicles, each on
+its own connection, at some multiple of real time going by the times
+in the logs. With --server an ingest server is started in the same
+process on --port, or a free port, and a scratch store, so one command
+shows how many fixes a second make it all the way into the store.
+
+python benchmarks/load_client.py --server --vehicles 50 --speed 100
+python benchmarks/load_client.py --host 127.0.0.1 --port 9000 --vehicles 10 --speed 1
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+from time import perf_counter
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+from GPS_Server import serve
+from GPS_Store import TraceStore
+from GPS_Sites import StopSites
+
+SAMPLES = [os.path.join(HERE, '..', 'sample_kml', name)
+           for name in ('ZJ42_EC0_to_RIT.TXT', 'ZJ42_L2C_trip_home.TXT')]
+
+def line_times(lines):
+    """
+    Seconds into the log of every line, from the hhmmss.sss time of its
+    sentence. Lines without a time are sent with the line before them
+    :return: list of seconds
+    """
+    times, last = [], None
+    for line in lines:
+        fields = line.split(',', 2)
+        try:
+            clock = float(fields[1]) if line.startswith('$GP') else None
+        except (IndexError, ValueError):
+            clock = None
+        if clock is not None:
+            hours, rest = divmod(clock, 10000)
+            minutes, seconds = divmod(rest, 100)
+            now = hours * 3600 + minutes * 60 + seconds
+            # Past midnight the clock starts over
+            if last is not None and now < last - 43200:
+                now += 86400
+            last = now
+        times.append(last)
+
+    first = next((t for t in times if t is not None), 0)
+    return [0.0 if t is None else t - first for t in times]
+
+async def replay(name, lines, times, speed, send, batch_seconds=0.05):
+    """
+    Send the lines of one log at speed times real time
+    :param send: Coroutine that sends a list of lines
+    :param batch_seconds: Lines due within this many seconds of each other are sent together
+    :return: Number of lines sent
+    """
+    start = perf_counter()
+    i = 0
+    while i < len(lines):
+        due = times[i] / speed if speed > 0 else 0
+        wait = due - (perf_counter() - start)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+        # Everything that is due by now goes in one send
+        now = perf_counter() - start + batch_seconds
+        j = i + 1
+        while j < len(lines) and (speed <= 0 and j - i < 200 or speed > 0 and times[j] / speed <= now):
+            j += 1
+        await send(lines[i:j])
+        i = j
+    return len(lines)
+
+async def tcp_vehicle(name, lines, times, speed, host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write('VEHICLE {}\n'.format(name).encode())
+
+    async def send(batch):
+        writer.write(''.join(batch).encode())
+        # Waits while the server is not reading, that is the backpressure
+        await writer.drain()
+
+    sent = await replay(name, lines, times, speed, send)
+    writer.close()
+    await writer.wait_closed()
+    return sent
+
+async def udp_vehicle(name, lines, times, speed, host, port):
+    loop = asyncio.get_running_loop()
+    transport, _ = await loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+    header = 'VEHICLE {}\n'.format(name)
+
+    async def send(batch):
+        # Keep every datagram well under the size of a packet
+        for lo in range(0, len(batch), 15):
+            transport.sendto((header + ''.join(batch[lo:lo + 15])).encode())
+            # Let the server, when it runs in this process, take it
+            await asyncio.sleep(0)
+
+    sent = await replay(name, lines, times, speed, send)
+    transport.close()
+    return sent
+
+async def run(files, vehicles, speed, host, port, protocol):
+    logs = []
+    for file in files:
+        with open(file, errors='replace') as f:
+            lines = f.readlines()
+        logs.append((lines, line_times(lines)))
+
+    vehicle = tcp_vehicle if protocol == 'tcp' else udp_vehicle
+    start = perf_counter()
+    sent = await asyncio.gather(*(vehicle('bench{}'.format(v), *logs[v % len(logs)], speed, host, port)
+                                  for v in range(vehicles)))
+    seconds = perf_counter() - start
+    print('Sent {} lines from {} vehicles in {:.2f}s, {:.0f} lines/s'.format(
+        sum(sent), vehicles, seconds, sum(sent) / seconds))
+    return sum(sent), seconds
+
+async def with_server(args):
+    """
+    Start an ingest server, replay the fleet into it, and
+    count what made it into the store
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        store_path = os.path.join(tmp, 'fleet.sqlite')
+        sites_path = os.path.join(tmp, 'sites.sqlite') if args.sites else None
+
+        # Ask the OS for a free port, unless one was given
+        port = args.port
+        if port is None:
+            with socket.socket() as probe:
+                probe.bind((args.host, 0))
+                port = probe.getsockname()[1]
+
+        address = (args.host, port)
+        server = asyncio.create_task(serve(tcp=address if args.protocol == 'tcp' else None,
+                                           udp=address if args.protocol == 'udp' else None,
+                                           report_every=args.report, duration=None, store_path=store_path,
+                                           batch_size=args.batch, queue_size=args.queue, sites_path=sites_path))
+        await asyncio.sleep(0.5)
+
+        start = perf_counter()
+        await run(args.files, args.vehicles, args.speed, args.host, port, args.protocol)
+
+        # Give the server a moment to take the last datagrams
+        await asyncio.sleep(0.5)
+        server.cancel()
+        try:
+            await server
+        except asyncio.CancelledError:
+            pass
+        seconds = perf_counter() - start
+
+        with TraceStore(store_path) as store:
+            trips = store.trips()
+        print('Stored {} fixes in {} trips, {:.0f} fixes/s end to end'.format(
+            trips['points'].sum(), len(trips), trips['points'].sum() / seconds))
+        if sites_path is not None:
+            with StopSites(sites_path) as sites:
+                found = sites.query()
+            print('Merged {} stops into {} stop sites'.format(found['visits'].sum(), len(found)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=None,
+                        help='Port of the server, 9000 by default. With --server a free port by default')
+    parser.add_argument('--protocol', choices=['tcp', 'udp'], default='tcp')
+    parser.add_argument('--vehicles', type=int, default=10, help='Vehicles sending at the same time')
+    parser.add_argument('--speed', type=float, default=10, help='Times real time, 0 sends as fast as possible')
+    parser.add_argument('--server', action='store_true', help='Start an ingest server in this process to send to')
+    parser.add_argument('--batch', type=int, default=500, help='Batch size of the server started with --server')
+    parser.add_argument('--queue', type=int, default=64, help='Queue size of the server started with --server')
+    parser.add_argument('--sites', action='store_true', help='Have the server started with --server find the stops too')
+    parser.add_argument('--report', type=float, default=5, help='Seconds between prints of the server counters')
+    parser.add_argument('files', nargs='*', default=SAMPLES)
+    args = parser.parse_args()
+
+    if args.server:
+        asyncio.run(with_server(args))
+    else:
+        asyncio.run(run(args.files, args.vehicles, args.speed, args.host, args.port or 9000, args.protocol))
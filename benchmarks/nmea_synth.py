@@ -0,0 +1,250 @@
+"""
+File: Synthetic NMEA traces
+Author: JosephGolden, JenniferLiu
+
+Writes GPS logs in the format of sample_kml/*.TXT, a $GPGGA and a
+$GPRMC sentence for every fix, with the header the logger puts on
+top. The car drives a grid of streets around Rochester, with turns at
+the corners, stops now and then, and the two faults of the real logs:
+burps, where the logger cuts a $GPRMC short with a $PGACK, and dropouts,
+where the receiver loses its fix and sends sentences with empty fields.
+The same settings and seed always give the same file.
+
+python benchmarks/nmea_synth.py --points 1000000 out.txt
+"""
+
+import argparse
+import datetime
+import os
+
+import numpy as np
+
+EARTH_RADIUS = 6371000
+
+# 1 knot in mph, the parser turns knots into mph with the same factor
+KNOT = 1.151
+
+HEADER = 'Vers 57\nUSE_SERIAL_FEEDBACK=false\nDEVELOPMENT_MODE=false\nUSE_RMC_ONLY=false\n\n'
+
+def drive(n, rate=5, block=150, turn_every=4, stop_every=120, stop_length=30,
+          center=(-77.6, 43.1), radius=5000, seed=0):
+    """
+    Path of a car around a grid of streets
+    :param n: Number of fixes
+    :param rate: Fixes per second
+    :param block: Length of a block of the grid in meters
+    :param turn_every: The car turns at a corner after this many blocks on average
+    :param stop_every: The car stops at a corner after about this many seconds of driving
+    :param stop_length: Seconds every stop lasts
+    :param center: (lon, lat) the grid is centered on
+    :param radius: Once the car is this many meters out, it turns back towards the center
+    :return: time in seconds, lon, lat, speed in mph and course in degrees of every fix
+    """
+    rng = np.random.default_rng(seed)
+    dt = 1 / rate
+
+    speeds, headings = [], []
+    x = y = 0.0
+    heading = 0.0
+    count, driven = 0, 0.0
+
+    def piece(speed, heading):
+        nonlocal x, y, count
+        speeds.append(speed)
+        headings.append(heading)
+        step = speed * 0.44704 * dt
+        x += np.sum(step * np.cos(np.radians(heading)))
+        y += np.sum(step * np.sin(np.radians(heading)))
+        count += len(speed)
+
+    while count < n:
+        # Drive a few blocks straight on, at a steady speed with a bit of noise
+        cruise = rng.uniform(25, 40)
+        blocks = rng.geometric(1 / turn_every)
+        samples = max(int(blocks * block / (cruise * 0.44704) * rate), 1)
+        piece(cruise + rng.normal(0, 1, samples), np.full(samples, heading))
+        driven += samples * dt
+
+        # Slow down for the corner, and now and then stop there
+        slow = 4 * rate
+        piece(np.linspace(cruise, 10, slow), np.full(slow, heading))
+        if driven >= stop_every:
+            piece(np.linspace(10, 0, 3 * rate), np.full(3 * rate, heading))
+            piece(np.zeros(stop_length * rate), np.full(stop_length * rate, heading))
+            piece(np.linspace(0, 10, 3 * rate), np.full(3 * rate, heading))
+            driven = 0.0
+
+        # Turn left or right, back towards the center once too far out
+        if np.hypot(x, y) > radius:
+            back = np.degrees(np.arctan2(-y, -x))
+            turn = 90 if ((back - heading + 180) % 360 - 180) > 0 else -90
+        else:
+            turn = rng.choice([-90, 90])
+        samples = 3 * rate
+        piece(np.full(samples, 10.0), heading + np.linspace(0, turn, samples))
+        heading = (heading + turn) % 360
+        piece(np.linspace(10, cruise, slow), np.full(slow, heading))
+
+    speed = np.maximum(np.concatenate(speeds)[:n], 0)
+    heading = np.concatenate(headings)[:n]
+
+    step = speed * 0.44704 * dt
+    x = np.cumsum(step * np.cos(np.radians(heading)))
+    y = np.cumsum(step * np.sin(np.radians(heading)))
+
+    # About 1.5 meters of receiver jitter on every fix
+    x += rng.normal(0, 1.5, n)
+    y += rng.normal(0, 1.5, n)
+
+    lon0, lat0 = center
+    lat = lat0 + np.degrees(y / EARTH_RADIUS)
+    lon = lon0 + np.degrees(x / (EARTH_RADIUS * np.cos(np.radians(lat0))))
+
+    # Course over ground counts clockwise from north
+    course = (90 - heading) % 360
+    time = np.arange(n) * dt
+
+    return time, lon, lat, speed, course
+
+def quality(n, seed=0):
+    """
+    What the receiver says about every fix, all of it good enough
+    for the parser to keep the fix
+    :return: satellites, dilution of precision and altitude in meters of every fix
+    """
+    rng = np.random.default_rng(seed + 2)
+    return rng.integers(4, 11, n), rng.uniform(0.9, 3.5, n), 150 + rng.normal(0, 2, n)
+
+def faults(n, rate=5, burp_rate=0.001, dropout_every=600, dropout_length=10, seed=0):
+    """
+    Where the log goes wrong
+    :param burp_rate: Share of the $GPRMC sentences cut short by a $PGACK
+    :param dropout_every: The fix is lost about this many seconds apart, 0 for never
+    :param dropout_length: Seconds every dropout lasts
+    :return: mask of the fixes that are burps, and of those in a dropout
+    """
+    rng = np.random.default_rng(seed + 1)
+    burp = rng.random(n) < burp_rate
+
+    dropout = np.zeros(n, dtype=bool)
+    if dropout_every > 0:
+        period = dropout_every * rate
+        starts = np.arange(rng.integers(0, period), n, period)
+        for start in starts:
+            dropout[start:start + dropout_length * rate] = True
+
+    return burp, dropout
+
+def _dm(degrees, width):
+    """
+    Degrees as NMEA dddmm.mmmm, without the hemisphere
+    """
+    value = np.abs(degrees)
+    whole = np.floor(value)
+    minutes = np.round((value - whole) * 60, 4)
+
+    # 59.99996 minutes round up to the next degree
+    carry = minutes >= 60
+    whole, minutes = whole + carry, np.where(carry, minutes - 60, minutes)
+    return ['{:0{}d}{:07.4f}'.format(int(d), width, m) for d, m in zip(whole, minutes)]
+
+def _checksums(bodies):
+    """
+    NMEA checksum of every sentence, the XOR of the bytes between $ and *
+    """
+    data = np.frombuffer('\n'.join(bodies).encode() + b'\n', dtype=np.uint8)
+    lengths = np.fromiter((len(body) + 1 for body in bodies), dtype=np.int64, count=len(bodies))
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+
+    # Every slice holds its newline too, which XORs in as 0x0A
+    return np.bitwise_xor.reduceat(data, starts) ^ 0x0A
+
+def sentences(time, lon, lat, speed, course, sats, dil, alt, burp, dropout,
+              start=datetime.datetime(2019, 4, 2, 14, 12)):
+    """
+    The $GPGGA and $GPRMC lines of every fix
+    :param start: Date and time of the first fix
+    :return: list of lines
+    """
+    stamp = [start + datetime.timedelta(seconds=float(t)) for t in time]
+    clock = ['{:%H%M%S}.{:03d}'.format(s, s.microsecond // 1000) for s in stamp]
+    date = ['{:%d%m%y}'.format(s) for s in stamp]
+
+    lats = _dm(lat, 2)
+    lons = _dm(lon, 3)
+    ns = np.where(lat >= 0, 'N', 'S')
+    ew = np.where(lon >= 0, 'E', 'W')
+
+    bodies = []
+    for i in range(len(time)):
+        if dropout[i]:
+            bodies.append('GPGGA,{},,,,,0,00,,,M,,M,,'.format(clock[i]))
+            bodies.append('GPRMC,{},V,,,,,0.00,0.00,{},,,N'.format(clock[i], date[i]))
+            continue
+
+        bodies.append('GPGGA,{},{},{},{},{},1,{:02d},{:.2f},{:.1f},M,-34.4,M,,'.format(
+            clock[i], lats[i], ns[i], lons[i], ew[i], sats[i], dil[i], alt[i]))
+        if burp[i]:
+            # The logger cut in with its acknowledgement mid sentence
+            bodies.append('GPRMC,{},A,{},{},{},{},$PGACK,33'.format(clock[i], lats[i], ns[i], lons[i], ew[i]))
+        else:
+            bodies.append('GPRMC,{},A,{},{},{},{},{:.2f},{:.2f},{},,,A'.format(
+                clock[i], lats[i], ns[i], lons[i], ew[i], speed[i] / KNOT, course[i], date[i]))
+
+    return ['${}*{:02X}'.format(body, checksum) for body, checksum in zip(bodies, _checksums(bodies))]
+
+def write_trace(path, points, rate=5, seed=0, burp_rate=0.001, dropout_every=600, dropout_length=10,
+                chunk_size=200000, **drive_options):
+    """
+    Write a synthetic log of points fixes
+    :param path: File to write
+    :param points: Number of fixes, every fix is a $GPGGA and a $GPRMC line
+    :param drive_options: More settings of the path, see drive
+    :return: path
+    """
+    time, lon, lat, speed, course = drive(points, rate=rate, seed=seed, **drive_options)
+    sats, dil, alt = quality(points, seed)
+    burp, dropout = faults(points, rate, burp_rate, dropout_every, dropout_length, seed)
+
+    tmp = path + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(HEADER)
+        for lo in range(0, points, chunk_size):
+            hi = min(lo + chunk_size, points)
+            lines = sentences(time[lo:hi], lon[lo:hi], lat[lo:hi], speed[lo:hi], course[lo:hi],
+                              sats[lo:hi], dil[lo:hi], alt[lo:hi], burp[lo:hi], dropout[lo:hi])
+            f.write('\n'.join(lines) + '\n')
+    os.replace(tmp, path)
+    return path
+
+def cached_trace(points, data_dir, **options):
+    """
+    Path of a synthetic log, written the first time it is asked for
+    :param data_dir: Where the logs are kept between runs
+    :param options: Settings of write_trace
+    :return: path
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    settings = '_'.join('{}{}'.format(key, value) for key, value in sorted(options.items()))
+    path = os.path.join(data_dir, 'synth_{}{}.txt'.format(points, '_' + settings if settings else ''))
+    if not os.path.exists(path):
+        write_trace(path, points, **options)
+    return path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=10000, help='Number of fixes')
+    parser.add_argument('--rate', type=int, default=5, help='Fixes per second')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stop-every', type=int, default=120, help='Seconds of driving between stops')
+    parser.add_argument('--stop-length', type=int, default=30, help='Seconds every stop lasts')
+    parser.add_argument('--turn-every', type=float, default=4, help='Blocks between turns on average')
+    parser.add_argument('--burp-rate', type=float, default=0.001, help='Share of $GPRMC sentences cut short')
+    parser.add_argument('--dropout-every', type=int, default=600, help='Seconds between losses of the fix, 0 for never')
+    parser.add_argument('--dropout-length', type=int, default=10, help='Seconds every loss of the fix lasts')
+    parser.add_argument('out', help='File to write')
+    args = parser.parse_args()
+
+    write_trace(args.out, args.points, rate=args.rate, seed=args.seed, burp_rate=args.burp_rate,
+                dropout_every=args.dropout_every, dropout_length=args.dropout_length,
+                stop_every=args.stop_every, stop_length=args.stop_length, turn_every=args.turn_every)